@@ -0,0 +1,231 @@
+#!/usr/bin/python
+"""
+A structured access log, written as one JSON object per line.
+
+Only class AccessLog is defined in this module, plus addOptions() and
+makeAccessLog() which give the servers the command line options to
+configure it.
+
+"""
+import os
+import sys
+import errno
+import time
+import json
+import random
+import threading
+import Queue
+import fcntl
+
+ACCESSLOG = '/var/log/eleserver.access.log'
+MAX_QUEUE = 10000         # records waiting to be written.
+BATCH_SIZE = 500          # records written with one write().
+FLUSH_INTERVAL = 1.0      # seconds a record may wait before it is written.
+MAX_BYTES = 100*1024*1024 # size at which the log is rotated (0 = never).
+BACKUP_COUNT = 5          # number of rotated logs kept.
+
+class AccessLog:
+    """
+    Writes access log records (dictionaries) to file fname as JSON lines.
+
+    log() only puts the record on a bounded queue, so it never waits for
+    the disk - a background thread takes the records off the queue and
+    writes them in batches, with one write() for up to BATCH_SIZE records,
+    at least every flushInterval seconds.  If the queue is full (the disk
+    can not keep up) records are dropped and counted, rather than slowing
+    down the requests.
+
+    If fd is given it is the log, already opened with openLog() - by a
+    server before it gave up root, say.
+
+    If sampleRate is less than 1, only that fraction of the records is
+    logged.  The log is rotated when it is bigger than maxBytes, keeping
+    backupCount old logs as fname.1, fname.2...  Several processes can
+    share one log - each batch is written with a single append, and a lock
+    file makes sure only one of them rotates it.
+
+    To use this class do:
+        accessLog = AccessLog('access.log')
+        accessLog.log({'path':'/', 'status':200})
+        ...
+        accessLog.close()
+
+    """
+
+    def __init__(self,fname,sampleRate=1.0,maxBytes=MAX_BYTES,
+                 backupCount=BACKUP_COUNT,flushInterval=FLUSH_INTERVAL,
+                 maxQueue=MAX_QUEUE,fd=None):
+        self.fname = fname
+        self.sampleRate = float(sampleRate)
+        self.maxBytes = int(maxBytes)
+        self.backupCount = int(backupCount)
+        self.flushInterval = float(flushInterval)
+        self.queue = Queue.Queue(maxQueue)
+        self.dropped = 0
+        self.droppedLock = threading.Lock()
+        self.written = 0
+        self.rotateFailed = False
+        if fd is None:
+            self.openLog()
+        else:
+            self.fd = fd
+        self.thread = threading.Thread(target=self.writer,
+                                       name="eleserver-accesslog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log(self,record):
+        """Queue record (a dictionary which can be converted to JSON) to
+        be written to the log, unless it is not picked by the sampling."""
+        if self.sampleRate < 1.0 and random.random() >= self.sampleRate:
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            with self.droppedLock:
+                self.dropped += 1
+
+    def close(self):
+        "Write the records still queued, and close the log."
+        self.queue.put(None)
+        self.thread.join()
+
+    def openLog(self):
+        self.fd = openLog(self.fname)
+
+    def writer(self):
+        "Main loop of the thread which writes the log."
+        while True:
+            records = [self.queue.get()]
+            deadline = time.time() + self.flushInterval
+            while records[-1] is not None and len(records) < BATCH_SIZE:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    records.append(self.queue.get(True, timeout))
+                except Queue.Empty:
+                    break
+            finished = (records[-1] is None)
+            if finished:
+                records.pop()
+            if records:
+                try:
+                    self.writeRecords(records)
+                except (OSError, IOError, TypeError, ValueError), e:
+                    print >>sys.stderr, "AccessLog - error writing %s - %s" % (self.fname, e)
+            if finished:
+                os.close(self.fd)
+                return
+
+    def writeRecords(self,records):
+        lines = []
+        for record in records:
+            # A record which can not be converted is lost on its own,
+            # rather than with the rest of the batch.
+            try:
+                lines.append(json.dumps(record, separators=(',',':'),
+                                        sort_keys=True))
+            except (TypeError, ValueError), e:
+                print >>sys.stderr, "AccessLog - can not write record - %s" % e
+        nrecords = len(lines)
+        with self.droppedLock:
+            (dropped, self.dropped) = (self.dropped, 0)
+        if dropped:
+            lines.append(json.dumps({'time':round(time.time(),3),
+                                     'dropped':dropped}))
+        if not lines:
+            return
+        self.checkRotate()
+        os.write(self.fd, '\n'.join(lines) + '\n')
+        self.written += nrecords
+
+    def checkRotate(self):
+        """Rotate the log if it is too big, and reopen it if another
+        process has rotated it.  If that fails - a server which has given
+        up root may not be allowed to rename or open files in the log's
+        directory - the error is reported once, and the records carry on
+        being appended to the file already open."""
+        try:
+            self.rotate()
+        except OSError, e:
+            if not self.rotateFailed:
+                print >>sys.stderr, "AccessLog - can not rotate %s - %s" % (self.fname, e)
+                self.rotateFailed = True
+
+    def rotate(self):
+        try:
+            st = os.stat(self.fname)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            st = None
+        if st is None or st.st_ino != os.fstat(self.fd).st_ino:
+            self.reopenLog()
+            return
+        if self.maxBytes <= 0 or st.st_size < self.maxBytes:
+            return
+        lockfd = os.open(self.fname + '.lock', os.O_WRONLY|os.O_CREAT, 0644)
+        try:
+            fcntl.flock(lockfd, fcntl.LOCK_EX)
+            # Check again - another process may have rotated it while we
+            # were waiting for the lock.
+            st = os.stat(self.fname)
+            if st.st_ino == os.fstat(self.fd).st_ino and st.st_size >= self.maxBytes:
+                for i in range(self.backupCount-1, 0, -1):
+                    if os.path.exists("%s.%d" % (self.fname, i)):
+                        os.rename("%s.%d" % (self.fname, i),
+                                  "%s.%d" % (self.fname, i+1))
+                if self.backupCount > 0:
+                    os.rename(self.fname, self.fname + '.1')
+                else:
+                    os.remove(self.fname)
+        finally:
+            os.close(lockfd)
+        self.reopenLog()
+
+    def reopenLog(self):
+        "Open the log again, closing the old file only once that has worked."
+        fd = openLog(self.fname)
+        os.close(self.fd)
+        self.fd = fd
+
+
+def openLog(fname):
+    "Open log file fname for appending, and return the file descriptor."
+    return os.open(fname, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+
+
+def addOptions(parser):
+    "Add the access log command line options to OptionParser parser."
+    parser.add_option("--accesslog", dest="accesslog",
+                      help="access log file (JSON lines) - empty for no access log")
+    parser.add_option("--logsample", dest="logsample",
+                      help="fraction of requests to write to the access log")
+    parser.add_option("--logmaxbytes", dest="logmaxbytes",
+                      help="size at which the access log is rotated (0 = never)")
+    parser.add_option("--logbackups", dest="logbackups",
+                      help="number of rotated access logs to keep")
+    parser.set_defaults(accesslog=ACCESSLOG,
+                        logsample="1.0",
+                        logmaxbytes=MAX_BYTES,
+                        logbackups=BACKUP_COUNT)
+
+
+def openAccessLog(options):
+    """Open the access log file selected by the command line options, and
+    return its file descriptor (to pass to makeAccessLog()), or None if
+    there is to be no access log."""
+    if not options.accesslog:
+        return None
+    return openLog(options.accesslog)
+
+
+def makeAccessLog(options,fd=None):
+    """Return the AccessLog selected by the command line options, or None
+    if there is to be no access log.  fd is the log file if it has already
+    been opened with openAccessLog()."""
+    if not options.accesslog:
+        return None
+    return AccessLog(options.accesslog, options.logsample,
+                     options.logmaxbytes, options.logbackups, fd=fd)
@@ -0,0 +1,446 @@
+#!/usr/bin/python
+#----------------------------------------------------------------------------
+# Elevation server benchmarks
+#
+# Generates a set of synthetic SRTM GeoTIFF tiles (and optionally raw
+# tiles - see srtm_raw.py), so that no real data is needed, then times:
+#   * single point lookups with getElevation() - nearest and bilinear.
+#   * batch lookups with getElevations() - nearest, bilinear and bicubic.
+#   * GPX parsing (gpx_parse.py) and elevation enrichment (gpx_enrich.py).
+#   * map tile rendering (srtm_tilegen) - the NumPy renderer, and the old
+#     per-pixel gd renderer if gd is installed, and a small tile pyramid
+#     sampled at every zoom level and in overview mode.
+#   * HTTP throughput of eleserver - single point GETs and bulk POSTs.
+# The tiles, points and GPX files are generated from a fixed random seed,
+# so runs are repeatable, and each benchmark is repeated and the best time
+# kept.  The results are written as JSON, and can be compared with the
+# results of an earlier run to find regressions:
+#   python ./benchmark.py -o new.json
+#   python ./benchmark.py -o new.json --compare old.json
+# python ./benchmark.py -h gives more information on arguments.
+#----------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import threading
+import subprocess
+import httplib
+from timeit import default_timer
+from cStringIO import StringIO
+from optparse import OptionParser
+import numpy
+import gdal
+
+TILE_SIZE = 1200          # pixels per degree (3 arc second data).
+SEED = 1281
+
+def makeTiles(dirname, lat0, lon0, nlat, nlon, size=TILE_SIZE, seed=SEED):
+    """Write nlat x nlon synthetic one degree GeoTIFF tiles of size x size
+    pixels, covering lat0..lat0+nlat, lon0..lon0+nlon, into directory
+    dirname, and a tile list file for srtm_tiff.  Returns the name of the
+    tile list file.
+
+    The terrain is a sum of waves in latitude and longitude, so it is
+    continuous across the tile edges, plus some random roughness.
+    """
+    rng = numpy.random.RandomState(seed)
+    listfname = os.path.join(dirname, 'tiles.txt')
+    listfile = open(listfname, 'w')
+    driver = gdal.GetDriverByName('GTiff')
+    pixel = 1.0/size
+    for i in range(nlat):
+        for j in range(nlon):
+            N = lat0 + i + 1
+            W = lon0 + j
+            lats = N - (numpy.arange(size)+0.5)*pixel
+            lons = W + (numpy.arange(size)+0.5)*pixel
+            (lon2d, lat2d) = numpy.meshgrid(lons, lats)
+            ele = 400 + 300*numpy.sin(lat2d*7.0)*numpy.cos(lon2d*5.0) + \
+                  80*numpy.sin(lat2d*61.0 + lon2d*37.0) + \
+                  rng.normal(0, 5, lat2d.shape)
+            fname = os.path.join(dirname, 'synth_%+03d_%+04d.tif' % (N-1, W))
+            dataset = driver.Create(fname, size, size, 1, gdal.GDT_Int16)
+            dataset.SetGeoTransform((W, pixel, 0.0, N, 0.0, -pixel))
+            dataset.GetRasterBand(1).WriteArray(ele.astype(numpy.int16))
+            dataset.FlushCache()
+            del dataset
+            listfile.write("%s %s %s %s %s %s %s %d %d\n" %
+                           (fname, N, N-1, W+1, W, -pixel, pixel, size, size))
+    listfile.close()
+    return listfname
+
+
+def randomPoints(n, lat0, lon0, nlat, nlon, seed=SEED):
+    "Return arrays (lats,lons) of n random points in the tile set."
+    rng = numpy.random.RandomState(seed)
+    return (rng.uniform(lat0, lat0+nlat, n), rng.uniform(lon0, lon0+nlon, n))
+
+
+def makeGPX(lats, lons):
+    "Return a GPX track log (a string) of the points (lats,lons)."
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<gpx version="1.1" creator="benchmark" xmlns="http://www.topografix.com/GPX/1/1">',
+             '<trk><name>benchmark</name><trkseg>']
+    for (i, (lat, lon)) in enumerate(zip(lats.tolist(), lons.tolist())):
+        lines.append('<trkpt lat="%.6f" lon="%.6f"><ele>0</ele><time>2010-01-01T%02d:%02d:%02dZ</time></trkpt>' %
+                     (lat, lon, (i/3600)%24, (i/60)%60, i%60))
+    lines.append('</trkseg></trk></gpx>')
+    return '\n'.join(lines)
+
+
+class benchmarkRunner:
+    """Runs the benchmarks selected by the command line options, and
+    collects their results."""
+
+    def __init__(self, options):
+        self.options = options
+        self.results = {}
+
+    def selected(self, name):
+        if not self.options.only:
+            return True
+        return [prefix for prefix in self.options.only.split(',')
+                if name.startswith(prefix)] != []
+
+    def timeIt(self, name, func, ops, **extra):
+        """Run func() options.repeat times, and record the best time as
+        the result of benchmark name, which does ops operations."""
+        if not self.selected(name):
+            return
+        times = []
+        for i in range(int(self.options.repeat)):
+            tstart = default_timer()
+            func()
+            times.append(default_timer() - tstart)
+        best = min(times)
+        result = {'ops':ops, 'seconds':best, 'median_seconds':sorted(times)[len(times)/2],
+                  'us_per_op':1e6*best/ops, 'ops_per_sec':ops/best}
+        result.update(extra)
+        self.results[name] = result
+        print "%-24s %10d ops %10.3f us/op %12.1f ops/s" % \
+            (name, ops, result['us_per_op'], result['ops_per_sec'])
+
+    def skip(self, name, reason):
+        if self.selected(name):
+            self.results[name] = {'skipped':reason}
+            print "%-24s skipped - %s" % (name, reason)
+
+    def lookupBenchmarks(self, srtm, prefix, lats, lons):
+        n = int(self.options.single)
+        slats = lats[:n].tolist()
+        slons = lons[:n].tolist()
+        def single(bilinear):
+            getElevation = srtm.getElevation
+            for i in xrange(n):
+                getElevation(slats[i], slons[i], bilinear)
+        # Warm the caches first - we want the steady state.
+        srtm.getElevations(lats, lons)
+        self.timeIt(prefix+'single_nearest', lambda: single(False), n)
+        self.timeIt(prefix+'single_bilinear', lambda: single(True), n)
+        self.timeIt(prefix+'batch_nearest',
+                    lambda: srtm.getElevations(lats, lons), len(lats))
+        self.timeIt(prefix+'batch_bilinear',
+                    lambda: srtm.getElevations(lats, lons, True), len(lats))
+        self.timeIt(prefix+'batch_bicubic',
+                    lambda: srtm.getElevations(lats, lons, False, True), len(lats))
+
+    def gpxBenchmarks(self, srtm, lats, lons):
+        if not [name for name in ('gpx_parse','gpx_parser_class','gpx_enrich')
+                if self.selected(name)]:
+            return
+        from gpx_parse import iterGPXPoints, GPXParser
+        from gpx_enrich import enrichGPX
+        gpx = makeGPX(lats, lons)
+        def parse():
+            for point in iterGPXPoints(StringIO(gpx)):
+                pass
+        self.timeIt('gpx_parse', parse, len(lats), bytes=len(gpx))
+        self.timeIt('gpx_parser_class', lambda: GPXParser(gpx), len(lats))
+        self.timeIt('gpx_enrich', lambda: enrichGPX(srtm, gpx), len(lats))
+
+    def renderBenchmarks(self, srtm, tilelist):
+        names = ('render_tile', 'render_tile_gd', 'render_pyramid',
+                 'render_pyramid_overview')
+        if not [name for name in names if self.selected(name)]:
+            return
+        try:
+            from srtm_tilegen import srtm_tilegen
+            from srtm_tilegen.srtm_tilegen import rendertile
+            from srtm_tilegen.pyramid import renderPyramid, pyramidSize
+            from srtm_tilegen.tilenames import tileXY
+        except ImportError, e:
+            for name in names:
+                self.skip(name, 'srtm_tilegen can not be imported - %s' % e)
+            return
+        class renderOptions:
+            pass
+        ropts = renderOptions()
+        ropts.outputdir = os.path.join(self.options.workdir, 'render')
+        ropts.minele = 200.0
+        ropts.maxele = 800.0
+        ropts.rerender = True
+        ropts.debug = False
+        Z = 12
+        ropts.maxzoom = Z
+        (x, y) = tileXY(float(self.options.lat0)+0.5, float(self.options.lon0)+0.5, Z)
+        for (name, useGD) in (('render_tile', False), ('render_tile_gd', True)):
+            if not self.selected(name):
+                continue
+            if useGD and srtm_tilegen.gd is None:
+                self.skip(name, 'gd is not installed')
+                continue
+            ropts.gd = useGD
+            self.timeIt(name, lambda: rendertile(ropts, srtm, x, y, Z), 1)
+
+        # Zoom levels 9 to 11 - 21 tiles, rendered in this process.
+        Z = 9
+        (x, y) = tileXY(float(self.options.lat0)+0.5, float(self.options.lon0)+0.5, Z)
+        ropts.filename = tilelist
+        ropts.maxzoom = Z+2
+        ropts.procs = 0
+        ropts.covered = False
+        ntiles = pyramidSize(Z, ropts.maxzoom)
+        for (name, overview) in (('render_pyramid', None),
+                                 ('render_pyramid_overview', 'mean')):
+            ropts.overview = overview
+            self.timeIt(name, lambda: renderPyramid(ropts, srtm, x, y, Z), ntiles)
+
+    def httpBenchmarks(self, srtm, lats, lons):
+        if not (self.selected('http_get') or self.selected('http_get_keepalive')
+                or self.selected('http_bulk')):
+            return
+        from eleserver import eleHTTPServer, eleServer
+        import bulkcoords
+        server = eleHTTPServer(('127.0.0.1', 0), eleServer, srtm,
+                               int(self.options.threads))
+        port = server.server_address[1]
+        serverThread = threading.Thread(target=server.serve_forever)
+        serverThread.daemon = True
+        serverThread.start()
+        n = int(self.options.requests)
+        clients = int(self.options.clients)
+        plats = lats[:n].tolist()
+        plons = lons[:n].tolist()
+        body = numpy.column_stack((lats, lons)).astype('<f8').tostring()
+
+        def run(request, nrequests, keepalive):
+            latencies = []
+            def client(k):
+                conn = None
+                for i in range(k, nrequests, clients):
+                    tstart = default_timer()
+                    if conn is None:
+                        conn = httplib.HTTPConnection('127.0.0.1', port)
+                    request(conn, i)
+                    reply = conn.getresponse()
+                    reply.read()
+                    if not keepalive or reply.getheader('connection') == 'close':
+                        conn.close()
+                        conn = None
+                    if reply.status != 200:
+                        raise RuntimeError("HTTP status %d" % reply.status)
+                    latencies.append(default_timer() - tstart)
+                if conn is not None:
+                    conn.close()
+            threads = [threading.Thread(target=client, args=(k,))
+                       for k in range(clients)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            return latencies
+
+        def get(conn, i):
+            conn.request('GET', '/?lat=%f&lon=%f' % (plats[i], plons[i]))
+        def bulk(conn, i):
+            conn.request('POST', '/elevations', body,
+                         {'Content-Type':'application/octet-stream'})
+
+        nbulk = max(n/100, 10)
+        for (name, request, nrequests, points, keepalive) in (
+            ('http_get', get, n, 1, False),
+            ('http_get_keepalive', get, n, 1, True),
+            ('http_bulk', bulk, nbulk, len(lats), False)):
+            if not self.selected(name):
+                continue
+            latencies = []
+            def once():
+                latencies[:] = run(request, nrequests, keepalive)
+            self.timeIt(name, once, nrequests, points_per_request=points,
+                        clients=clients)
+            latencies.sort()
+            self.results[name]['p50_ms'] = 1000*latencies[len(latencies)/2]
+            self.results[name]['p99_ms'] = 1000*latencies[int(len(latencies)*0.99)]
+        server.shutdown()
+        server.server_close()
+
+    def run(self):
+        options = self.options
+        (lat0, lon0) = (float(options.lat0), float(options.lon0))
+        (nlat, nlon) = (int(options.nlat), int(options.nlon))
+        print "Generating %d x %d synthetic tiles in %s" % (nlat, nlon, options.workdir)
+        tilelist = makeTiles(options.workdir, lat0, lon0, nlat, nlon,
+                             int(options.tilesize), int(options.seed))
+        (lats, lons) = randomPoints(int(options.points), lat0, lon0, nlat, nlon,
+                                    int(options.seed))
+
+        from srtm_tiff3 import srtm_tiff
+        srtm = srtm_tiff(tilelist, nlat*nlon, False, False)
+        self.lookupBenchmarks(srtm, '', lats, lons)
+        if options.raw:
+            from srtm_raw import srtm_raw, convertTiles
+            convertTiles(tilelist, False, 2)
+            self.lookupBenchmarks(srtm_raw(tilelist, nlat*nlon, False, False),
+                                  'raw_', lats, lons)
+        self.gpxBenchmarks(srtm, lats[:int(options.gpxpoints)],
+                           lons[:int(options.gpxpoints)])
+        self.renderBenchmarks(srtm, tilelist)
+        self.httpBenchmarks(srtm, lats, lons)
+        return self.results
+
+
+def systemInfo():
+    "Return a dictionary describing the code and machine being benchmarked."
+    info = {'time':time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python':platform.python_version(),
+            'numpy':numpy.__version__,
+            'platform':platform.platform(),
+            'machine':platform.machine(),
+            'cpus':os.sysconf('SC_NPROCESSORS_ONLN')}
+    try:
+        info['gdal'] = gdal.VersionInfo()
+    except AttributeError:
+        pass
+    try:
+        info['commit'] = subprocess.Popen(
+            ['git', 'describe', '--always', '--dirty'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0].strip()
+    except OSError:
+        pass
+    return info
+
+
+def compareResults(old, new, threshold):
+    """Print a comparison of the results of two runs (as written by this
+    program), and return the names of the benchmarks which are more than
+    threshold (a fraction) slower in new."""
+    regressions = []
+    print "%-24s %12s %12s %8s" % ('benchmark', 'old us/op', 'new us/op', 'change')
+    for name in sorted(set(old['results'].keys()) & set(new['results'].keys())):
+        (o, n) = (old['results'][name], new['results'][name])
+        if 'us_per_op' not in o or 'us_per_op' not in n:
+            continue
+        change = n['us_per_op']/o['us_per_op'] - 1.0
+        flag = ''
+        if change > threshold:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print "%-24s %12.3f %12.3f %+7.1f%%%s" % \
+            (name, o['us_per_op'], n['us_per_op'], 100*change, flag)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    usage = "benchmark [options]"
+    parser.add_option("-o", "--output", dest="output",
+                      help="file to write the results to (JSON)")
+    parser.add_option("--compare", dest="compare",
+                      help="results of an earlier run to compare with")
+    parser.add_option("--threshold", dest="threshold",
+                      help="fraction slower than the earlier run which counts as a regression")
+    parser.add_option("--only", dest="only",
+                      help="comma separated list of benchmarks (or prefixes) to run")
+    parser.add_option("--workdir", dest="workdir",
+                      help="directory for the synthetic tiles (default a temporary directory)")
+    parser.add_option("--nlat", dest="nlat",
+                      help="number of tiles north-south")
+    parser.add_option("--nlon", dest="nlon",
+                      help="number of tiles east-west")
+    parser.add_option("--lat0", dest="lat0",
+                      help="latitude of the south edge of the tiles")
+    parser.add_option("--lon0", dest="lon0",
+                      help="longitude of the west edge of the tiles")
+    parser.add_option("--tilesize", dest="tilesize",
+                      help="tile size in pixels")
+    parser.add_option("--raw", action="store_true", dest="raw",
+                      help="also benchmark raw tiles (see srtm_raw.py)")
+    parser.add_option("--points", dest="points",
+                      help="number of points for the batch lookups")
+    parser.add_option("--single", dest="single",
+                      help="number of points for the single point lookups")
+    parser.add_option("--gpxpoints", dest="gpxpoints",
+                      help="number of points in the GPX file")
+    parser.add_option("--requests", dest="requests",
+                      help="number of HTTP GET requests")
+    parser.add_option("--clients", dest="clients",
+                      help="number of concurrent HTTP clients")
+    parser.add_option("-t", "--threads", dest="threads",
+                      help="number of server worker threads")
+    parser.add_option("--repeat", dest="repeat",
+                      help="number of times to run each benchmark (the best is kept)")
+    parser.add_option("--seed", dest="seed",
+                      help="random seed for the tiles and points")
+    parser.set_defaults(output=None,
+                        compare=None,
+                        threshold="0.2",
+                        only=None,
+                        workdir=None,
+                        nlat="2",
+                        nlon="2",
+                        lat0="54",
+                        lon0="-2",
+                        tilesize=TILE_SIZE,
+                        raw=False,
+                        points="100000",
+                        single="10000",
+                        gpxpoints="20000",
+                        requests="2000",
+                        clients="8",
+                        threads="8",
+                        repeat="3",
+                        seed=SEED)
+    (options,args)=parser.parse_args()
+
+    tmpdir = None
+    if options.workdir is None:
+        tmpdir = options.workdir = tempfile.mkdtemp(prefix='eleserver-bench-')
+    try:
+        results = benchmarkRunner(options).run()
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, True)
+
+    output = {'system':systemInfo(),
+              'options':dict([(k, v) for (k, v) in vars(options).items()
+                              if k not in ('output', 'compare', 'workdir')]),
+              'results':results}
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump(output, f, indent=1, sort_keys=True)
+        f.close()
+        print "Results written to %s" % options.output
+    if options.compare:
+        regressions = compareResults(json.load(open(options.compare)), output,
+                                     float(options.threshold))
+        if regressions:
+            print "Regressions: %s" % ', '.join(regressions)
+            sys.exit(1)
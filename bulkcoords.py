@@ -0,0 +1,160 @@
+"""
+NAME: bulkcoords
+DESC: Reading lists of coordinates, and writing lists of elevations, in the
+      formats accepted by the eleserver bulk elevation request
+      (POST /elevations).  The format is chosen by the Content-Type of the
+      request, and the reply is in the same format:
+
+      json     - application/json
+                 request [[lat,lon],[lat,lon],...] or [{"lat":..,"lon":..},...]
+                 reply   [ele,ele,...] with null for points out of range.
+      csv      - text/csv
+                 request one "lat,lon" line per point, with no other
+                 columns (a header line is allowed), reply "lat,lon,ele" lines, with ele empty for
+                 points out of range.
+      polyline - text/x-polyline (or application/x-polyline)
+                 request the points as an encoded polyline (the Google maps
+                 algorithm, 5 decimal places), reply the elevations in
+                 whole metres encoded the same way as a list of single
+                 values, with -32768 for points out of range.
+      binary   - application/octet-stream
+                 request little-endian float64 (lat,lon) pairs, reply
+                 little-endian float64 elevations, NaN for out of range.
+
+      The decoding and encoding is done with NumPy array operations where
+      possible, so that large requests are not limited by per point
+      Python overheads.
+
+"""
+import json
+import numpy
+
+FORMATS = {'application/json':'json',
+           'text/csv':'csv',
+           'text/x-polyline':'polyline',
+           'application/x-polyline':'polyline',
+           'application/octet-stream':'binary'}
+
+CONTENT_TYPES = {'json':'application/json',
+                 'csv':'text/csv',
+                 'polyline':'text/x-polyline',
+                 'binary':'application/octet-stream'}
+
+VOID = -32768
+
+def getFormat(contentType):
+    """Return the format name for content type contentType (without any
+    parameters), or None if it is not a supported format."""
+    return FORMATS.get((contentType or '').lower())
+
+
+def decodeCoords(fmt,data):
+    """Decode the coordinates in string data, which is in format fmt.
+    Returns a tuple of arrays (lats,lons).  Raises ValueError if the data
+    is not valid.
+    """
+    if fmt == 'json':
+        points = json.loads(data)
+        if not isinstance(points,list):
+            raise ValueError("expected a JSON array of points")
+        if len(points) > 0 and isinstance(points[0],dict):
+            points = [(p['lat'],p['lon']) for p in points]
+        for (i,p) in enumerate(points):
+            if not isinstance(p,(list,tuple)) or len(p) != 2:
+                raise ValueError("point %d is not a [lat,lon] pair" % (i+1))
+        coords = numpy.array(points,dtype=float).reshape(-1,2)
+    elif fmt == 'csv':
+        lines = data.strip().splitlines()
+        first = 1
+        if len(lines) > 0 and not lines[0].strip()[:1] in '+-.0123456789':
+            lines = lines[1:]  # header
+            first = 2
+        points = []
+        for (i,line) in enumerate(lines):
+            if line.strip() == '':
+                continue
+            fields = line.split(',')
+            try:
+                if len(fields) != 2:
+                    raise ValueError
+                points.append((float(fields[0]),float(fields[1])))
+            except ValueError:
+                raise ValueError("line %d is not \"lat,lon\"" % (i+first))
+        coords = numpy.array(points,dtype=float).reshape(-1,2)
+    elif fmt == 'polyline':
+        coords = decodePolyline(data.strip()).reshape(-1,2)/1e5
+    elif fmt == 'binary':
+        if len(data) % 16 != 0:
+            raise ValueError("binary data must be pairs of float64 values")
+        coords = numpy.frombuffer(data,dtype='<f8').reshape(-1,2)
+    else:
+        raise ValueError("unknown format %s" % fmt)
+    return (coords[:,0].astype(float),coords[:,1].astype(float))
+
+
+def encodeElevations(fmt,lats,lons,eles,outside):
+    """Encode elevations eles (with boolean array outside marking the
+    points out of range) for the points (lats,lons) in format fmt.
+    Returns the encoded string.
+    """
+    if fmt == 'json':
+        values = numpy.where(outside,numpy.nan,eles).tolist()
+        return json.dumps([None if v != v else v for v in values])
+    elif fmt == 'csv':
+        lines = ["%s,%s,%s" % (lat,lon,'' if out else ele)
+                 for (lat,lon,ele,out) in zip(lats.tolist(),lons.tolist(),
+                                              eles.tolist(),outside.tolist())]
+        return '\n'.join(lines) + '\n'
+    elif fmt == 'polyline':
+        values = numpy.where(outside,VOID,numpy.rint(eles)).astype(numpy.int64)
+        return encodePolyline(values)
+    elif fmt == 'binary':
+        return numpy.where(outside,numpy.nan,eles).astype('<f8').tostring()
+    else:
+        raise ValueError("unknown format %s" % fmt)
+
+
+def decodePolyline(data,ndims=2):
+    """Decode polyline encoded string data into an array of the integer
+    values it contains, with the deltas added up for each of the ndims
+    dimensions - so for a line of (lat,lon) points this gives
+    lat0,lon0,lat1,lon1... times 1e5.  Use ndims=1 for a list of single
+    values (as in the reply to a polyline request).
+
+    Each value is a run of 5 bit chunks, stored low chunk first as
+    characters chr(63+chunk), with 0x20 set on all but the last chunk.
+    """
+    if len(data) == 0:
+        return numpy.zeros(0,dtype=numpy.int64)
+    b = numpy.frombuffer(data,dtype=numpy.uint8).astype(numpy.int64) - 63
+    if b.min() < 0 or b.max() > 63:
+        raise ValueError("invalid character in polyline")
+    last = (b & 0x20) == 0
+    if not last[-1]:
+        raise ValueError("polyline ends part way through a value")
+    # Number each chunk with the value it belongs to, and its position
+    # within that value.
+    value = numpy.concatenate(([0],numpy.cumsum(last)[:-1]))
+    starts = numpy.nonzero(numpy.concatenate(([True],last[:-1])))[0]
+    pos = numpy.arange(len(b)) - starts[value]
+    raw = numpy.zeros(value[-1]+1,dtype=numpy.int64)
+    numpy.add.at(raw,value,(b & 0x1f) << (5*pos))
+    deltas = numpy.where(raw & 1,~(raw >> 1),raw >> 1)
+    if len(deltas) % ndims != 0:
+        raise ValueError("polyline does not contain whole points")
+    return numpy.cumsum(deltas.reshape(-1,ndims),axis=0).ravel()
+
+
+def encodePolyline(values):
+    """Encode the integer values as a polyline string of single values
+    (the inverse of decodePolyline for a list of single values).
+    """
+    deltas = numpy.diff(numpy.concatenate(([0],values))).tolist()
+    chars = []
+    for delta in deltas:
+        v = ~(delta << 1) if delta < 0 else (delta << 1)
+        while v >= 0x20:
+            chars.append(chr((0x20 | (v & 0x1f)) + 63))
+            v >>= 5
+        chars.append(chr(v + 63))
+    return ''.join(chars)
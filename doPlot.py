@@ -2,64 +2,292 @@
 
 """Produce a PNG image of a simple XY chart
 
+The elevation profile of a route is worked out by profileData(), and
+drawn by renderPlot(), which uses its own matplotlib figure rather than
+the pylab global state, so plots can be drawn in several threads or
+processes at once.  class plotRenderer draws the plots in a pool of
+processes, and keeps them in a cache.
+
 """
 from math import *
+import os
+import hashlib
+import threading
+import multiprocessing
+import numpy
 import matplotlib
 matplotlib.use('Agg')  # Need to do this to avoid X11/GTK errors in pylab
-import pylab
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from staticfiles import staticFiles
+
+PLOTDIR = 'plots'
+PLOT_URL = '/plots/'      # URL path the servers serve the plots under.
+PLOT_PROCESSES = 2
+PLOT_TIMEOUT = 30.0       # seconds to wait for a plot to be drawn.
+MAX_PLOTS = 1000          # plots kept in the cache directory.
+PLOT_VERSION = 2          # change this when the plots change, so that the
+                          # cached plots are not used.
+PROFILE_SPACING = 30.0    # metres between profile samples (about the
+                          # SRTM resolution).
+MAX_PROFILE_POINTS = 100000
+EARTH_RADIUS = 6372795.0  # metres.
 
 def doPlot(srtm,points,fname):
-    """Produce a PNG Image of a simple XY chart
+    """Produce a PNG Image of a simple XY chart of the elevation profile
+    of route points (a list of (lat,lon,...) tuples), in file fname.
+    """
+    renderPlot(profileData(srtm,points),fname)
+
+
+def haversine(lats1,lons1,lats2,lons2):
+    """Return the great circle distances in metres between the points
+    (lats1,lons1) and (lats2,lons2) - NumPy arrays (or sequences) of
+    degrees, which are worked out all at once."""
+    lats1 = numpy.radians(lats1)
+    lats2 = numpy.radians(lats2)
+    dlats = lats2 - lats1
+    dlons = numpy.radians(numpy.asarray(lons2,dtype=float) -
+                          numpy.asarray(lons1,dtype=float))
+    a = numpy.sin(dlats/2)**2 + \
+        numpy.cos(lats1)*numpy.cos(lats2)*numpy.sin(dlons/2)**2
+    return 2*EARTH_RADIUS*numpy.arcsin(numpy.sqrt(numpy.minimum(a,1.0)))
+
+
+def buildProfile(srtm,points,spacing=PROFILE_SPACING):
+    """Work out the elevation profile of route points (a list of
+    (lat,lon,...) tuples), sampled every spacing metres along the route.
+
+    Each leg of the route is split into equal steps of no more than
+    spacing metres, so short legs get only a few samples and long ones
+    as many as they need, and all of the samples are looked up with one
+    srtm.getElevations() call.  If that would be more than
+    MAX_PROFILE_POINTS samples, the spacing is increased.
+
+    Returns a dictionary of NumPy arrays and totals:
+        'lat', 'lon': the sample positions, which include the route points
+        'dist': the distance along the route of each sample in metres
+        'ele': the elevation of each sample, NaN where there is no data
+        'ptDist', 'ptEle': the distance and elevation of the route points
+        'length', 'ascent', 'descent': totals in metres
+    """
+    if len(points) == 0:
+        raise ValueError("buildProfile - the route has no points")
+    lats = numpy.array([pt[0] for pt in points],dtype=float)
+    lons = numpy.array([pt[1] for pt in points],dtype=float)
+    legs = haversine(lats[:-1],lons[:-1],lats[1:],lons[1:])
+    legStarts = numpy.concatenate(([0.0],numpy.cumsum(legs)))
+    length = legStarts[-1]
+    spacing = max(float(spacing),length/MAX_PROFILE_POINTS)
+    steps = numpy.maximum(numpy.ceil(legs/spacing),1).astype(int)
+
+    # The fraction of its leg each sample is at, and which leg it is on,
+    # with the last route point added at the end.
+    legNos = numpy.repeat(numpy.arange(len(legs)),steps)
+    firstSample = numpy.cumsum(steps) - steps
+    fracs = (numpy.arange(len(legNos)) - firstSample[legNos]) / \
+            steps[legNos].astype(float)
+    sampleLats = numpy.append(lats[legNos] + (lats[legNos+1]-lats[legNos])*fracs,
+                              lats[-1:])
+    sampleLons = numpy.append(lons[legNos] + (lons[legNos+1]-lons[legNos])*fracs,
+                              lons[-1:])
+    dist = numpy.append(legStarts[legNos] + legs[legNos]*fracs,legStarts[-1:])
+
+    (eles, outside) = srtm.getElevations(sampleLats,sampleLons,True)
+    eles = numpy.where(outside | (eles == -32768),numpy.nan,eles)
+
+    # Only count the climbs between samples which both have data.
+    climbs = numpy.diff(eles)
+    climbs = climbs[~numpy.isnan(climbs)]
+    ptIndex = numpy.append(firstSample,len(dist)-1)
+    return {'lat':sampleLats, 'lon':sampleLons, 'dist':dist, 'ele':eles,
+            'ptDist':dist[ptIndex], 'ptEle':eles[ptIndex],
+            'length':length,
+            'ascent':climbs[climbs > 0].sum(),
+            'descent':abs(climbs[climbs < 0].sum())}
+
+
+def profileData(srtm,points):
+    """Work out the data for the plot of route points - returns a
+    dictionary of the lists x_rtepts, y_rtepts, x_prof and y_prof, and
+    the totals length, ascent and descent (in metres).
 
-    How it works:
     x_rtepts and y_rtepts are lists of x and y values to plot with symbols
     - these are the locations of the specified route points.
     x_prof and y_prof are lists of x and y values to plot as a line -
-    these are the intermediate heights between the route points.
-    This version just plots 10 points between each route point (set by nProf).
-
+    these are the heights every PROFILE_SPACING metres along the route.
+    x is the distance along the route in km.
     """
-    nProf = 10  # The number of height profile points between each route point.
+    profile = buildProfile(srtm,points)
+    return {'x_rtepts':(profile['ptDist']/1000).tolist(),
+            'y_rtepts':profile['ptEle'].tolist(),
+            'x_prof':(profile['dist']/1000).tolist(),
+            'y_prof':profile['ele'].tolist(),
+            'length':float(profile['length']),
+            'ascent':float(profile['ascent']),
+            'descent':float(profile['descent'])}
+
 
-    ptNo=1
-    x_rtepts = []
-    y_rtepts = []
+def renderPlot(data,fname):
+    """Draw the plot of data (as returned by profileData()) as a PNG image
+    in file fname.  The image is written under a temporary name and
+    renamed into place, so a partly written plot is never served.
+    """
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.plot(data['x_rtepts'],data['y_rtepts'],'ro',
+            data['x_prof'],data['y_prof'],'b-')
+    ax.set_xlabel('Distance (km)')
+    ax.set_ylabel('Elevation (m)')
+    ax.set_title('%.1f km, %d m ascent, %d m descent' %
+                 (data['length']/1000,data['ascent'],data['descent']))
+    tmpfname = "%s.%d.tmp.png" % (fname,os.getpid())
+    fig.savefig(tmpfname)
+    os.rename(tmpfname,fname)
+    return fname
 
-    x_prof = []
-    y_prof = []
 
-    isfirst = 1
+def plotKey(points):
+    """Return the cache key of the plot of route points - a hash of the
+    point positions and PLOT_VERSION."""
+    h = hashlib.sha1("v%d" % PLOT_VERSION)
     for pt in points:
-       x_rtepts.append(ptNo)
-       y_rtepts.append(srtm.getElevation(pt[0],pt[1]))
-
-       if (isfirst == 1):
-           prevlat = pt[0]
-           prevlon = pt[0]
-           prevpt = pt
-           isfirst = 0
-       else:
-           for n in range(0,nProf):
-               xp = ptNo-1 + float(n)/nProf
-               #print "n=%d: nProf=%d n/nProf=%s xp=%s" % \
-               (n,nProf,float(n)/nProf,xp)
-               #print "n=%d: prevpt[0]=%s, pt[0]=%s" % (n,prevpt[0],pt[0])
-               lat = prevpt[0] + (pt[0]-prevpt[0])*n/nProf 
-               lon = prevpt[1] + (pt[1]-prevpt[1])*n/nProf
-               dist = distance(prevlat,prevlon,lat,lon)
-               prevlat = lat
-               prevlon = lon
-               x_prof.append(xp)
-               #x_prof.append(dist)
-               y_prof.append(srtm.getElevation(lat,lon))
-           prevpt = pt
-       ptNo += 1
-           
-
-    pylab.plot(x_rtepts,y_rtepts,'ro',
-               x_prof,y_prof,'b-')
-    pylab.savefig(fname)
-    pylab.show()
+        h.update("%.6f,%.6f;" % (pt[0],pt[1]))
+    return h.hexdigest()
+
+
+class plotJob:
+    """A plot being drawn by one of plotRenderer's calling threads (when it
+    has no pool), with the ready() and get() methods of the pool's
+    AsyncResult, so that other requests for the plot can wait for it."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+    def ready(self):
+        return self.done.is_set()
+
+    def get(self,timeout=None):
+        if not self.done.wait(timeout):
+            raise multiprocessing.TimeoutError
+        if self.error is not None:
+            raise self.error
+
+
+class plotRenderer:
+    """
+    Draws route elevation plots in a pool of processes worker processes,
+    keeping them in directory plotdir as <hash>.png, where hash is
+    plotKey() of the route points, so a route which has been plotted
+    before is served from the cache.  Requests for a plot which is already
+    being drawn wait for the same job.
+
+    The elevations are looked up by the calling thread (the worker
+    processes do not have the elevation data), and only the drawing is
+    done in the pool.  getPlot() waits at most timeout seconds - if the
+    plot is not ready by then it returns None, and the plot is cached
+    when it is finished.  With processes=0 the plots are drawn in the
+    calling thread (several at once if they are different plots).
+
+    The plots are served under PLOT_URL (wherever plotdir is) from
+    self.files, a staticfiles.staticFiles object for plotdir - plotURL()
+    gives the URL of a plot.
+
+    Create the renderer before starting any threads, as the pool forks
+    its processes when it is created.
+    """
+    def __init__(self,plotdir=PLOTDIR,processes=PLOT_PROCESSES,
+                 timeout=PLOT_TIMEOUT,maxPlots=MAX_PLOTS):
+        self.plotdir = plotdir
+        self.timeout = float(timeout)
+        self.maxPlots = int(maxPlots)
+        if not os.path.isdir(plotdir):
+            os.makedirs(plotdir)
+        self.files = staticFiles(plotdir)
+        self.processes = int(processes)
+        if self.processes > 0:
+            self.pool = multiprocessing.Pool(self.processes)
+        else:
+            self.pool = None
+        self.lock = threading.Lock()
+        self.jobs = {}        # key -> AsyncResult of plots being drawn.
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+
+    def getPlot(self,srtm,points):
+        """Return the file name of the plot of route points, drawing it if
+        it is not in the cache, or None if it could not be drawn within
+        the timeout."""
+        key = plotKey(points)
+        fname = os.path.join(self.plotdir,"%s.png" % key)
+        if os.path.isfile(fname):
+            with self.lock:
+                self.hits += 1
+            return fname
+        with self.lock:
+            self.misses += 1
+        data = profileData(srtm,points)
+        drawHere = False
+        with self.lock:
+            # Forget jobs which finished after their callers gave up.
+            for k in [k for (k,j) in self.jobs.items() if j.ready()]:
+                del self.jobs[k]
+            job = self.jobs.get(key)
+            if job is None:
+                if self.pool is None:
+                    job = plotJob()
+                    drawHere = True
+                else:
+                    job = self.pool.apply_async(renderPlot,(data,fname))
+                self.jobs[key] = job
+        if drawHere:
+            # Drawn without the lock held, so other plots are not held up.
+            try:
+                renderPlot(data,fname)
+            except Exception, e:
+                job.error = e
+            job.done.set()
+        try:
+            job.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            with self.lock:
+                self.timeouts += 1
+            return None
+        finally:
+            with self.lock:
+                if job.ready() and self.jobs.get(key) is job:
+                    del self.jobs[key]
+                    self.prune()
+        return fname
+
+    def plotURL(self,fname):
+        "Return the URL path of plot file fname (as returned by getPlot())."
+        return PLOT_URL + os.path.basename(fname)
+
+    def prune(self):
+        """Delete the oldest plots if there are more than maxPlots."""
+        fnames = [os.path.join(self.plotdir,f) for f in os.listdir(self.plotdir)
+                  if f.endswith('.png') and not f.endswith('.tmp.png')]
+        if len(fnames) <= self.maxPlots:
+            return
+        fnames.sort(key=os.path.getmtime)
+        for fname in fnames[:len(fnames)-self.maxPlots]:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+    def getStats(self):
+        with self.lock:
+            return {'hits':self.hits, 'misses':self.misses,
+                    'timeouts':self.timeouts, 'drawing':len(self.jobs)}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
 
 def distance(lat1_deg,lon1_deg, lat2_deg,lon2_deg):
     """Calculate the distance between two (lat,lon) points.
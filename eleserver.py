@@ -6,6 +6,32 @@
 #   * Serves SRTM elevation data in response to HTTP GET Requests
 #   * Expects two parameters lat and lon which are the lattitude and
 #     longitude of the point for which height data is required.
+#   * POST /elevations answers many points in one request - the points
+#     are sent as JSON, CSV, an encoded polyline or packed float64 values,
+#     and the elevations are returned in the same format (see bulkcoords.py).
+#   * POST /gpx returns the GPX file sent with the elevations of all of its
+#     points filled in - it is sent back (chunked) as it is read, so large
+#     files do not have to be held in memory (see gpx_enrich.py).
+#   * Each request is recorded in a JSON lines access log, written by a
+#     background thread (see accesslog.py).
+#   * GET /metrics returns request, latency, cache and tile read statistics
+#     in the Prometheus text format (see serverMetrics below).
+#   * Single point results are cached by pixel (see srtm_tiff.setPointCache),
+#     and sent with Cache-Control and ETag headers so that clients and
+#     proxies can cache them too.
+#   * Route plots (POST with Plot set) are linked as /plots/{hash}.png,
+#     served from --plotdir wherever it is.
+#   * Other GET requests are for files in the document root (see
+#     staticfiles.py) - small ones are kept in memory, and large ones are
+#     sent with sendfile().
+#   * Speaks HTTP/1.1 - connections are kept open for further (possibly
+#     pipelined) requests, up to --maxrequests, until idle for --keepalive
+#     seconds.
+#   * GET /tiles/{z}/{x}/{y}.png returns an elevation map tile, coloured
+#     from --minele to --maxele metres, and /tiles/{layer}/{z}/{x}/{y}.png
+#     a tile of the hillshade, slope or aspect layer.  Tiles are rendered
+#     when first asked for, a metatile (--metatile x --metatile tiles) at a
+#     time, and kept on disk in --tiledir and in memory (see tilecache.py).
 #----------------------------------------------------------------------------
 # Author: Graham Jones, using the pyrender server.py by Oliver White as the 
 # starting point (http://wiki.openstreetmap.org/index.php/Pyrender).
@@ -29,17 +55,43 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #---------------------------------------------------------------------------
 from BaseHTTPServer import *
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
 import re
 import sys
 import os
 import string,cgi,time
-from srtm_tiff import srtm_tiff
+import threading
+import Queue
+import signal
+import socket
+import errno
+import traceback
+import hashlib
+from math import isnan, isinf
+from cStringIO import StringIO
+from srtm_tiff3 import srtm_tiff
+from srtm_raw import srtm_raw
 from gpx_parse import GPXParser
-from doPlot import doPlot
+from gpx_enrich import GPXEnricher, enrichGPX
+from xml.parsers import expat
+import bulkcoords
+import accesslog
+from metrics import Registry, Counter, Histogram
+from doPlot import plotRenderer, PLOTDIR, PLOT_URL, PLOT_PROCESSES, PLOT_TIMEOUT
+from staticfiles import staticFiles, sendFile, etagMatches
+from tilecache import tileCache, parseTilePath, TILEDIR, MINELE, MAXELE, \
+     METATILE, TILE_CACHE_BYTES
 
 LOGFILE = '/var/log/eleserver.log'
 PIDFILE = '/var/run/eleserver.pid'
 WDIR = '/home/disk2/OSM/eleserver'
+PORT = 1281
+NUMTHREADS = 8
+KEEPALIVE_TIMEOUT = 5.0   # seconds an idle connection is kept open.
+MAX_REQUESTS = 100        # requests answered on one connection.
+REQUEST_TIMEOUT = 60.0    # seconds a request may stall for.
+
 class Log:
     """file like for writes with auto flush after each write
     to ensure that everything is logged, even during an
@@ -51,9 +103,196 @@ class Log:
         self.f.write(s)
         self.f.flush()
 
+    def flush(self):
+        # multiprocessing flushes sys.stdout and sys.stderr when it forks.
+        self.f.flush()
+
+
+class countingFile:
+    """File like wrapper which counts the bytes written to file f."""
+    def __init__(self, f):
+        self.f = f
+        self.bytes = 0
+
+    def write(self, s):
+        self.bytes += len(s)
+        self.f.write(s)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+class ThreadPoolMixIn(ThreadingMixIn):
+    """Mix-in class to handle requests with a fixed pool of worker threads.
+
+    The listening thread queues each accepted connection, and the next
+    free worker handles it.  The queue holds at most a few connections per
+    worker, so when all the workers are busy the listening thread stops
+    accepting connections until one is free.
+    If numThreads is 0, requests are handled in the listening thread.
+    """
+    numThreads = NUMTHREADS
+    daemon_threads = True
+
+    def startWorkers(self):
+        "Start the worker threads - call once before serve_forever()."
+        self.requestQueue = Queue.Queue(4*max(self.numThreads,1))
+        for i in range(self.numThreads):
+            t = threading.Thread(target = self.worker,
+                                 name = "eleserver-worker-%d" % i)
+            t.daemon = self.daemon_threads
+            t.start()
+
+    def worker(self):
+        "Main loop of a worker thread."
+        while True:
+            (request, client_address) = self.requestQueue.get()
+            self.process_request_thread(request, client_address)
+            self.requestQueue.task_done()
+
+    def finishRequests(self):
+        "Wait until every queued request has been answered."
+        self.requestQueue.join()
+
+    def process_request(self, request, client_address):
+        "Queue the request for the next free worker thread."
+        if self.numThreads > 0:
+            self.requestQueue.put((request, client_address))
+        else:
+            HTTPServer.process_request(self, request, client_address)
+
+
+class eleHTTPServer(ThreadPoolMixIn, HTTPServer):
+    """HTTP server which answers requests with a pool of worker threads,
+    using elevation engine srtm (a srtm_tiff object), which the request
+    handlers find as self.server.srtm.  Requests are recorded in accessLog
+    (an accesslog.AccessLog object) unless it is None, and always in
+    self.metrics (a serverMetrics object).  Plots are drawn by plotter
+    (a doPlot.plotRenderer object) - if it is None, plots are not
+    available.  Files are served by files (a staticfiles.staticFiles
+    object), or from the current directory if it is None.  Map tiles come
+    from tiles (a tilecache.tileCache object) - if it is None, they are
+    not available.
+
+    Connections are kept open for up to maxRequests requests, and closed
+    if the next request has not arrived within keepAliveTimeout seconds
+    (0 to close them after every request).  An idle connection holds on
+    to its worker thread, so keep the timeout short.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, server_address, RequestHandlerClass, srtm,
+                 numThreads=NUMTHREADS, bind_and_activate=True,
+                 accessLog=None, plotter=None, files=None, tiles=None,
+                 keepAliveTimeout=KEEPALIVE_TIMEOUT, maxRequests=MAX_REQUESTS):
+        HTTPServer.__init__(self, server_address, RequestHandlerClass,
+                            bind_and_activate)
+        self.srtm = srtm
+        self.accessLog = accessLog
+        self.plotter = plotter
+        if files is None:
+            files = staticFiles()
+        self.files = files
+        self.tiles = tiles
+        self.metrics = serverMetrics(srtm, files, tiles, plotter)
+        self.keepAliveTimeout = float(keepAliveTimeout)
+        self.maxRequests = int(maxRequests)
+        self.numThreads = int(numThreads)
+        self.startWorkers()
+
 
 class eleServer(BaseHTTPRequestHandler):
-    "Basic Land Elevation Web Server"
+    """Basic Land Elevation Web Server
+
+    Speaks HTTP/1.1, so every reply has a Content-Length or is chunked,
+    and the connection is kept open for the next request (see
+    eleHTTPServer).  Pipelined requests are answered in turn from what is
+    left in rfile.  The reply is buffered and sent when the request has
+    been answered, so the headers do not go out as separate packets.
+    """
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.wfile = countingFile(self.wfile)
+        self.requestCount = 0
+        self.connectionSent = False
+
+    def handle_one_request(self):
+        """Answer one request, then record it in the metrics and the
+        access log."""
+        self.startTime = None
+        # Wait at most the keep-alive timeout for the request to start.
+        self.connection.settimeout(self.server.keepAliveTimeout or REQUEST_TIMEOUT)
+        BaseHTTPRequestHandler.handle_one_request(self)
+        if not self.wfile.closed:
+            self.wfile.flush()
+        if self.startTime is None:
+            return
+        record = accessRecord(self.server.srtm, self.startTime,
+                              self.client_address[0],
+                              self.command, self.requestPath, self.status,
+                              self.requestLength(),
+                              self.wfile.bytes - self.startBytes,
+                              self.headers.getheader('user-agent'))
+        self.server.metrics.record(record)
+        if self.server.accessLog is not None:
+            self.server.accessLog.log(record)
+
+    def requestLength(self):
+        """Return the Content-Length of the request, or 0 if it has none
+        or it is not a number."""
+        try:
+            return int(self.headers.getheader('content-length') or 0)
+        except ValueError:
+            return 0
+
+    def parse_request(self):
+        """Called once the request line has been read - start timing."""
+        self.connection.settimeout(REQUEST_TIMEOUT)
+        self.requestCount += 1
+        self.connectionSent = False
+        self.startTime = time.time()
+        self.startBytes = self.wfile.bytes
+        self.status = None
+        self.server.srtm.startLookupInfo()
+        ok = BaseHTTPRequestHandler.parse_request(self)
+        self.requestPath = self.path
+        if not ok:
+            self.startTime = None
+        return ok
+
+    def log_request(self, code='-', size='-'):
+        """Record the status of the reply for the access log, which
+        replaces the BaseHTTPServer request log."""
+        self.status = code
+
+    def log_error(self, format, *args):
+        # A keep-alive connection timing out between requests is normal.
+        if self.startTime is None and format.startswith('Request timed out'):
+            return
+        BaseHTTPRequestHandler.log_error(self, format, *args)
+
+    def send_header(self, keyword, value):
+        BaseHTTPRequestHandler.send_header(self, keyword, value)
+        if keyword.lower() == 'connection':
+            self.connectionSent = True
+
+    def end_headers(self):
+        """Say whether the connection will be kept open, unless the reply
+        has already said - it is closed after maxRequests requests, or if
+        keep-alive is switched off."""
+        if self.server.keepAliveTimeout <= 0 or \
+           self.requestCount >= self.server.maxRequests:
+            self.close_connection = 1
+        if not self.connectionSent:
+            if self.close_connection:
+                self.send_header('Connection','close')
+            elif self.request_version == 'HTTP/1.0':
+                self.send_header('Connection','keep-alive')
+        BaseHTTPRequestHandler.end_headers(self)
   
     def makeSessionID(self,st):
 	import md5, time, base64
@@ -63,73 +302,120 @@ class eleServer(BaseHTTPRequestHandler):
 	m.update(str(st))
 	return string.replace(base64.encodestring(m.digest())[:-3], '/', '$')
 
-    def return_file(self, filename, contentType='text/HTML'):
-        "Serve a real file from disk (for indexes etc.)"
-        f = open(filename, "r")
-        if(f):
-            self.send_response(200)
-            self.send_header('Content-type',contentType) # TODO: more headers
-            self.end_headers()
-            self.wfile.write(f.read())
-            f.close()
-        else:
-            self.send_response(404)
+    def return_file(self, path, files=None):
+        """Serve the file for URL path from the document root (see
+        staticfiles.py), or from files (a staticFiles object) if it is
+        given - from memory if it is small, otherwise with sendFile() - or
+        a 404 error if there is no such file."""
+        if files is None:
+            files = self.server.files
+        info = files.lookup(path)
+        if info is None:
+            self.sendData(404,'text/html','Error - %s not found' % cgi.escape(path))
+            return
+        try:
+            headers = files.headers(info)
+            if files.notModified(info,self.headers.getheader('if-none-match'),
+                                 self.headers.getheader('if-modified-since')):
+                self.sendData(304,info['ctype'],'',headers)
+            elif info['data'] is not None:
+                self.sendData(200,info['ctype'],info['data'],headers)
+            else:
+                self.send_response(200)
+                self.send_header('Content-type',info['ctype'])
+                self.send_header('Content-Length',str(info['size']))
+                for (name,value) in headers:
+                    self.send_header(name,value)
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.flush()
+                    self.wfile.bytes += sendFile(self.connection,info['file'],
+                                                 info['size'])
+        finally:
+            files.close(info)
 
     def showMessage(self,message):
-        self.send_response(200)
-        self.send_header('Content-type','text/html')
+        self.sendData(200,'text/html',message)
+
+    def sendData(self,code,contentType,data,headers=()):
+        """Send data as the whole reply, with its length, and any extra
+        headers (a list of (name,value) tuples)."""
+        self.send_response(code)
+        self.send_header('Content-type',contentType)
+        if code != 304:
+            self.send_header('Content-Length',str(len(data)))
+        for (name,value) in headers:
+            self.send_header(name,value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def startChunked(self,code,contentType):
+        """Send the headers for a reply whose length is not known yet - the
+        body is then sent with writeChunk() and endChunked().  HTTP/1.0
+        clients do not understand chunked encoding, so the body is sent as
+        it is and the end of the reply is marked by closing the connection.
+        """
+        self.chunked = (self.request_version != 'HTTP/1.0')
+        self.send_response(code)
+        self.send_header('Content-type',contentType)
+        if self.chunked:
+            self.send_header('Transfer-Encoding','chunked')
+        else:
+            self.send_header('Connection','close')
         self.end_headers()
-        self.wfile.write(message)
+
+    def writeChunk(self,data):
+        if not data:
+            return
+        if self.chunked:
+            self.wfile.write('%x\r\n%s\r\n' % (len(data),data))
+        else:
+            self.wfile.write(data)
+        self.wfile.flush()
+
+    def endChunked(self):
+        if self.chunked:
+            self.wfile.write('0\r\n\r\n')
 
     def showUsageError(self):
         "Display an error message in the web browser"
-        self.send_response(200)
-        self.send_header('Content-type','text/html')
-        self.end_headers()
-        self.wfile.write('-1 - ERROR: You must specify both lat=value ' \
-                         'and lon=value as parameters to the GET Request')
+        self.sendData(400,'text/html',USAGE_ERROR)
 
     def do_GET(self):
         "process http GET requests - get elevation of a single (lat,lon) point."
+        if self.path == '/metrics':
+            self.sendData(200,METRICS_TYPE,self.server.metrics.render())
+            return
+        tile = parseTilePath(self.path)
+        if tile is not None:
+            self.sendData(*tileMessage(self.server.srtm,self.server.tiles,tile,
+                                       self.headers.getheader('if-none-match')))
+            return
         # See if any arguments have been passed by checking for a '?' in the URL.
         if self.path.find('?') != -1: 
             (self.path, self.query_string) = self.path.split('?', 1)
-            print "self.query_string=%s." % (self.query_string)
 
             # Separate the arguments into a dictionary of key=value pairs.
             argDict = self.parseGetArgs(self.query_string)
-            if "lat" in argDict:
-                lat = float(argDict["lat"])
-            else:
-                self.showUsageError()
-                return
-            if "lon" in argDict:
-                lon = float(argDict["lon"])
-            else:
+            message = elevationMessage(self.server.srtm,argDict)
+            if message is None:
                 self.showUsageError()
                 return
+            self.sendData(*cachedReply(200,'text/html',message,
+                                       self.headers.getheader('if-none-match')))
 
-            ele = srtm.getElevation(lat,lon)
-            if (ele != -999):
-                if (ele == -32768):
-                    ele = 0
-                message = '%s - Elevation of (lat=%s, lon=%s) is %s m\n' % (ele, lat, lon, ele)
-                self.showMessage(message)
-            else:
-                message = '-1 - ERROR: (lat=%s, lon=%s) is out of range\n' % (lat, lon)
-                self.showMessage(message)
-            print "lat=%f, lon=%f, ele=%f\n" % (lat,lon,ele)
-
+        elif self.path.startswith(PLOT_URL) and self.server.plotter is not None:
+            self.return_file(self.path[len(PLOT_URL)-1:],
+                             self.server.plotter.files)
         else:
-            # if no parameters, return main html page.
-            if self.path=='/':
-                self.return_file('eleserver.html')
-                return
-            else:
-                (lhs,rhs) = self.path.split("/",1)
-                print "Returning File %s - cwd=%s" % (rhs, os.getcwd());
-                self.return_file(rhs)
+            # if no parameters, return a file - '/' is the main html page.
+            self.return_file(self.path)
         
+    def do_HEAD(self):
+        "process http HEAD requests - the same as GET, without the body."
+        self.do_GET()
+
 ######################################################################
 
     def do_POST(self):
@@ -138,46 +424,115 @@ class eleServer(BaseHTTPRequestHandler):
         Accepts a file uploaded via a POST request, and parses it as a
         GPX file containing route points.
         Returns a table of the route point locations and elevations
+
+        A POST to /elevations is a bulk elevation request instead - see
+        bulkMessage().
         
         """
-        print "sessionID = %s " % self.makeSessionID('test');
-        global rootnode
-        print "do_POST()"
+        (path, query_string) = (self.path.split('?', 1) + [''])[:2]
+        if path == '/elevations':
+            self.doBulkElevations(query_string)
+            return
+        if path == '/gpx':
+            self.doEnrichGPX(query_string)
+            return
         try:
             ctype, pdict = cgi.parse_header(  \
-                           self.headers.getheader('content-type'))
+                           self.headers.getheader('content-type') or '')
+            length = self.getContentLength(MAX_BULK_SIZE)
+            if length is None:
+                return
+            # Read exactly the body, so that the next request on the
+            # connection is left for handle_one_request().
+            data = self.rfile.read(length)
             if ctype == 'multipart/form-data':
-                print "multipart/form-data"
-                query=cgi.parse_multipart(self.rfile, pdict)
+                query=cgi.parse_multipart(StringIO(data), pdict)
 #                self.send_response(301)
 #                self.end_headers()
-                if query.has_key('GPXFile'):
-                    upfilecontent = query.get('GPXFile')
-                    parser = GPXParser(upfilecontent[0])
-                    points = parser.getRoute('route')
-                    if query.has_key('Plot'):
-                        fname = 'doPlot.png'
-                        doPlot(srtm,points,fname);
-                        #self.return_file(fname)
-                        msg = '<a href=\"%s\">%s<\a>' % \
-                                         (fname,fname)
-                        self.showMessage(msg)
-                        print msg
-                        
-                    else:
-                        for pt in points:
-                            linestr = "Point=%s (%s,%s) - Ele=%s<br>" % \
-                                      (pt[2],pt[0],pt[1],srtm.getElevation(pt[0],pt[1]))
-                            print linestr
-                            self.wfile.write(linestr)
-                else:
-                    self.wfile.write("Error - No data labelled GPXFile provided")
+                self.showMessage(gpxMessage(self.server.srtm,query,
+                                            self.server.plotter))
             else:
-                print "ctype = %s, but I need multipart/form-data" % ctype
+                self.sendData(415,'text/html',
+                              'Error - %s, but I need multipart/form-data' %
+                              cgi.escape(ctype))
         except :
             print "do_Post() - ERROR!!! ", sys.exc_info()[0]
             raise
 
+    def getContentLength(self,maxLength):
+        """Return the length of the request body, or None (having sent an
+        error reply) if it is missing, invalid or more than maxLength.
+        The body is not read after an error, so the connection is closed.
+        """
+        length = self.headers.getheader('content-length')
+        if length is None:
+            self.close_connection = 1
+            self.sendData(411,'text/plain','Error - Content-Length required\n')
+            return None
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = 1
+            self.sendData(400,'text/plain','Error - invalid Content-Length\n')
+            return None
+        if maxLength is not None and length > maxLength:
+            self.close_connection = 1
+            self.sendData(413,'text/plain','Error - request too large\n')
+            return None
+        return length
+
+    def doBulkElevations(self,query_string):
+        "Answer a POST /elevations request for the elevations of many points."
+        length = self.getContentLength(MAX_BULK_SIZE)
+        if length is None:
+            return
+        data = self.rfile.read(length)
+        (code, ctype, body) = bulkMessage(self.server.srtm,
+                                          parseGetArgs(query_string),
+                                          self.headers.getheader('content-type'),
+                                          data)
+        self.sendData(code, ctype, body)
+
+    def doEnrichGPX(self,query_string):
+        """Answer a POST /gpx request - send back the GPX file in the request
+        body with the elevations filled in, as it is read.  Nothing is sent
+        until the first chunk of points has been looked up, so if the file
+        is not valid XML near the start the reply is a 400 error; after
+        that the reply is cut short instead.
+        """
+        length = self.getContentLength(None)
+        if length is None:
+            return
+        started = []
+        def write(data):
+            if not started:
+                self.startChunked(200,'application/gpx+xml')
+                started.append(True)
+            self.writeChunk(data)
+        enricher = GPXEnricher(self.server.srtm, write,
+                               boolArg(parseGetArgs(query_string),'bilinear'))
+        try:
+            while length > 0:
+                data = self.rfile.read(min(length,GPX_READ_SIZE))
+                if not data:
+                    break
+                length -= len(data)
+                enricher.feed(data)
+            enricher.close()
+        except expat.ExpatError, e:
+            print "doEnrichGPX - invalid GPX - %s" % e
+            # The rest of the body has not been read, and the reply may
+            # have been cut short, so the connection can not be used again.
+            self.close_connection = 1
+            if not started:
+                self.sendData(400,'text/plain','Error - invalid GPX: %s\n' % e)
+            return
+        if not started:
+            write('')
+        self.endChunked()
+
   ##############################################################################  # NAME: parseGetArgs(queryString)
         # DESC: queryString should be a series of key=value pairs, separated by '&'
   #       characters (as per http GET requests).
@@ -187,48 +542,589 @@ class eleServer(BaseHTTPRequestHandler):
   #
     def parseGetArgs(self,queryString):
         'Parse a HTTP GET Query String into a dictionary of key, value pairs'
-        argList = {}
-        qs = queryString
-        #    print "parseGetArgs: qs=%s" % (qs)
-        while (len(qs)>0):
-            if qs.find('&') != -1:
-                (kvp,rhs) = qs.split('&',1)
-                qs = rhs
+        return parseGetArgs(queryString)
+
+
+
+
+
+############################################################################
+# The functions below do the work of answering requests, and are shared
+# with the other front ends (eleserver_async.py).
+
+USAGE_ERROR = '-1 - ERROR: You must specify both lat=value ' \
+              'and lon=value as parameters to the GET Request'
+
+MAX_BULK_SIZE = 64*1024*1024   # bytes of coordinates in a bulk request.
+GPX_READ_SIZE = 65536          # bytes of a GPX upload read at a time.
+METRICS_TYPE = 'text/plain; version=0.0.4'
+POINT_CACHE = 100000           # single point results cached.
+CACHE_MAX_AGE = 86400          # seconds clients may cache a result for.
+
+def parseGetArgs(queryString):
+    'Parse a HTTP GET Query String into a dictionary of key, value pairs'
+    argList = {}
+    qs = queryString
+    #    print "parseGetArgs: qs=%s" % (qs)
+    while (len(qs)>0):
+        if qs.find('&') != -1:
+            (kvp,rhs) = qs.split('&',1)
+            qs = rhs
+        else:
+            kvp = qs
+            qs=''
+        if kvp.find('=') != -1:
+            (key,val) = kvp.split('=',1)
+            argList[key]=val
+        else:
+            print "parseGetArgs Error - key but no = sign? %s" % queryString
+    return argList
+
+
+def boolArg(argDict,key):
+    "Return True if GET argument key is set to anything except 0 or false."
+    return argDict.get(key,'0').lower() not in ('','0','false')
+
+
+def elevationMessage(srtm,argDict):
+    """Return the reply to a GET request for the elevation of point
+    (argDict['lat'],argDict['lon']), or None if either is missing or is
+    not a (finite) number.
+    """
+    try:
+        lat = float(argDict["lat"])
+        lon = float(argDict["lon"])
+    except (KeyError, ValueError):
+        return None
+    if isnan(lat) or isnan(lon) or isinf(lat) or isinf(lon):
+        return None
+
+    ele = srtm.getElevation(lat,lon)
+    if (ele != -999):
+        if (ele == -32768):
+            ele = 0
+        message = '%s - Elevation of (lat=%s, lon=%s) is %s m\n' % (ele, lat, lon, ele)
+    else:
+        message = '-1 - ERROR: (lat=%s, lon=%s) is out of range\n' % (lat, lon)
+    return message
+
+
+def cachedReply(code,contentType,body,ifNoneMatch=None):
+    """Return the reply (code, content type, body, headers) for body,
+    with the headers that let clients and proxies cache it - its ETag (a
+    hash of body) and a Cache-Control max-age of CACHE_MAX_AGE.  If
+    ifNoneMatch (the If-None-Match request header) has the ETag, the client
+    already has body, so the reply is 304 Not Modified with no body.
+    """
+    etag = '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+    headers = [('Cache-Control','public, max-age=%d' % CACHE_MAX_AGE),
+               ('ETag',etag)]
+    if etagMatches(etag, ifNoneMatch):
+        return (304, contentType, '', headers)
+    return (code, contentType, body, headers)
+
+
+def tileMessage(srtm,tiles,tile,ifNoneMatch=None):
+    """Return the reply (code, content type, body, headers) to a request
+    for map tile tile (layer,z,x,y), from tiles (a tilecache.tileCache
+    object, or None if there are no map tiles), rendering it with srtm if
+    need be.
+    """
+    if tiles is None:
+        return (404, 'text/html', 'Error - map tiles are not available', [])
+    (layer,z,x,y) = tile
+    png = tiles.getTile(srtm,z,x,y,layer)
+    if png is None:
+        return (404, 'text/html', 'Error - there is no %s tile %d/%d/%d' % tile, [])
+    return cachedReply(200,'image/png',png,ifNoneMatch)
+
+
+def bulkMessage(srtm,argDict,contentType,data):
+    """Return the reply to a bulk elevation request (POST /elevations) as
+    a tuple (code, content type, body).  data is the request body, which
+    contains the points in the format given by contentType (see
+    bulkcoords.py), and the elevations are returned in the same format.
+    The points are looked up together with srtm.getElevations(), using
+    bilinear interpolation if argDict['bilinear'] is set.
+    """
+    (ctype, pdict) = cgi.parse_header(contentType or '')
+    fmt = bulkcoords.getFormat(ctype)
+    if fmt is None:
+        return (415, 'text/plain',
+                'Error - Content-Type must be one of %s\n' %
+                ', '.join(sorted(bulkcoords.FORMATS.keys())))
+    try:
+        (lats, lons) = bulkcoords.decodeCoords(fmt, data)
+    except (ValueError, KeyError, TypeError, IndexError), e:
+        return (400, 'text/plain', 'Error - invalid %s data: %s\n' % (fmt, e))
+    (eles, outside) = srtm.getElevations(lats, lons, boolArg(argDict, 'bilinear'))
+    eles[eles == -32768] = 0
+    return (200, bulkcoords.CONTENT_TYPES[fmt],
+            bulkcoords.encodeElevations(fmt, lats, lons, eles, outside))
+
+
+def gpxEnrichMessage(srtm,argDict,data):
+    """Return the reply to a POST /gpx request as a tuple (code, content
+    type, body) - for front ends which cannot stream the reply."""
+    try:
+        return (200, 'application/gpx+xml',
+                enrichGPX(srtm, data, boolArg(argDict, 'bilinear')))
+    except expat.ExpatError, e:
+        return (400, 'text/plain', 'Error - invalid GPX: %s\n' % e)
+
+
+def gpxMessage(srtm,query,plotter=None):
+    """Return the reply to a POST request of a GPX file - query is the
+    dictionary of form fields returned by cgi.parse_multipart().
+    Lists the route points and their elevations, or plots them with
+    plotter (a doPlot.plotRenderer object) if the Plot field is set.
+    """
+    if not query.has_key('GPXFile'):
+        return "Error - No data labelled GPXFile provided"
+    upfilecontent = query.get('GPXFile')
+    parser = GPXParser(upfilecontent[0])
+    points = parser.getRoute('route')
+    if query.has_key('Plot'):
+        if plotter is None:
+            return "Error - plotting is not available"
+        fname = plotter.getPlot(srtm,points)
+        if fname is None:
+            return "The plot is taking a long time to draw - please try again in a minute"
+        url = plotter.plotURL(fname)
+        msg = '<a href=\"%s\">%s</a>' % (url,url)
+        return msg
+    else:
+        lines = []
+        for pt in points:
+            linestr = "Point=%s (%s,%s) - Ele=%s<br>" % \
+                      (pt[2],pt[0],pt[1],srtm.getElevation(pt[0],pt[1]))
+            lines.append(linestr)
+        # The point names from the GPX file are unicode.
+        return u''.join(lines).encode('utf-8')
+
+
+def logText(value):
+    """Return string value from a request as unicode, with any bytes
+    which are not UTF-8 replaced, so that it can be written as JSON."""
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def accessRecord(srtm, startTime, client, method, path, status,
+                 bytesIn, bytesOut, userAgent=None):
+    """Return the access log record (a dictionary) for a request which
+    started at startTime, and was answered by the calling thread using
+    srtm - the tile used and the cache hits and misses are taken from
+    srtm.getLookupInfo().
+    """
+    record = {'time':round(startTime,3), 'client':client,
+              'method':logText(method), 'path':logText(path),
+              'status':status, 'in':bytesIn, 'out':bytesOut,
+              'ms':round(1000*(time.time()-startTime),2)}
+    if userAgent:
+        record['agent'] = logText(userAgent)
+    info = srtm.getLookupInfo()
+    if info is not None and info['points'] > 0:
+        record['points'] = info['points']
+        if info['tile'] is not None:
+            record['tile'] = os.path.basename(info['tile'])
+            if info['tilemisses'] > 0:
+                record['tilecache'] = 'miss'
             else:
-                kvp = qs
-                qs=''
-            if kvp.find('=') != -1:
-                (key,val) = kvp.split('=',1)
-                argList[key]=val
+                record['tilecache'] = 'hit'
+        if info['blockhits'] + info['blockmisses'] > 0:
+            record['blockhits'] = info['blockhits']
+            record['blockmisses'] = info['blockmisses']
+    return record
+
+
+def endpointName(method, path):
+    "Return the name of the endpoint which answers request (method, path)."
+    (path, query) = ((path or '').split('?', 1) + [None])[:2]
+    if method == 'POST':
+        return {'/elevations':'bulk', '/gpx':'gpx'}.get(path, 'gpxform')
+    if path.startswith('/tiles/'):
+        return 'tile'
+    if path.startswith(PLOT_URL):
+        return 'plot'
+    if query is not None:
+        return 'elevation'
+    if path == '/metrics':
+        return 'metrics'
+    return 'file'
+
+
+class serverMetrics:
+    """The metrics recorded by a server using elevation engine srtm - the
+    number of requests, their latency, the bytes received and sent and
+    the points looked up by each endpoint, plus the engine's tile read
+    times and cache statistics, and those of the static file cache of
+    files (a staticfiles.staticFiles object), the map tile cache of
+    tiles (a tilecache.tileCache object) and the plot cache of plotter (a
+    doPlot.plotRenderer object) if they are given.  render()
+    returns them in the Prometheus text format, for GET /metrics.
+
+    Each process keeps its own metrics, so with pre-fork workers a request
+    for /metrics gets the figures of whichever worker answers it.
+    """
+    def __init__(self, srtm, files=None, tiles=None, plotter=None):
+        self.srtm = srtm
+        self.files = files
+        self.tiles = tiles
+        self.plotter = plotter
+        self.registry = Registry()
+        self.requests = self.registry.add(Counter(
+            'eleserver_requests_total', 'Requests answered',
+            ('endpoint','status')))
+        self.latency = self.registry.add(Histogram(
+            'eleserver_request_seconds', 'Time taken to answer requests',
+            labels=('endpoint',)))
+        self.bytesIn = self.registry.add(Counter(
+            'eleserver_received_bytes_total', 'Bytes of request bodies received',
+            ('endpoint',)))
+        self.bytesOut = self.registry.add(Counter(
+            'eleserver_sent_bytes_total', 'Bytes of replies sent',
+            ('endpoint',)))
+        self.points = self.registry.add(Counter(
+            'eleserver_points_total',
+            'Points looked up (GPX points processed for the gpx endpoints)',
+            ('endpoint',)))
+        self.registry.add(srtm.readTimes)
+        self.registry.addCollector(self.cacheMetrics)
+
+    def record(self, record):
+        "Record a request, described by its access log record."
+        endpoint = (endpointName(record['method'], record['path']),)
+        self.requests.inc((endpoint[0], record['status']))
+        self.latency.observe(record['ms']/1000.0, endpoint)
+        self.bytesIn.inc(endpoint, record['in'])
+        self.bytesOut.inc(endpoint, record['out'])
+        if 'points' in record:
+            self.points.inc(endpoint, record['points'])
+
+    def cacheMetrics(self):
+        "Collector for the srtm tile and block cache statistics."
+        stats = self.srtm.getCacheStats()
+        if self.files is not None:
+            stats['files'] = self.files.getStats()
+        if self.tiles is not None:
+            stats['maptiles'] = self.tiles.getStats()
+        metrics = []
+        for (key, kind, help) in (
+            ('items', 'gauge', 'Items in the cache'),
+            ('bytes', 'gauge', 'Size of the items in the cache'),
+            ('hits', 'counter', 'Cache hits'),
+            ('misses', 'counter', 'Cache misses'),
+            ('evictions', 'counter', 'Items evicted from the cache'),
+            ('hitratio', 'gauge', 'Fraction of lookups which were hits')):
+            if kind == 'counter':
+                name = 'srtm_cache_%s_total' % key
             else:
-                print "parseGetArgs Error - key but no = sign? %s" % queryString
-        return argList
-    #return argList
+                name = 'srtm_cache_%s' % key
+            metrics.append((name, kind, help,
+                            [({'cache':cache}, stats[cache][key])
+                             for cache in sorted(stats.keys())]))
+        metrics.append(('srtm_tile_opens_total', 'counter',
+                        'Tile files opened (tile cache misses)',
+                        [({}, stats['tiles']['misses'])]))
+        if self.tiles is not None:
+            for (key, name, help) in (
+                ('diskhits', 'eleserver_map_tile_disk_reads_total',
+                 'Map tiles read from the disk cache'),
+                ('rendered', 'eleserver_metatiles_rendered_total',
+                 'Metatiles rendered'),
+                ('coalesced', 'eleserver_map_tile_waits_total',
+                 'Map tile requests which waited for a metatile being rendered')):
+                metrics.append((name, 'counter', help,
+                                [({}, stats['maptiles'][key])]))
+        if self.plotter is not None:
+            plots = self.plotter.getStats()
+            for (key, name, kind, help) in (
+                ('hits', 'eleserver_plot_cache_hits_total', 'counter',
+                 'Plots served from the plot cache'),
+                ('misses', 'eleserver_plot_cache_misses_total', 'counter',
+                 'Plots which had to be drawn'),
+                ('timeouts', 'eleserver_plot_timeouts_total', 'counter',
+                 'Plot requests which gave up waiting for the plot'),
+                ('drawing', 'eleserver_plots_drawing', 'gauge',
+                 'Plots being drawn')):
+                metrics.append((name, kind, help, [({}, plots[key])]))
+        return metrics
 
+    def render(self):
+        return self.registry.render()
 
 
+def makeEngine(options):
+    """Create the elevation engine (a srtm_tiff object) to use, as selected
+    by the command line options.
+    """
+    if options.raw:
+        srtm = srtm_raw(options.filename,options.maxfiles,False,False)
+    else:
+        srtm = srtm_tiff(options.filename,options.maxfiles,False,False)
+    srtm.setPointCache(options.pointcache)
+    return srtm
 
 
-############################################################################
+def makePlotter(options):
+    """Create the plot renderer selected by the command line options."""
+    return plotRenderer(options.plotdir, options.plotprocs,
+                        options.plottimeout)
+
+
+def makeTiles(options):
+    """Create the map tile cache selected by the command line options."""
+    return tileCache(options.tiledir, options.minele, options.maxele,
+                     options.metatile, options.tilecache)
+
+
+def makeListenSocket(options):
+    """Create the socket the server listens on.  With options.reuseport
+    it is marked SO_REUSEPORT, so that several processes can each have
+    their own listening socket on the same port, and the kernel shares
+    the connections between them.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if options.reuseport:
+        # Python 2 does not define SO_REUSEPORT - 15 is the Linux value.
+        sock.setsockopt(socket.SOL_SOCKET,
+                        getattr(socket, 'SO_REUSEPORT', 15), 1)
+    sock.bind(('', int(options.port)))
+    sock.listen(eleHTTPServer.request_queue_size)
+    return sock
+
+
+def runServer(options, listenSocket, isWorker=False, accessLogFd=None):
+    """Load the elevation data and answer requests on listenSocket until
+    told to stop with SIGTERM (or SIGINT, unless this is a pre-fork
+    worker, in which case the master deals with SIGINT), then finish the
+    requests already accepted before returning.  accessLogFd is the access
+    log file, opened before the server gave up root (see main()).
+    """
+    srtm = makeEngine(options)
+    # The plot processes are forked now, before there are any threads.
+    plotter = makePlotter(options)
+    server = eleHTTPServer(('',int(options.port)), eleServer, srtm,
+                           options.threads, bind_and_activate=False,
+                           accessLog=accesslog.makeAccessLog(options, accessLogFd),
+                           plotter=plotter,
+                           files=staticFiles(options.docroot),
+                           tiles=makeTiles(options),
+                           keepAliveTimeout=options.keepalive,
+                           maxRequests=options.maxrequests)
+    server.socket.close()
+    server.socket = listenSocket
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it must not
+        # be called from the thread running serve_forever().
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    if isWorker:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    else:
+        signal.signal(signal.SIGINT, stop)
+
+    print "Process %d starting web server with %s worker threads. Open http://localhost:%s to access EleServer." % \
+        (os.getpid(), options.threads, options.port)
+    server.serve_forever()
+    print "Process %d stopping - finishing requests" % os.getpid()
+    server.finishRequests()
+    server.socket.close()
+    if server.accessLog is not None:
+        server.accessLog.close()
+    plotter.close()
 
-def main():
-    os.chdir(WDIR)
-    sys.stdout = sys.stderr = Log(open(LOGFILE, 'a+'))
-    os.setegid(103)
-    os.seteuid(103)
+
+class preforkMaster:
+    """Runs options.workers worker processes which all answer requests on
+    the same port, restarting any that die.
+
+    Either the master creates the listening socket and the workers inherit
+    it, or (with options.reuseport) each worker creates its own
+    SO_REUSEPORT socket.  Each worker loads its own elevation engine after
+    the fork, as GDAL handles cannot be shared between processes - using
+    raw tiles (--raw) means the workers share the tile data through the
+    page cache rather than each having its own copy.
+
+    SIGTERM or SIGINT to the master stops the workers gracefully, waits for
+    them, and removes the PID file.
+    """
+    RestartDelay = 1.0   # seconds to wait before restarting a worker
+                         # which died straight after it was started.
+
+    def __init__(self, options, accessLogFd=None):
+        self.options = options
+        self.accessLogFd = accessLogFd
+        self.workers = {}      # pid -> time started.
+        self.stopping = False
+        if options.reuseport:
+            self.listenSocket = None
+        else:
+            self.listenSocket = makeListenSocket(options)
+
+    def startWorker(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                listenSocket = self.listenSocket
+                if listenSocket is None:
+                    listenSocket = makeListenSocket(self.options)
+                runServer(self.options, listenSocket, True, self.accessLogFd)
+            except:
+                traceback.print_exc()
+                status = 1
+            os._exit(status)
+        print "Started worker process %d" % pid
+        self.workers[pid] = time.time()
+
+    def stop(self, signum, frame):
+        print "Master process received signal %d - stopping workers" % signum
+        self.stopping = True
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print "Master process %d starting %d workers" % \
+            (os.getpid(), self.options.workers)
+        for i in range(self.options.workers):
+            self.startWorker()
+        while self.workers:
+            try:
+                (pid, status) = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+            if not self.stopping:
+                print "Worker process %d died (status %d) - restarting" % \
+                    (pid, status)
+                if time.time() - started < self.RestartDelay:
+                    time.sleep(self.RestartDelay)
+                self.startWorker()
+        print "Master process %d - all workers stopped" % os.getpid()
+        # the pid file was written as root before the privilege drop, so
+        # removing it may well fail now
+        try:
+            if self.options.pidfile and \
+               os.path.isfile(self.options.pidfile) and \
+               open(self.options.pidfile).read().strip() == str(os.getpid()):
+                os.remove(self.options.pidfile)
+        except (IOError, OSError), e:
+            print "Could not remove pid file %s: %s" % \
+                (self.options.pidfile, e)
+
+
+def main(options):
+    os.chdir(options.wdir)
+    sys.stdout = sys.stderr = Log(open(options.logfile, 'a+'))
+    # Like the log file, the access log may be somewhere only root can
+    # open it.
+    accessLogFd = accesslog.openAccessLog(options)
+    if os.geteuid() == 0:
+        os.setegid(103)
+        os.seteuid(103)
     print "eleserver.main() - cwd=%s" % (os.getcwd())
-    
-    try:
-        server = HTTPServer(('',1281), eleServer)
-        global srtm
-        srtm=srtm_tiff()
-        print "Starting web server. Open http://localhost:1281 to access EleServer."
-        server.serve_forever()
-    except KeyboardInterrupt:
-        server.socket.close()
-        sys.exit()
+
+    if options.workers > 0:
+        preforkMaster(options, accessLogFd).run()
+    else:
+        runServer(options, makeListenSocket(options), False, accessLogFd)
 
 if __name__ == "__main__":
+    parser = OptionParser()
+    usage = "eleserver [options]"
+    parser.add_option("-f", "--file", dest="filename",
+                      help="name of file containing list of srtm data files",
+                      metavar="FILE")
+    parser.add_option("-p", "--port", dest="port",
+                      help="port to listen on")
+    parser.add_option("-t", "--threads", dest="threads",
+                      help="number of worker threads (0 to handle requests one at a time)")
+    parser.add_option("--workers", dest="workers",
+                      help="number of worker processes (0 to run in a single process)")
+    parser.add_option("--reuseport", action="store_true", dest="reuseport",
+                      help="each worker process listens with its own SO_REUSEPORT socket")
+    parser.add_option("--raw", action="store_true", dest="raw",
+                      help="use memory mapped raw tiles (see srtm_raw.py)")
+    parser.add_option("--maxfiles", dest="maxfiles",
+                      help="maximum number of open tile files per thread")
+    parser.add_option("--keepalive", dest="keepalive",
+                      help="seconds an idle connection is kept open (0 to close after each request)")
+    parser.add_option("--maxrequests", dest="maxrequests",
+                      help="maximum number of requests answered on one connection")
+    parser.add_option("--docroot", dest="docroot",
+                      help="directory of the files served (default the working directory)")
+    parser.add_option("--pointcache", dest="pointcache",
+                      help="number of single point results to cache (0 for none)")
+    parser.add_option("--plotdir", dest="plotdir",
+                      help="directory where plots are cached")
+    parser.add_option("--plotprocs", dest="plotprocs",
+                      help="number of processes drawing plots (per worker process, 0 to draw them in the request thread)")
+    parser.add_option("--plottimeout", dest="plottimeout",
+                      help="seconds to wait for a plot before replying")
+    parser.add_option("--tiledir", dest="tiledir",
+                      help="directory where map tiles are cached")
+    parser.add_option("--minele", dest="minele",
+                      help="elevation (m) of the lightest green in map tiles")
+    parser.add_option("--maxele", dest="maxele",
+                      help="elevation (m) of the darkest green in map tiles")
+    parser.add_option("--metatile", dest="metatile",
+                      help="map tiles rendered at once in each direction")
+    parser.add_option("--tilecache", dest="tilecache",
+                      help="bytes of map tiles kept in memory")
+    parser.add_option("-w", "--wdir", dest="wdir",
+                      help="working directory")
+    parser.add_option("-l", "--logfile", dest="logfile",
+                      help="log file")
+    parser.add_option("--pidfile", dest="pidfile",
+                      help="file to write the process id of the (master) server to")
+    parser.add_option("--foreground", action="store_true", dest="foreground",
+                      help="do not run as a daemon")
+    accesslog.addOptions(parser)
+    parser.set_defaults(filename="srtm_tiff.txt",
+                        port=PORT,
+                        threads=NUMTHREADS,
+                        workers=0,
+                        reuseport=False,
+                        raw=False,
+                        maxfiles="10",
+                        keepalive=KEEPALIVE_TIMEOUT,
+                        maxrequests=MAX_REQUESTS,
+                        docroot=".",
+                        pointcache=POINT_CACHE,
+                        plotdir=PLOTDIR,
+                        plotprocs=PLOT_PROCESSES,
+                        plottimeout=PLOT_TIMEOUT,
+                        tiledir=TILEDIR,
+                        minele=MINELE,
+                        maxele=MAXELE,
+                        metatile=METATILE,
+                        tilecache=TILE_CACHE_BYTES,
+                        wdir=WDIR,
+                        logfile=LOGFILE,
+                        pidfile=PIDFILE,
+                        foreground=False)
+    (options,args)=parser.parse_args()
+    options.threads = int(options.threads)
+    options.workers = int(options.workers)
+
+    if options.foreground:
+        main(options)
+        sys.exit(0)
+
     # do the UNIX double-fork magic, see Stevens' "Advanced
     # Programming in the UNIX Environment" for details (ISBN 0201563177)
     try:
@@ -251,13 +1147,13 @@ if __name__ == "__main__":
         if pid > 0:
             # exit from second parent, print eventual PID before
             #print "Daemon PID %d" % pid
-            open(PIDFILE,'w').write("%d"%pid)
+            open(options.pidfile,'w').write("%d"%pid)
             sys.exit(0)
     except OSError, e:
         print >>sys.stderr, "fork #2 failed: %d (%s)" % (e.errno, e.strerror)
         sys.exit(1)
 
     # start the daemon main loop
-    main()
+    main(options)
 
 
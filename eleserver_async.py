@@ -0,0 +1,458 @@
+#!/usr/bin/python
+#----------------------------------------------------------------------------
+# Elevation data server - asynchronous front end
+#
+# Features:
+#   * Answers the same GET (lat=,lon=), POST (GPXFile), POST /elevations
+#     and POST /gpx requests as eleserver.py, using the same code to produce the replies.
+#   * All of the connections are handled by one thread using asyncore,
+#     so an idle client costs a socket rather than a thread - suitable
+#     for large numbers of phones polling for their elevation.
+#   * HTTP/1.1 persistent connections (keep-alive), with pipelined requests
+#     answered in order, and idle connections closed after a timeout.
+#   * Elevation lookups and GPX processing are done by a pool of worker
+#     threads, so the event loop never waits for them.
+#   * Requests are recorded in the same JSON lines access log and
+#     /metrics statistics as eleserver.py (see accesslog.py).
+#   * Serves the same map tiles (GET /tiles/{z}/{x}/{y}.png) as
+#     eleserver.py, rendered in the worker threads (see tilecache.py).
+#
+# To run it do:
+#   python ./eleserver_async.py -f srtm_tiff.txt -p 1281
+# python ./eleserver_async.py -h gives more information on arguments.
+#----------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+import asyncore, asynchat
+import socket
+import sys
+import os
+import time
+import cgi
+import mimetools
+import threading
+import Queue
+from cStringIO import StringIO
+from collections import deque
+from optparse import OptionParser
+from BaseHTTPServer import BaseHTTPRequestHandler
+import accesslog
+from eleserver import parseGetArgs, elevationMessage, gpxMessage, bulkMessage, \
+     gpxEnrichMessage, tileMessage, accessRecord, serverMetrics, METRICS_TYPE, \
+     makeEngine, makePlotter, makeTiles, cachedReply, POINT_CACHE, USAGE_ERROR, Log, LOGFILE, WDIR, PORT, NUMTHREADS
+from doPlot import PLOTDIR, PLOT_URL, PLOT_PROCESSES, PLOT_TIMEOUT
+from staticfiles import staticFiles
+from tilecache import parseTilePath, TILEDIR, MINELE, MAXELE, METATILE, \
+     TILE_CACHE_BYTES
+
+IDLE_TIMEOUT = 60          # seconds before an idle connection is closed.
+MAX_HEADER_SIZE = 65536    # bytes of request line and headers allowed.
+MAX_BODY_SIZE = 64*1024*1024
+
+class trigger(asyncore.file_dispatcher):
+    """Wakes up the event loop from another thread.
+
+    pull() writes a byte to a pipe which the event loop is watching, and
+    the event loop then calls callback().
+    """
+    def __init__(self, callback):
+        (r, w) = os.pipe()
+        asyncore.file_dispatcher.__init__(self, r)
+        os.close(r)   # file_dispatcher keeps its own copy.
+        self.w = w
+        self.callback = callback
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def pull(self):
+        os.write(self.w, 'x')
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except (OSError, socket.error):
+            pass
+        self.callback()
+
+
+class eleChannel(asynchat.async_chat):
+    """One client connection.
+
+    Requests are read by the event loop, and put in self.pending.  They
+    are passed to the worker threads one at a time, so the replies to
+    pipelined requests go back in the order the requests were made.
+    """
+    def __init__(self, server, sock, addr):
+        asynchat.async_chat.__init__(self, sock)
+        self.server = server
+        self.addr = addr
+        self.ibuffer = []
+        self.ibufferSize = 0
+        self.request = None      # request whose body is being read.
+        self.pending = deque()   # requests read but not started yet.
+        self.busy = False        # a worker is answering a request.
+        self.closing = False     # no more requests will be read.
+        self.lastActivity = time.time()
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self.ibuffer.append(data)
+        self.ibufferSize += len(data)
+        self.lastActivity = time.time()
+        if self.request is None and self.ibufferSize > MAX_HEADER_SIZE:
+            self.ibuffer = []
+            self.ibufferSize = 0
+            self.addRequest({'error':400, 'keepalive':False})
+
+    def found_terminator(self):
+        data = ''.join(self.ibuffer)
+        self.ibuffer = []
+        self.ibufferSize = 0
+        if self.request is None:
+            request = self.parseRequest(data.lstrip('\r\n'))
+            if request is None:
+                # Blank lines between requests.
+                return
+            length = request.get('length',0)
+            if length > 0:
+                self.request = request
+                self.set_terminator(length)
+                return
+            request['body'] = ''
+        else:
+            request = self.request
+            request['body'] = data
+            self.request = None
+            self.set_terminator('\r\n\r\n')
+        self.addRequest(request)
+
+    def parseRequest(self, data):
+        """Parse the request line and headers in data, and return a
+        dictionary describing the request (or an error), or None if
+        data is empty.
+        """
+        if data == '':
+            return None
+        (requestline, rest) = (data.split('\r\n',1) + [''])[:2]
+        words = requestline.split()
+        if len(words) != 3 or not words[2].startswith('HTTP/'):
+            return {'error':400, 'keepalive':False}
+        (method, path, version) = words
+        headers = mimetools.Message(StringIO(rest + '\r\n\r\n'))
+        connection = (headers.getheader('connection') or '').lower()
+        if version == 'HTTP/1.0':
+            keepalive = (connection == 'keep-alive')
+        else:
+            keepalive = (connection != 'close')
+        request = {'method':method, 'path':path, 'version':version,
+                   'headers':headers, 'keepalive':keepalive}
+        try:
+            request['length'] = int(headers.getheader('content-length') or 0)
+        except ValueError:
+            return {'error':400, 'keepalive':False}
+        if request['length'] > MAX_BODY_SIZE:
+            return {'error':413, 'keepalive':False}
+        if request['length'] < 0:
+            return {'error':400, 'keepalive':False}
+        return request
+
+    def addRequest(self, request):
+        self.pending.append(request)
+        if not request['keepalive']:
+            self.closing = True
+        self.startNext()
+
+    def readable(self):
+        return not self.closing and asynchat.async_chat.readable(self)
+
+    def startNext(self):
+        "Pass the next pending request to the workers, if we are not busy."
+        if not self.busy and self.pending:
+            self.busy = True
+            self.server.jobs.put((self, self.pending.popleft()))
+
+    def sendResponse(self, request, response):
+        "Send the reply to request - called in the event loop thread."
+        self.busy = False
+        self.lastActivity = time.time()
+        if not self.connected:
+            return
+        (code, ctype, body) = response[:3]
+        keepalive = request['keepalive']
+        headers = ['HTTP/1.1 %d %s' % (code, BaseHTTPRequestHandler.responses[code][0]),
+                   'Server: eleserver_async',
+                   'Date: %s' % time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime()),
+                   'Content-Type: %s' % ctype]
+        if code != 304:
+            headers.append('Content-Length: %d' % len(body))
+        if len(response) > 3:
+            headers.extend(['%s: %s' % header for header in response[3]])
+        if keepalive:
+            headers.append('Connection: keep-alive')
+        else:
+            headers.append('Connection: close')
+        if request.get('method') == 'HEAD':
+            body = ''
+        self.push('\r\n'.join(headers) + '\r\n\r\n' + body)
+        if keepalive:
+            self.startNext()
+        else:
+            self.pending.clear()
+            self.close_when_done()
+
+    def isIdle(self, now):
+        "True if the connection has been doing nothing for too long."
+        return not self.busy and not self.pending and \
+               not self.producer_fifo and \
+               now - self.lastActivity > self.server.idleTimeout
+
+    def handle_error(self):
+        print "eleChannel - ERROR!!! ", sys.exc_info()[0], sys.exc_info()[1]
+        self.close()
+
+
+class eleAsyncServer(asyncore.dispatcher):
+    """Listens for connections, and runs the worker threads which answer
+    the requests using elevation engine srtm (a srtm_tiff object).
+    Requests are recorded in accessLog (an accesslog.AccessLog object)
+    unless it is None, plots are drawn by plotter (a
+    doPlot.plotRenderer object), files are served by files (a
+    staticfiles.staticFiles object, or the current directory if None),
+    and map tiles by tiles (a tilecache.tileCache object, or None if
+    there are none).
+    """
+    def __init__(self, port, srtm, numThreads=NUMTHREADS,
+                 idleTimeout=IDLE_TIMEOUT, accessLog=None, plotter=None,
+                 files=None, tiles=None):
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(('', int(port)))
+        self.listen(1024)
+        self.srtm = srtm
+        self.idleTimeout = idleTimeout
+        self.accessLog = accessLog
+        self.plotter = plotter
+        if files is None:
+            files = staticFiles()
+        self.files = files
+        self.tiles = tiles
+        self.metrics = serverMetrics(srtm, files, tiles, plotter)
+        self.jobs = Queue.Queue()
+        self.completed = deque()
+        self.trigger = trigger(self.processCompleted)
+        for i in range(max(int(numThreads),1)):
+            t = threading.Thread(target = self.worker,
+                                 name = "eleserver-worker-%d" % i)
+            t.daemon = True
+            t.start()
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error, e:
+            # Probably out of file descriptors - try again later.
+            print "handle_accept - %s" % e
+            return
+        if pair is not None:
+            eleChannel(self, pair[0], pair[1])
+
+    def handle_error(self):
+        print "eleAsyncServer - ERROR!!! ", sys.exc_info()[0], sys.exc_info()[1]
+
+    def worker(self):
+        "Main loop of a worker thread."
+        while True:
+            (channel, request) = self.jobs.get()
+            startTime = time.time()
+            self.srtm.startLookupInfo()
+            try:
+                response = self.handleRequest(request)
+            except:
+                print "handleRequest - ERROR!!! ", sys.exc_info()[0], sys.exc_info()[1]
+                response = (500, 'text/html', 'Error - Internal Server Error')
+                request['keepalive'] = False
+            headers = request.get('headers')
+            record = accessRecord(self.srtm, startTime, channel.addr[0],
+                                  request.get('method'), request.get('path'),
+                                  response[0], request.get('length', 0),
+                                  len(response[2]),
+                                  headers and headers.getheader('user-agent'))
+            self.metrics.record(record)
+            if self.accessLog is not None:
+                self.accessLog.log(record)
+            self.completed.append((channel, request, response))
+            self.trigger.pull()
+
+    def processCompleted(self):
+        "Send the replies finished by the workers - in the event loop thread."
+        while self.completed:
+            (channel, request, response) = self.completed.popleft()
+            channel.sendResponse(request, response)
+
+    def handleRequest(self, request):
+        """Work out the reply to request - called in a worker thread.
+        Returns a tuple (code, content type, body), or (code, content type,
+        body, headers) where headers is a list of extra (name, value)
+        headers.
+        """
+        if 'error' in request:
+            code = request['error']
+            return (code, 'text/html', 'Error - %s' % BaseHTTPRequestHandler.responses[code][0])
+        method = request['method']
+        path = request['path']
+        if method in ('GET', 'HEAD'):
+            if path == '/metrics':
+                return (200, METRICS_TYPE, self.metrics.render())
+            tile = parseTilePath(path)
+            if tile is not None:
+                return tileMessage(self.srtm, self.tiles, tile,
+                                   request['headers'].getheader('if-none-match'))
+            if path.find('?') != -1:
+                (path, query_string) = path.split('?', 1)
+                message = elevationMessage(self.srtm, parseGetArgs(query_string))
+                if message is None:
+                    return (400, 'text/html', USAGE_ERROR)
+                return cachedReply(200, 'text/html', message,
+                                   request['headers'].getheader('if-none-match'))
+            headers = request['headers']
+            files = self.files
+            if path.startswith(PLOT_URL) and self.plotter is not None:
+                (path, files) = (path[len(PLOT_URL)-1:], self.plotter.files)
+            return files.reply(path, headers.getheader('if-none-match'),
+                               headers.getheader('if-modified-since'))
+        elif method == 'POST':
+            (path, query_string) = (path.split('?', 1) + [''])[:2]
+            if path == '/elevations':
+                return bulkMessage(self.srtm, parseGetArgs(query_string),
+                                   request['headers'].getheader('content-type'),
+                                   request['body'])
+            if path == '/gpx':
+                return gpxEnrichMessage(self.srtm, parseGetArgs(query_string),
+                                        request['body'])
+            ctype, pdict = cgi.parse_header(request['headers'].getheader('content-type') or '')
+            if ctype != 'multipart/form-data':
+                return (400, 'text/html', 'Error - I need multipart/form-data')
+            query = cgi.parse_multipart(StringIO(request['body']), pdict)
+            return (200, 'text/html', gpxMessage(self.srtm, query, self.plotter))
+        else:
+            return (501, 'text/html', 'Error - %s not supported' % method)
+
+    def closeIdleChannels(self):
+        now = time.time()
+        for obj in asyncore.socket_map.values():
+            if isinstance(obj, eleChannel) and obj.isIdle(now):
+                obj.close()
+
+    def serve_forever(self):
+        """Run the event loop.  poll() is used rather than select() so
+        that there is no limit of 1024 connections.
+        """
+        lastCheck = time.time()
+        while True:
+            asyncore.loop(timeout=1.0, use_poll=True, count=1)
+            if time.time() - lastCheck >= 1.0:
+                self.closeIdleChannels()
+                lastCheck = time.time()
+
+
+def main(options):
+    os.chdir(options.wdir)
+    sys.stdout = sys.stderr = Log(open(options.logfile, 'a+'))
+    print "eleserver_async.main() - cwd=%s" % (os.getcwd())
+    srtm = makeEngine(options)
+    # The plot processes are forked now, before there are any threads.
+    plotter = makePlotter(options)
+    server = eleAsyncServer(options.port, srtm, options.threads,
+                            float(options.idle),
+                            accesslog.makeAccessLog(options), plotter,
+                            staticFiles(options.docroot), makeTiles(options))
+    print "Starting asynchronous web server with %s worker threads. Open http://localhost:%s to access EleServer." % \
+        (options.threads, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+        if server.accessLog is not None:
+            server.accessLog.close()
+        sys.exit()
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    usage = "eleserver_async [options]"
+    parser.add_option("-f", "--file", dest="filename",
+                      help="name of file containing list of srtm data files",
+                      metavar="FILE")
+    parser.add_option("-p", "--port", dest="port",
+                      help="port to listen on")
+    parser.add_option("-t", "--threads", dest="threads",
+                      help="number of worker threads for elevation lookups")
+    parser.add_option("--idle", dest="idle",
+                      help="seconds before an idle connection is closed")
+    parser.add_option("--raw", action="store_true", dest="raw",
+                      help="use memory mapped raw tiles (see srtm_raw.py)")
+    parser.add_option("--maxfiles", dest="maxfiles",
+                      help="maximum number of open tile files per thread")
+    parser.add_option("--docroot", dest="docroot",
+                      help="directory of the files served (default the working directory)")
+    parser.add_option("--pointcache", dest="pointcache",
+                      help="number of single point results to cache (0 for none)")
+    parser.add_option("--plotdir", dest="plotdir",
+                      help="directory where plots are cached")
+    parser.add_option("--plotprocs", dest="plotprocs",
+                      help="number of processes drawing plots (0 to draw them in the worker threads)")
+    parser.add_option("--plottimeout", dest="plottimeout",
+                      help="seconds to wait for a plot before replying")
+    parser.add_option("--tiledir", dest="tiledir",
+                      help="directory where map tiles are cached")
+    parser.add_option("--minele", dest="minele",
+                      help="elevation (m) of the lightest green in map tiles")
+    parser.add_option("--maxele", dest="maxele",
+                      help="elevation (m) of the darkest green in map tiles")
+    parser.add_option("--metatile", dest="metatile",
+                      help="map tiles rendered at once in each direction")
+    parser.add_option("--tilecache", dest="tilecache",
+                      help="bytes of map tiles kept in memory")
+    parser.add_option("-w", "--wdir", dest="wdir",
+                      help="working directory")
+    parser.add_option("-l", "--logfile", dest="logfile",
+                      help="log file")
+    accesslog.addOptions(parser)
+    parser.set_defaults(filename="srtm_tiff.txt",
+                        port=PORT,
+                        threads=NUMTHREADS,
+                        idle=IDLE_TIMEOUT,
+                        raw=False,
+                        maxfiles="10",
+                        docroot=".",
+                        pointcache=POINT_CACHE,
+                        plotdir=PLOTDIR,
+                        plotprocs=PLOT_PROCESSES,
+                        plottimeout=PLOT_TIMEOUT,
+                        tiledir=TILEDIR,
+                        minele=MINELE,
+                        maxele=MAXELE,
+                        metatile=METATILE,
+                        tilecache=TILE_CACHE_BYTES,
+                        wdir=WDIR,
+                        logfile=LOGFILE)
+    (options,args)=parser.parse_args()
+    options.threads = int(options.threads)
+
+    main(options)
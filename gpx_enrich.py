@@ -0,0 +1,200 @@
+"""
+NAME: GPX Enrich
+DESC:  Adds elevations to a GPX file as it is read.
+       class GPXEnricher is fed the GPX data a piece at a time, and writes
+       out the same file with an <ele> element added to (or replaced in)
+       every route point, track point and waypoint.  The points are
+       looked up in chunks with srtm_tiff.getElevations(), and the output
+       up to the end of each chunk is written as soon as the chunk has
+       been looked up, so the memory used and the delay before the first
+       output do not depend on the size of the file.
+
+"""
+from xml.parsers import expat
+from xml.sax.saxutils import escape, quoteattr
+
+POINT_TAGS = ('rtept','trkpt','wpt')
+CHUNK_POINTS = 1000       # points looked up together.
+MAX_BUFFER = 65536        # characters of output held when there are no points.
+
+def localName(tag):
+    "Return tag without any namespace prefix."
+    return tag.rsplit(':',1)[-1]
+
+
+class GPXEnricher:
+    """
+    Fills in the elevations of the points in a GPX file, using srtm (a
+    srtm_tiff object).  To use it do:
+        enricher = GPXEnricher(srtm,outfile.write)
+        for data in pieces_of_the_file:
+            enricher.feed(data)
+        enricher.close()
+
+    write(string) is called with the UTF-8 encoded output whenever a
+    chunk of points has been looked up.  feed() and close() raise
+    expat.ExpatError if the data is not valid XML.
+
+    Each point gets an <ele> element as its first child, as the GPX schema
+    requires, and any <ele> it had is removed - unless the point is not
+    covered by the elevation data, in which case the original <ele> (if
+    any) is kept.  Everything else is copied through unchanged, apart
+    from the XML declaration which always says UTF-8.
+
+    """
+
+    def __init__(self, srtm, write, bilinear=False, chunkPoints=CHUNK_POINTS):
+        self.srtm = srtm
+        self.write = write
+        self.bilinear = bilinear
+        self.chunkPoints = chunkPoints
+        self.out = []        # output strings, and point numbers where an
+                             # <ele> element is to be inserted.
+        self.outSize = 0
+        self.points = []     # [lat, lon, tag, original ele text] for each
+                             # point in self.out.
+        self.depth = 0
+        self.pointDepth = None   # depth of the point element we are in.
+        self.pointStart = 0      # where that point starts in self.out.
+        self.eleText = None      # text of an <ele> being removed, or None.
+        self.nPoints = 0
+        self.parser = expat.ParserCreate()
+        self.parser.ordered_attributes = True
+        self.parser.XmlDeclHandler = self.xmlDecl
+        self.parser.StartElementHandler = self.startElement
+        self.parser.EndElementHandler = self.endElement
+        self.parser.CharacterDataHandler = self.characters
+        self.parser.CommentHandler = self.comment
+        self.parser.ProcessingInstructionHandler = self.processingInstruction
+
+    def feed(self, data):
+        "Parse the next piece of the file."
+        self.parser.Parse(data, False)
+        if len(self.points) >= self.chunkPoints or \
+           (len(self.points) == 0 and self.outSize > MAX_BUFFER):
+            self.flush()
+
+    def close(self):
+        "Finish parsing, and write out the rest of the file."
+        self.parser.Parse('', True)
+        self.emit(u'\n')
+        self.flush()
+
+    def emit(self, s):
+        self.out.append(s)
+        self.outSize += len(s)
+
+    def xmlDecl(self, version, encoding, standalone):
+        self.emit(u'<?xml version="%s" encoding="UTF-8"?>\n' % (version or '1.0'))
+
+    def startElement(self, tag, attrs):
+        self.depth += 1
+        if self.eleText is not None:
+            return
+        name = localName(tag)
+        if self.pointDepth is not None and self.depth == self.pointDepth+1 \
+           and name == 'ele':
+            self.eleText = u''
+            return
+        point = None
+        if name in POINT_TAGS and self.pointDepth is None:
+            attrDict = dict(zip(attrs[0::2], attrs[1::2]))
+            try:
+                point = [float(attrDict['lat']), float(attrDict['lon']),
+                         tag[:len(tag)-len(name)] + 'ele', None]
+            except (KeyError, ValueError):
+                pass
+        if point is not None:
+            self.pointDepth = self.depth
+            self.pointStart = len(self.out)
+        attrStr = u''.join([u' %s=%s' % (attrs[i], quoteattr(attrs[i+1]))
+                            for i in range(0, len(attrs), 2)])
+        self.emit(u'<%s%s>' % (tag, attrStr))
+        if point is not None:
+            self.points.append(point)
+            self.out.append(len(self.points)-1)
+            self.nPoints += 1
+
+    def endElement(self, tag):
+        self.depth -= 1
+        if self.eleText is not None:
+            if self.depth == self.pointDepth:
+                self.points[-1][3] = self.eleText
+                self.eleText = None
+            return
+        self.emit(u'</%s>' % tag)
+        if self.depth+1 == self.pointDepth:
+            self.pointDepth = None
+
+    def characters(self, data):
+        if self.eleText is not None:
+            self.eleText += data
+        else:
+            self.emit(escape(data))
+
+    def comment(self, data):
+        if self.eleText is None:
+            self.emit(u'<!--%s-->' % data)
+            self.newlineOutside()
+
+    def processingInstruction(self, target, data):
+        if self.eleText is None:
+            self.emit(u'<?%s %s?>' % (target, data))
+            self.newlineOutside()
+
+    def newlineOutside(self):
+        "expat does not report the white space outside the root element."
+        if self.depth == 0:
+            self.emit(u'\n')
+
+    def flush(self):
+        """Look up the points read so far, and write out the output up to
+        the start of the point we are in (if any), which is kept for the
+        next chunk as it may still have an <ele> to come."""
+        if self.pointDepth is not None:
+            (done, keep) = (self.out[:self.pointStart], self.out[self.pointStart:])
+            (points, self.points) = (self.points[:-1], self.points[-1:])
+        else:
+            (done, keep) = (self.out, [])
+            (points, self.points) = (self.points, [])
+        eleStrs = self.eleStrings(points)
+        data = u''.join([eleStrs[s] if isinstance(s, int) else s
+                         for s in done])
+        self.out = [0 if isinstance(s, int) else s for s in keep]
+        self.pointStart = 0
+        self.outSize = sum([len(s) for s in self.out if not isinstance(s, int)])
+        if data:
+            self.write(data.encode('utf-8'))
+
+    def eleStrings(self, points):
+        """Look up the elevations of points, and return the <ele> element
+        to write for each of them."""
+        if not points:
+            return []
+        (eles, outside) = self.srtm.getElevations([p[0] for p in points],
+                                                  [p[1] for p in points],
+                                                  self.bilinear)
+        eleStrs = []
+        for (point, ele, out) in zip(points, eles.tolist(), outside.tolist()):
+            if out or ele == -32768:
+                if point[3] is None:
+                    eleStrs.append(u'')
+                else:
+                    eleStrs.append(u'<%s>%s</%s>' % (point[2], escape(point[3]), point[2]))
+            elif self.bilinear:
+                eleStrs.append(u'<%s>%.1f</%s>' % (point[2], ele, point[2]))
+            else:
+                eleStrs.append(u'<%s>%d</%s>' % (point[2], ele, point[2]))
+        return eleStrs
+
+
+def enrichGPX(srtm, data, bilinear=False):
+    """Return GPX data (a string) with the elevations of all of the points
+    filled in, as GPXEnricher does.  Raises expat.ExpatError if the data is
+    not valid XML.
+    """
+    out = []
+    enricher = GPXEnricher(srtm, out.append, bilinear)
+    enricher.feed(data)
+    enricher.close()
+    return ''.join(out)
@@ -1,64 +1,145 @@
 """
 NAME: GPX Parse
 DESC:  A simple class to parse a GPX file.
-HISTORY:  06aug2008  GJ  Plagiarised from 
+       The file is read incrementally with iterparse() by iterGPXPoints(),
+       which yields the route, track and waypoint points one at a time, and
+       throws away each part of the document as soon as it has been read,
+       so that large track logs can be processed in constant memory.
+       GPXParser collects the points into lists of routes and tracks.
+HISTORY:  06aug2008  GJ  Plagiarised from
                          http://code.activestate.com/recipes/528877/
 
 """
 
 import sys, string
-from xml.dom import minidom, Node
+from cStringIO import StringIO
+from xml.etree import cElementTree
+
+POINT_TAGS = ('rtept','trkpt','wpt')
+
+def localName(tag):
+    "Return tag without its namespace (GPX 1.0 and 1.1 use different ones)."
+    return tag.rsplit('}',1)[-1]
+
+
+def iterGPXPoints(source, debug=False):
+    """Read GPX data from source (a file name or file object) and yield a
+    dictionary for each route point, track point and waypoint, in the
+    order they appear in the file:
+        {'type':'rtept', 'trkpt' or 'wpt',
+         'lat':..., 'lon':...,
+         'name': the point name, or None,
+         'ele': the elevation as a float, or None,
+         'time': the time string, or None,
+         'parent': the name of the route or track the point is in, or None,
+         'segment': the number of the track segment (trkpt only, else 0)}
+
+    Each element is removed from the document once it has been read, so
+    memory use does not grow with the size of the file.  Points without a
+    valid lat and lon are skipped.  Raises SyntaxError if the data is not
+    valid XML.
+    """
+    stack = []         # the elements we are inside, outermost first.
+    point = None
+    parentName = None
+    segment = -1
+    for (event, elem) in cElementTree.iterparse(source, ('start','end')):
+        tag = localName(elem.tag)
+        if event == 'start':
+            if tag in POINT_TAGS:
+                point = {'type':tag, 'lat':elem.get('lat'), 'lon':elem.get('lon'),
+                         'name':None, 'ele':None, 'time':None,
+                         'parent':None, 'segment':0}
+                if tag != 'wpt':
+                    point['parent'] = parentName
+                if tag == 'trkpt':
+                    point['segment'] = segment
+            elif tag in ('rte','trk'):
+                parentName = None
+                segment = -1
+            elif tag == 'trkseg':
+                segment += 1
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        parentTag = None
+        if stack:
+            parentTag = localName(stack[-1].tag)
+        if point is not None and parentTag == point['type']:
+            text = (elem.text or '').strip()
+            if tag == 'name':
+                point['name'] = text
+            elif tag == 'time':
+                point['time'] = text
+            elif tag == 'ele':
+                try:
+                    point['ele'] = float(text)
+                except ValueError:
+                    pass
+        elif tag == 'name' and parentTag in ('rte','trk'):
+            parentName = (elem.text or '').strip()
+        elif tag in POINT_TAGS and point is not None:
+            try:
+                point['lat'] = float(point['lat'])
+                point['lon'] = float(point['lon'])
+            except (TypeError, ValueError):
+                if (debug):
+                    print "iterGPXPoints - skipping %s with no valid lat/lon" % tag
+                point = None
+            if point is not None:
+                if (debug):
+                    print "read %s %s at (%s,%s)" % \
+                        (tag,point['name'],point['lat'],point['lon'])
+                yield point
+            point = None
+        # Throw away what we have read.
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+
 
 class GPXParser:
-    def __init__(self, gpxStr):
-        print "GPXParser.__init__()"
+    """
+    Reads the routes, tracks and waypoints from the GPX data in string
+    gpxStr - use getRoute(name), getTrack(name) and getWaypoints() to get
+    the points.  If gpxStr is not a valid GPX file, there are no routes
+    or tracks.
+    """
+    def __init__(self, gpxStr, debug=False):
+        self.debug = debug
+        if (self.debug):
+            print "GPXParser.__init__()"
         self.tracks = {}
         self.routes = {}
+        self.waypoints = []
         try:
-            doc = minidom.parseString(gpxStr)
-            doc.normalize()
-        except:
-            return # handle this properly later
-        gpx = doc.documentElement
-        for node in gpx.getElementsByTagName('rte'):
-            print "reading route"
-            self.parseRoute(node)
-        for node in gpx.getElementsByTagName('trk'):
-            self.parseTrack(node)
-        print("init finished")
-
-    def parseRoute(self, rte):
-        print "parseRoute()"
-        rteName = rte.getElementsByTagName('name')[0].firstChild.data
-        if not rteName in self.routes:
-            self.routes[rteName] = []
-        for rtept in rte.getElementsByTagName('rtept'):
-            lat = float(rtept.getAttribute('lat'))
-            lon = float(rtept.getAttribute('lon'))
-            ptName = rtept.getElementsByTagName('name')[0].firstChild.data
-            print "read point %s at (%s,%s)" % (ptName,lat,lon)
-            self.routes[rteName].append({'lat':lat,'lon':lon,'name':ptName})
+            for point in iterGPXPoints(StringIO(gpxStr), debug):
+                if point['type'] == 'rtept':
+                    self.routes.setdefault(point['parent'],[]).append(point)
+                elif point['type'] == 'trkpt':
+                    self.tracks.setdefault(point['parent'],[]).append(point)
+                else:
+                    self.waypoints.append(point)
+        except SyntaxError, e:
+            print "GPXParser - invalid GPX data - %s" % e
+        if (self.debug):
+            print("init finished")
 
     def getRoute(self, rteName):
         "Return a list of route points (lat,lon,name) for route rteName"
         return [(point['lat'],point['lon'],point['name'])
                 for point in self.routes[rteName]]
 
-
-
-    def parseTrack(self, trk):
-        name = trk.getElementsByTagName('name')[0].firstChild.data
-        if not name in self.tracks:
-            self.tracks[name] = {}
-        for trkseg in trk.getElementsByTagName('trkseg'):
-            for trkpt in trkseg.getElementsByTagName('trkpt'):
-                lat = float(trkpt.getAttribute('lat'))
-                lon = float(trkpt.getAttribute('lon'))
-                ele = float(trkpt.getElementsByTagName('ele')[0].firstChild.data)
-                rfc3339 = trkpt.getElementsByTagName('time')[0].firstChild.data
-                self.tracks[name][rfc3339]={'lat':lat,'lon':lon,'ele':ele}
-
     def getTrack(self, name):
-        times = self.tracks[name].keys()
-        points = [self.tracks[name][time] for time in times.sort()]
+        """Return a list of the track points (lat,lon) of track name, in
+        time order (in file order if any of the points have no time)."""
+        points = self.tracks[name]
+        if None not in [point['time'] for point in points]:
+            points = sorted(points, key=lambda point: point['time'])
         return [(point['lat'],point['lon']) for point in points]
+
+    def getWaypoints(self):
+        "Return a list of the waypoints (lat,lon,name)."
+        return [(point['lat'],point['lon'],point['name'])
+                for point in self.waypoints]
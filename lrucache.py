@@ -0,0 +1,143 @@
+#!/usr/bin/python
+"""
+A least recently used cache, bounded by the number of items and by their
+total size in bytes.
+
+Only class LRUCache is defined in this module, plus functions to work
+with its statistics.
+
+"""
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    A dictionary like cache which discards the least recently used items
+    when it holds more than maxitems items, or when the total size of the
+    items is more than maxbytes bytes (maxbytes=0 means no byte limit).
+
+    The size of each item is given by the caller when it is added with
+    put(), because only the caller knows what an item really costs.
+    If onEvict is given it is called as onEvict(key,value) for each item
+    that is discarded to make space, so that (for example) files can be
+    closed.
+
+    The cache keeps counts of hits, misses and evictions, which are
+    returned by getStats() so that it can be sized for the working set.
+
+    All of the methods are safe to call from several threads at once.
+
+    To use this class do:
+        cache = LRUCache(10,1000000)
+        value = cache.get(key)
+        if value is None:
+            value = makeValue(key)
+            cache.put(key,value,size_of_value)
+
+    """
+
+    def __init__(self,maxitems,maxbytes=0,onEvict=None):
+        self.maxitems = int(maxitems)
+        self.maxbytes = int(maxbytes)
+        self.onEvict = onEvict
+        self.items = OrderedDict()   # key -> (value,nbytes), oldest first.
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self,key):
+        with self.lock:
+            return key in self.items
+
+    def get(self,key,default=None):
+        """Return the value stored for key, or default if it is not in
+        the cache.  A successful get makes key the most recently used item.
+
+        """
+        with self.lock:
+            try:
+                item = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def put(self,key,value,nbytes=0):
+        """Add value to the cache as key, with a size of nbytes, then
+        discard least recently used items until the cache is back within
+        its limits.  The item just added is never discarded, even if it
+        is bigger than maxbytes on its own.
+
+        """
+        evicted = []
+        with self.lock:
+            if key in self.items:
+                self.nbytes -= self.items.pop(key)[1]
+            self.items[key] = (value,nbytes)
+            self.nbytes += nbytes
+            while len(self.items) > 1 and \
+                    (len(self.items) > self.maxitems or
+                     (self.maxbytes > 0 and self.nbytes > self.maxbytes)):
+                (oldkey,(oldvalue,oldbytes)) = self.items.popitem(last=False)
+                self.nbytes -= oldbytes
+                self.evictions += 1
+                evicted.append((oldkey,oldvalue))
+        if self.onEvict is not None:
+            for (oldkey,oldvalue) in evicted:
+                self.onEvict(oldkey,oldvalue)
+
+    def remove(self,key):
+        """Remove key from the cache (if it is there) without counting
+        it as an eviction.
+
+        """
+        with self.lock:
+            if key in self.items:
+                self.nbytes -= self.items.pop(key)[1]
+
+    def clear(self):
+        """Remove everything from the cache."""
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+    def getStats(self):
+        """Return a dictionary of the current size and limits of the cache
+        and the hit, miss and eviction counts.
+
+        """
+        with self.lock:
+            stats = {'items':len(self.items), 'maxitems':self.maxitems,
+                     'bytes':self.nbytes, 'maxbytes':self.maxbytes,
+                     'hits':self.hits, 'misses':self.misses,
+                     'evictions':self.evictions}
+        stats['hitratio'] = hitRatio(stats)
+        return stats
+
+
+def hitRatio(stats):
+    """Return the hit ratio from a dictionary of cache statistics."""
+    lookups = stats['hits'] + stats['misses']
+    if lookups > 0:
+        return float(stats['hits'])/lookups
+    else:
+        return 0.0
+
+
+def sumStats(statslist):
+    """Add up the statistics of several caches (a list of dictionaries
+    as returned by LRUCache.getStats()) - used where each thread has its
+    own cache.
+    """
+    total = {'caches':len(statslist)}
+    for key in ('items','maxitems','bytes','maxbytes','hits','misses','evictions'):
+        total[key] = sum([stats[key] for stats in statslist])
+    total['hitratio'] = hitRatio(total)
+    return total
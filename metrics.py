@@ -0,0 +1,154 @@
+#!/usr/bin/python
+"""
+Counters and histograms for instrumenting the elevation server, which can
+be written out in the Prometheus text exposition format.
+
+Classes Counter, Histogram and Registry are defined in this module.
+
+"""
+import threading
+from bisect import bisect_left
+
+# Histogram buckets (upper bounds) in seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def formatLabels(names, values, extra=''):
+    'Return the {name="value",...} label string for a sample.'
+    labels = ['%s="%s"' % (name, str(value).replace('\\','\\\\').replace('"','\\"'))
+              for (name, value) in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    if labels:
+        return '{%s}' % ','.join(labels)
+    return ''
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter:
+    """
+    A count which only goes up, optionally split by labels - for example
+        requests = Counter('requests_total', 'Requests answered', ('endpoint',))
+        requests.inc(('elevation',))
+    Recording a value takes a lock and a dictionary update, so counters
+    can be left on all the time.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labelValues=(), amount=1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def get(self, labelValues=()):
+        return self.values.get(labelValues, 0)
+
+    def samples(self):
+        "Return a list of the lines for this metric's values."
+        with self.lock:
+            values = sorted(self.values.items())
+        return ['%s%s %s' % (self.name, formatLabels(self.labels, lv), formatValue(v))
+                for (lv, v) in values]
+
+
+class Histogram:
+    """
+    Counts of observed values (such as latencies) in buckets with upper
+    bounds buckets, plus their sum and count, optionally split by labels.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labels = tuple(labels)
+        self.values = {}     # labelValues -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, labelValues=()):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            v = self.values.get(labelValues)
+            if v is None:
+                v = self.values[labelValues] = [[0]*(len(self.buckets)+1), 0.0, 0]
+            v[0][i] += 1
+            v[1] += value
+            v[2] += 1
+
+    def getStats(self, labelValues=()):
+        """Return a dictionary of the count and sum of the values observed
+        with labelValues."""
+        with self.lock:
+            v = self.values.get(labelValues)
+            if v is None:
+                return {'count':0, 'sum':0.0}
+            return {'count':v[2], 'sum':v[1]}
+
+    def samples(self):
+        with self.lock:
+            values = sorted([(lv, (list(v[0]), v[1], v[2]))
+                             for (lv, v) in self.values.items()])
+        lines = []
+        for (lv, (counts, total, count)) in values:
+            cumulative = 0
+            for (bound, n) in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' %
+                             (self.name,
+                              formatLabels(self.labels, lv, 'le="%s"' % bound),
+                              cumulative))
+            lines.append('%s_sum%s %s' % (self.name, formatLabels(self.labels, lv),
+                                          repr(total)))
+            lines.append('%s_count%s %d' % (self.name, formatLabels(self.labels, lv),
+                                            count))
+        return lines
+
+
+class Registry:
+    """
+    A set of metrics, and of collector functions which work out values
+    (such as cache statistics) when the metrics are read.  A collector is
+    called with no arguments, and returns a list of tuples
+    (name, kind, help, [(labels dictionary, value), ...]).
+    """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        "Add metric to the registry and return it."
+        self.metrics.append(metric)
+        return metric
+
+    def addCollector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        "Return all of the metrics in the Prometheus text format."
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.samples())
+        for collector in self.collectors:
+            for (name, kind, help, values) in collector():
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for (labels, value) in values:
+                    names = sorted(labels.keys())
+                    lines.append('%s%s %s' % (name,
+                                              formatLabels(names, [labels[n] for n in names]),
+                                              formatValue(value)))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,299 @@
+#!/usr/bin/python
+"""
+Provides an interface to SRTM elevation data stored in raw, memory mapped
+tile files.
+
+Only class srtm_raw is defined in this module, plus the functions used to
+convert GeoTIFF tiles to the raw format.
+
+"""
+import os
+import struct
+import fileinput
+from optparse import OptionParser
+import numpy
+import gdal, gdalnumeric
+from srtm_tiff3 import srtm_tiff
+
+# The raw file is a fixed size header followed by the tile data as
+# ysize rows of xsize native-endian int16 values.
+# The header is:
+#   magic     - 'SRTMRAW1'
+#   byteorder - the int16 value 0x0102, so a file written on a machine
+#               with the other byte order can be detected.
+#   halo      - number of pixels of data copied from the neighbouring tiles
+#               stored around each edge of the tile.
+#   xsize, ysize - size of the tile data in pixels (excluding any halo), so
+#               the data is really ysize+2*halo rows of xsize+2*halo values.
+#   N, W      - latitude and longitude of the top left corner of the tile.
+#   lat_pixel, lon_pixel - pixel height and width in degrees.
+RAW_MAGIC = 'SRTMRAW1'
+RAW_BYTEORDER = 0x0102
+RAW_HEADER_FORMAT = '=8shhiidddd'
+RAW_HEADER_SIZE = 64
+
+
+def rawFileName(fname):
+    """Return the name of the raw file corresponding to GeoTIFF fname."""
+    return "%s.raw" % os.path.splitext(fname)[0]
+
+
+def readRawHeader(rawfname):
+    """Read the header of raw tile file rawfname and return it as a
+    dictionary (keys as for the srtm_tiff tile dictionaries, plus 'halo'),
+    or None if the file does not exist or is not a valid raw tile file.
+
+    """
+    if not os.path.isfile(rawfname):
+        return None
+    f = open(rawfname,'rb')
+    hdr = f.read(RAW_HEADER_SIZE)
+    f.close()
+    if len(hdr) != RAW_HEADER_SIZE:
+        print "readRawHeader - %s is too short to be a raw tile" % rawfname
+        return None
+    (magic,byteorder,halo,xsize,ysize,N,W,lat_pixel,lon_pixel) = \
+        struct.unpack(RAW_HEADER_FORMAT,
+                      hdr[:struct.calcsize(RAW_HEADER_FORMAT)])
+    if magic != RAW_MAGIC:
+        print "readRawHeader - %s is not a raw tile file" % rawfname
+        return None
+    if byteorder != RAW_BYTEORDER:
+        print "readRawHeader - %s has the wrong byte order - it needs converting again" % rawfname
+        return None
+    expected = RAW_HEADER_SIZE + 2*(xsize+2*halo)*(ysize+2*halo)
+    if os.path.getsize(rawfname) != expected:
+        print "readRawHeader - %s is truncated" % rawfname
+        return None
+    return {'halo':halo, 'xsize':xsize, 'ysize':ysize, 'N':N, 'W':W,
+            'lat_pixel':lat_pixel, 'lon_pixel':lon_pixel}
+
+
+def fillHalo(data,halo,geotransform,source):
+    """Fill in the halo of padded tile data array data from the
+    neighbouring tiles, by looking up the elevation of the centre of each
+    halo pixel with source (a srtm_tiff object).  Halo pixels which are
+    not covered by any tile are left as they are.
+
+    """
+    (nrows,ncols) = data.shape
+    inhalo = numpy.ones(data.shape,dtype=bool)
+    inhalo[halo:nrows-halo,halo:ncols-halo] = False
+    (rr,cc) = numpy.nonzero(inhalo)
+    lats = geotransform[3] + (rr-halo+0.5)*geotransform[5]
+    lons = geotransform[0] + (cc-halo+0.5)*geotransform[1]
+    (eles,outside) = source.getElevations(lats,lons)
+    data[rr[~outside],cc[~outside]] = eles[~outside]
+
+
+def convertTile(fname,rawfname,verbose=False,halo=0,source=None):
+    """Convert GeoTIFF file fname into raw tile file rawfname.
+
+    If halo is not zero, halo pixels are added around each edge of the
+    tile, copied from the neighbouring tiles using source (a srtm_tiff
+    object for the complete tile set), or copied from the edge of this
+    tile where there is no neighbour.  With a halo, interpolation at the
+    edge of a tile reads the neighbouring data from the same array rather
+    than getting it wrong (or having to read the next tile).
+
+    The file is written under a temporary name and renamed into place,
+    so other processes never see a partly written tile.
+
+    """
+    if (verbose):
+        print "Converting %s to %s (halo=%d)" % (fname,rawfname,halo)
+    dataset = gdal.Open(fname)
+    geotransform = dataset.GetGeoTransform()
+    data = gdalnumeric.DatasetReadAsArray(dataset).astype(numpy.int16)
+    (ysize,xsize) = data.shape
+    if halo > 0:
+        data = numpy.pad(data,halo,mode='edge')
+        if source is not None:
+            fillHalo(data,halo,geotransform,source)
+    hdr = struct.pack(RAW_HEADER_FORMAT,RAW_MAGIC,RAW_BYTEORDER,halo,
+                      xsize,ysize,geotransform[3],geotransform[0],
+                      geotransform[5],geotransform[1])
+    tmpfname = "%s.%d.tmp" % (rawfname,os.getpid())
+    f = open(tmpfname,'wb')
+    f.write(hdr.ljust(RAW_HEADER_SIZE,'\0'))
+    data.tofile(f)
+    f.close()
+    os.rename(tmpfname,rawfname)
+
+
+def convertTiles(fname,verbose=False,halo=0):
+    """Convert all of the GeoTIFF files listed in tile list file fname
+    (the same format as used by srtm_tiff) to raw tile files, with halo
+    pixels of neighbouring data around each one.
+
+    """
+    tilefnames = [line.split(None,1)[0] for line in fileinput.input(fname)]
+    fileinput.close()
+    if halo > 0:
+        source = srtm_tiff(fname,10,False,False)
+    else:
+        source = None
+    for tilefname in tilefnames:
+        convertTile(tilefname,rawFileName(tilefname),verbose,halo,source)
+
+
+class srtm_raw(srtm_tiff):
+    """
+    Provides an interface to SRTM elevation data stored in raw tile files.
+
+    This is a drop in replacement for srtm_tiff3.srtm_tiff, using the same
+    tile list file.  Each GeoTIFF tile is converted once into a raw file
+    alongside it (same name, but with a .raw extension - see convertTile()),
+    which is then opened with numpy.memmap.  Reading a window is then just
+    an array slice of the mapped file - there is no GDAL call, no copy,
+    and no start up cost, and because the data lives in the operating
+    system page cache it is shared by every process using the same tiles.
+
+    To convert the tiles listed in srtm_tiff.txt do:
+       python ./srtm_raw.py -f srtm_tiff.txt --convert
+
+    Tiles that have not been converted are read from the GeoTIFF file
+    through GDAL as before, unless convert=True is passed to the
+    constructor, in which case they are converted as the tile list is read.
+
+    Tiles converted with a halo (--halo=N with --convert) give correct
+    bilinear (N>=1) and bicubic (N>=2) interpolation right up to the tile
+    edges, without reading from a second tile.
+
+    """
+
+    def __init__(self,fname,maxfiles,verbose,debug,maxbytes=0,convert=False,
+                 halo=0):
+        """Reads the tile list as for srtm_tiff, then checks for the raw
+        version of each tile.
+
+        In addition to the srtm_tiff tile dictionary entries, each tile
+        has filedict['rawfname'] - the name of the raw file to use, or
+        None if the tile has to be read from the GeoTIFF file, and
+        filedict['halo'] is set from the raw file header.  Tiles converted
+        by the constructor are given halo pixels of halo.
+
+        Mapped files are kept in the tile cache like GDAL handles, so
+        maxfiles and maxbytes limit the number and total size of the
+        mappings held by this process.
+
+        """
+        srtm_tiff.__init__(self,fname,maxfiles,verbose,debug,maxbytes)
+        self.convert = convert
+        self.halo = int(halo)
+        for td in self.tilearr:
+            td['rawfname'] = None
+        for tdi in range(len(self.tilearr)):
+            self.tilearr[tdi]['rawfname'] = self.checkRawFile(self.tilearr[tdi])
+            # The GDAL file may have been opened to fill in the halo of
+            # a neighbouring tile - make sure the raw file is used now.
+            self.getTileCache().remove(tdi)
+
+
+    def checkRawFile(self,td):
+        """Return the name of the raw file for tile td, converting it if
+        necessary (and allowed), or None if it is not available.
+
+        """
+        rawfname = rawFileName(td['fname'])
+        hdr = readRawHeader(rawfname)
+        if hdr is None and self.convert:
+            convertTile(td['fname'],rawfname,self.verbose,self.halo,self)
+            hdr = readRawHeader(rawfname)
+        if hdr is None:
+            if (self.verbose):
+                print "No raw file for %s - using GDAL" % td['fname']
+            return None
+        if hdr['xsize'] != td['xsize'] or hdr['ysize'] != td['ysize']:
+            print "checkRawFile - %s does not match %s - using GDAL" % \
+                (rawfname,td['fname'])
+            return None
+        td['halo'] = hdr['halo']
+        return rawfname
+
+
+    def openTileFile(self,td):
+        """Return the memory mapped data array for tile td, or a GDAL
+        handle if it does not have a raw file.
+
+        The mapping is released when the array is evicted from the tile
+        cache and no views of it are left.
+
+        """
+        if td['rawfname'] is None:
+            return srtm_tiff.openTileFile(self,td)
+        if (self.debug):
+            print "Mapping file %s" % td['rawfname']
+        halo = td['halo']
+        return numpy.memmap(td['rawfname'],dtype=numpy.int16,
+                            mode='r',offset=RAW_HEADER_SIZE,
+                            shape=(td['ysize']+2*halo,td['xsize']+2*halo))
+
+
+    def readWindow(self,tdi,col,row,ncols,nrows):
+        """Return a nrows x ncols array of the tile data of tile tdi,
+        starting at pixel (row,col).  row and col may be negative, or
+        the window may extend past the end of the tile, by up to the
+        size of the tile's halo.
+
+        For raw tiles this is a view of the mapped file, not a copy.
+
+        """
+        td = self.tilearr[tdi]
+        if td['rawfname'] is None:
+            return srtm_tiff.readWindow(self,tdi,col,row,ncols,nrows)
+        halo = td['halo']
+        return self.openTile(tdi)[row+halo:row+halo+nrows,
+                                  col+halo:col+halo+ncols]
+
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    usage = "srtm_raw [options]"
+    parser.add_option("-f", "--file", dest="filename",
+                      help="name of file containing list of srtm data files",
+                      metavar="FILE")
+    parser.add_option("-c", "--convert", action="store_true",dest="convert",
+                      help="Convert the GeoTIFF files to raw tile files")
+    parser.add_option("--maxfiles", dest="maxfiles",
+                      help="maximum number of mapped files")
+    parser.add_option("--maxbytes", dest="maxbytes",
+                      help="maximum total size of mapped files (bytes, 0=no limit)")
+    parser.add_option("--lat", dest="lat",
+                      help="latitude of point")
+    parser.add_option("--lon", dest="lon",
+                      help="longitude of point")
+    parser.add_option("--halo", dest="halo",
+                      help="Number of pixels of neighbouring tile data to add around converted tiles")
+    parser.add_option("-b", "--bilinear", action="store_true",dest="bilinear",
+                      help="Use bilinear interpolation to improve accuracy (slower)")
+    parser.add_option("--bicubic", action="store_true",dest="bicubic",
+                      help="Use bicubic interpolation (needs --halo=2 or more to be correct at tile edges)")
+    parser.add_option("-v", "--verbose", action="store_true",dest="verbose",
+                      help="Include verbose output")
+    parser.add_option("-d", "--debug", action="store_true",dest="debug",
+                      help="Include debug output")
+    parser.set_defaults(filename="srtm_tiff.txt",
+                        convert=False,
+                        maxfiles="10",
+                        maxbytes="0",
+                        lat="54",
+                        lon="-1",
+                        halo="0",
+                        bilinear=False,
+                        bicubic=False,
+                        debug=False,
+                        verbose=False)
+    (options,args)=parser.parse_args()
+
+    if options.convert:
+        print "Converting tiles listed in %s" % options.filename
+        convertTiles(options.filename,True,int(options.halo))
+    else:
+        srtm = srtm_raw(options.filename,options.maxfiles,options.verbose,
+                        options.debug,options.maxbytes)
+        lat = float(options.lat)
+        lon = float(options.lon)
+        ele = srtm.getElevation(lat,lon,options.bilinear,options.bicubic)
+        print "Elevation of point (%s,%s) is %d" % (lat,lon,ele)
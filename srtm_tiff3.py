@@ -8,11 +8,17 @@ Only class srtm_tiff is defined in this module.
 import sys
 import fileinput
 import random
+import threading
+import weakref
+import time
 from math import floor
-from time import clock
+from timeit import default_timer
 from optparse import OptionParser
 import re
+import numpy
 import gdal, gdalnumeric
+from lrucache import LRUCache, sumStats, hitRatio
+from metrics import Histogram
 
 class srtm_tiff:
     """
@@ -44,13 +50,17 @@ class srtm_tiff:
     The pulic functions of this class are:
         __init__ the constructor, called as srtm_tiff()
         getElevation(lat,lon)
+        getElevations(lats,lons) - the same for arrays of points.
         
     """
     
     MaxOpenFiles = 10
-    NumOpenFiles = 0
+    MaxOpenBytes = 0
+    BlockSize = 256
+    MaxBlockBytes = 32*1024*1024
 
-    def __init__(self,fname,maxfiles,verbose,debug):
+    def __init__(self,fname,maxfiles,verbose,debug,maxbytes=0,
+                 blockbytes=MaxBlockBytes):
         """Reads the GeoTIFF files into memory ready for processing.
 
         The tiles are stored as a list of dictionaries containing the
@@ -63,10 +73,28 @@ class srtm_tiff:
         - filedict['W']         - The western most ....
         - filedict['lat_pixel'] - the vertical size (in deg Lat) of each pixel.
         - filedict['lon_pixel'] - the horizontal size (in deg Lon) of each pixel.
-        - filedict['handle']    - the file handle of the file (if open) or -1 if not open.
+        - filedict['xsize']     - the width of the tile in pixels.
+        - filedict['ysize']     - the height of the tile in pixels.
+        - filedict['halo']      - the number of pixels of data from the
+                                  neighbouring tiles stored around the edge
+                                  of this tile (always 0 for GeoTIFF files).
+
+        The open files are held in a tile cache (see getTileCache()), an
+        LRU cache keyed on the tile index, which holds at most maxfiles
+        files, and (if maxbytes is not zero) files whose total decoded size
+        is at most maxbytes.  GDAL handles must not be shared between
+        threads, so each thread has its own tile cache.
+        The number and duration of the reads from the files are recorded
+        in self.readTimes (a metrics.Histogram).
+        Data read from the files is held in self.blockCache, as decoded
+        BlockSize x BlockSize pixel blocks, up to a total of blockbytes
+        bytes (blockbytes=0 switches the block cache off).  The blocks are
+        never modified once read, so this cache is shared by all threads.
 
         The list of files to be read is taken from srtm_tiff.txt unless
         the filename is specified as a parameter to __init__.
+        Once the list is read, a spatial index of the tiles is built by
+        buildTileIndex() so that tile lookups are quick.
 
         """
         self.verbose = verbose
@@ -97,15 +125,55 @@ class srtm_tiff:
             filedict['lon_pixel']=float(lon_pixel)
             filedict['xsize'] = int(xsize)
             filedict['ysize'] = int(ysize)
-            filedict['handle']=-1
+            filedict['halo'] = 0
             self.tilearr.append(filedict)
 
+        self.buildTileIndex()
+
         self.MaxOpenFiles = int(maxfiles)
-        self.NumOpenFiles = 0
+        self.MaxOpenBytes = int(maxbytes)
+        self.threadData = threading.local()
+        self.tileCaches = {}     # number -> (tile cache, weakref) per thread.
+        self.tileCacheCount = 0
+        self.retiredTileStats = {'hits':0, 'misses':0, 'evictions':0}
+        self.tileCachesLock = threading.Lock()
+        self.MaxBlockBytes = int(blockbytes)
+        if self.MaxBlockBytes > 0:
+            self.blockCache = LRUCache(self.MaxBlockBytes/(2*self.BlockSize**2)+1,
+                                       self.MaxBlockBytes)
+        else:
+            self.blockCache = None
+        self.readTimes = Histogram('srtm_tile_read_seconds',
+                                   'Time taken to read data from a tile file')
+        self.pointCache = None
 
         if (self.verbose):
-            print "init finished - MaxOpenFiles = %s" % self.MaxOpenFiles
+            print "init finished - MaxOpenFiles = %s, MaxOpenBytes = %s, MaxBlockBytes = %s" % \
+                (self.MaxOpenFiles,self.MaxOpenBytes,self.MaxBlockBytes)
+
+
+
+    def buildTileIndex(self):
+        """Build a grid hash of the tiles in self.tilearr so that
+        getTileIndex() does not have to search the whole list.
+
+        self.tileIndex is a dictionary keyed on whole degree cells
+        (floor(lat),floor(lon)).  Each entry is a list of the indices (in
+        self.tilearr) of the tiles whose bounding box overlaps that cell,
+        in catalog order.  A tile is entered in every cell it touches, so
+        catalogs which mix tile sizes need no special treatment, and a
+        lookup only has to check the few tiles which share one cell.
 
+        """
+        self.tileIndex = {}
+        for i in range(len(self.tilearr)):
+            td = self.tilearr[i]
+            for ilat in range(int(floor(td['S'])), int(floor(td['N']))+1):
+                for ilon in range(int(floor(td['W'])), int(floor(td['E']))+1):
+                    self.tileIndex.setdefault((ilat,ilon),[]).append(i)
+        if (self.verbose):
+            print "Tile index built - %s tiles in %s cells" % \
+                (len(self.tilearr),len(self.tileIndex))
 
 
     def getTileIndex(self,lat,lon):
@@ -114,19 +182,22 @@ class srtm_tiff:
 
         This is not intended as a public function - I can't think of what
         use it would be to anyone - use getElevation(lat,lon) instead.
-        It searches through the list of tile dictionaries to find the one
-        containing the requested point.  An error (-999) is returned if
-        none of the available tiles contains the desired location.
+        It looks up the degree cell containing the point in self.tileIndex
+        and checks the bounding boxes of the tiles listed there, so the
+        cost does not depend on the number of tiles in the catalog.
+        An error (-999) is returned if none of the available tiles contains
+        the desired location.
 
         """
-        for i in range(len(self.tilearr)):
+        cell = (int(floor(lat)),int(floor(lon)))
+        debug = self.debug
+        for i in self.tileIndex.get(cell,()):
             td = self.tilearr[i]
-            fname = td["fname"]
             N = td["N"]
             S = td["S"]
             E = td["E"]
             W = td["W"]
-            if (self.debug):
+            if (debug):
                 print "N=%s S=%s E=%s W=%s point=(%s,%s)" % (N,S,E,W,lat,lon)
             if ((lat<=N and lat>=S) and (lon<=E and lon>=W)):
                 if (self.verbose):
@@ -134,7 +205,7 @@ class srtm_tiff:
                       (lat,lon,i,N,W,S,E)
                 return i
             else:
-                if (self.debug):
+                if (debug):
                     print "point (%s, %s) DOES NOT FIT in bounding box \
                     (%s,%s %s,%s)" % \
                     (lat,lon,N,W,S,E)
@@ -143,47 +214,234 @@ class srtm_tiff:
         return(-999)
 
 
-    def closeAFile(self):
-        """
-        Close one of the open GeoTiff Files, and update NumOpenFiles
-        accordingly.
-        """
+    def openTileFile(self,td):
+        """Open the file for tile dictionary td and return its handle."""
         if (self.debug):
-            print "closeAFile - NumOpenFiles = %s" % self.NumOpenFiles
-        if (self.NumOpenFiles <= 0):
-            print "closeAFile() - Error - NumOpenFiles = %s:  Doing Nothing" % \
-                      self.NumOpenFiles
-            return -1
-        fileno = random.randint(1, self.NumOpenFiles)
+            print "Opening file %s" % td['fname']
+        return gdal.Open(td['fname'])
+
+
+    def closeTile(self,tdi,handle):
+        """Called by the tile cache when tile tdi is evicted from the cache.
+        Dropping the last reference to the handle closes the file.
+        """
         if (self.debug):
-            print "Closing open file number %s" % fileno
+            print "Closing File %s" % self.tilearr[tdi]['fname']
+
+
+    def tileBytes(self,td):
+        """Return the decoded size in bytes of tile td, which is what an
+        open tile is charged against MaxOpenBytes."""
+        return 2*td['xsize']*td['ysize']
+
+
+    def getTileCache(self):
+        """Return the tile cache (of open files) for the calling thread,
+        creating it if this is the thread's first lookup.
+
+        The cache is dropped, closing its files, when the thread exits,
+        and its hit, miss and eviction counts are added to
+        self.retiredTileStats, so that the totals getCacheStats() returns
+        never go down.
+
+        """
+        try:
+            return self.threadData.tileCache
+        except AttributeError:
+            tileCache = LRUCache(self.MaxOpenFiles,self.MaxOpenBytes,
+                                 self.closeTile)
+            # Only the thread's local data refers to the token, so it is
+            # freed (calling retire) when the thread exits.
+            token = threadToken()
+            with self.tileCachesLock:
+                number = self.tileCacheCount
+                self.tileCacheCount += 1
+                retire = tileCacheRetirer(number,self.tileCaches,
+                                          self.retiredTileStats,
+                                          self.tileCachesLock)
+                self.tileCaches[number] = (tileCache,weakref.ref(token,retire))
+            self.threadData.tileCache = tileCache
+            self.threadData.tileCacheToken = token
+            return tileCache
+
+
+    def openTile(self,tdi):
+        """Return the open file handle for tile number tdi, opening the
+        file if necessary.
+
+        If the file is not already open it is opened and added to the
+        calling thread's tile cache, which closes the least recently used
+        files if that takes it over MaxOpenFiles files or MaxOpenBytes bytes.
+
+        """
+        tileCache = self.getTileCache()
+        handle = tileCache.get(tdi)
+        info = getattr(self.threadData,'lookupInfo',None)
+        if info is not None:
+            info['tile'] = tdi
+            if handle is None:
+                info['tilemisses'] += 1
+            else:
+                info['tilehits'] += 1
+        if handle is None:
+            td = self.tilearr[tdi]
+            handle = self.openTileFile(td)
+            tileCache.put(tdi,handle,self.tileBytes(td))
+            if (self.debug):
+                print "Number of open files = %s" % len(tileCache)
+        return handle
+
+
+    def startLookupInfo(self):
+        """Start recording which tile the calling thread reads, and how
+        often its reads are answered from the tile and block caches -
+        used to write the access log.  See getLookupInfo().
+        """
+        self.threadData.lookupInfo = {'tile':None, 'points':0,
+                                      'tilehits':0, 'tilemisses':0,
+                                      'blockhits':0, 'blockmisses':0}
+
+
+    def getLookupInfo(self):
+        """Return the information recorded since the calling thread last
+        called startLookupInfo() (or None if it has not) - a dictionary of
+        the file name of the last tile read ('tile'), the number of points
+        looked up, and the numbers of tile and block cache hits and misses.
+        """
+        info = getattr(self.threadData,'lookupInfo',None)
+        if info is None:
+            return None
+        info = dict(info)
+        if info['tile'] is not None:
+            info['tile'] = self.tilearr[info['tile']]['fname']
+        return info
+
+
+    def setPointCache(self,maxpoints):
+        """Keep the results of up to maxpoints single point lookups (see
+        getElevation()) in self.pointCache, an LRU cache keyed on the
+        pixel (tile,row,col) which the point falls in, so that points which
+        are nearly the same share an entry.  maxpoints=0 switches the
+        cache off.  The data never changes, so the entries never go stale.
+        """
+        if int(maxpoints) > 0:
+            self.pointCache = LRUCache(maxpoints)
+        else:
+            self.pointCache = None
+
+
+    def getCacheStats(self):
+        """Return a dictionary of the statistics of the caches used by
+        this object (see LRUCache.getStats()), keyed on cache name.
+        The 'tiles' statistics are the totals for all of the threads,
+        with the hits, misses and evictions of the threads which have
+        exited.
+        """
+        with self.tileCachesLock:
+            tiles = sumStats([tileCache.getStats() for (tileCache,ref)
+                              in self.tileCaches.values()])
+            for (key,count) in self.retiredTileStats.items():
+                tiles[key] += count
+        tiles['hitratio'] = hitRatio(tiles)
+        stats = {'tiles':tiles}
+        if self.blockCache is not None:
+            stats['blocks'] = self.blockCache.getStats()
+        if self.pointCache is not None:
+            stats['points'] = self.pointCache.getStats()
+        return stats
+
+
+    def readTileData(self,tdi,col,row,ncols,nrows):
+        """Read a nrows x ncols array of data from the file of tile tdi,
+        starting at pixel (row,col), without using the block cache.
+        The time taken is recorded in self.readTimes.
+        """
+        handle = self.openTile(tdi)
+        tstart = time.time()
+        data = gdalnumeric.DatasetReadAsArray(handle,col,row,ncols,nrows)
+        self.readTimes.observe(time.time()-tstart)
+        return data
 
-        openFileCount = 0
-        for i in range(len(self.tilearr)):
-            td = self.tilearr[i]
-            if (td['handle']!=-1):
-                openFileCount += 1
-                if (self.debug):
-                    print "Found File Number %s" % openFileCount
-                if (openFileCount == fileno):
-                    if (self.debug):
-                        print "Closing File %s" % td['fname']
-                    #gdal.close(td['handle'])
-                        del self.tilearr[i]['handle']
-                        self.tilearr[i]['handle'] = -1
-                    self.NumOpenFiles -= 1
-        
-    
 
-    def getElevation(self,lat,lon,bilinear=False):
+    def getBlock(self,tdi,brow,bcol):
+        """Return block (brow,bcol) of tile tdi from the block cache,
+        reading it from the file if it is not there.
+
+        Block (brow,bcol) starts at pixel (brow*BlockSize,bcol*BlockSize);
+        blocks at the right and bottom edges of a tile are cut short.
+
+        """
+        key = (tdi,brow,bcol)
+        block = self.blockCache.get(key)
+        info = getattr(self.threadData,'lookupInfo',None)
+        if info is not None:
+            info['tile'] = tdi
+            if block is None:
+                info['blockmisses'] += 1
+            else:
+                info['blockhits'] += 1
+        if block is None:
+            td = self.tilearr[tdi]
+            bs = self.BlockSize
+            block = self.readTileData(tdi,bcol*bs,brow*bs,
+                                      min(bs,td['xsize']-bcol*bs),
+                                      min(bs,td['ysize']-brow*bs))
+            self.blockCache.put(key,block,block.nbytes)
+        return block
+
+
+    def readWindow(self,tdi,col,row,ncols,nrows):
+        """Return a nrows x ncols array of the raw tile data of tile tdi,
+        starting at pixel (row,col).
+
+        All reads of elevation data go through this function.
+        The data comes from the block cache, so neighbouring lookups
+        share one decoded block rather than each making a GDAL call.
+        A window that lies within one block is returned as a view of
+        the cached block, so must not be modified.
+
+        """
+        if self.blockCache is None:
+            return self.readTileData(tdi,col,row,ncols,nrows)
+        bs = self.BlockSize
+        brow0 = row/bs
+        bcol0 = col/bs
+        brow1 = (row+nrows-1)/bs
+        bcol1 = (col+ncols-1)/bs
+        if brow0 == brow1 and bcol0 == bcol1:
+            block = self.getBlock(tdi,brow0,bcol0)
+            return block[row-brow0*bs:row-brow0*bs+nrows,
+                         col-bcol0*bs:col-bcol0*bs+ncols]
+        htarr = None
+        for brow in range(brow0,brow1+1):
+            for bcol in range(bcol0,bcol1+1):
+                block = self.getBlock(tdi,brow,bcol)
+                if htarr is None:
+                    htarr = numpy.empty((nrows,ncols),dtype=block.dtype)
+                # Overlap of the block and the window, in tile pixels.
+                r0 = max(row,brow*bs)
+                r1 = min(row+nrows,brow*bs+block.shape[0])
+                c0 = max(col,bcol*bs)
+                c1 = min(col+ncols,bcol*bs+block.shape[1])
+                htarr[r0-row:r1-row,c0-col:c1-col] = \
+                    block[r0-brow*bs:r1-brow*bs,c0-bcol*bs:c1-bcol*bs]
+        return htarr
+
+
+    def getElevation(self,lat,lon,bilinear=False,bicubic=False):
         """Returns the elevation in metres of point (lat,lon).
         Uses bilinar interpolation to interpolate the SRTM data to the
-        required point if bilinear=True, otherwise uses single point.
+        required point if bilinear=True, bicubic (Catmull-Rom) interpolation
+        if bicubic=True, otherwise uses single point.
 
         An error (-999) is returned if the location is not covered by any
-        of the loaded tiles.
+        of the loaded tiles.  Single point lookups are answered from the
+        point cache if there is one (see setPointCache()).
 
         """
+        info = getattr(self.threadData,'lookupInfo',None)
+        if info is not None:
+            info['points'] += 1
         tdi = self.getTileIndex(lat,lon)
         if (tdi == -999):
             if (self.verbose):
@@ -191,44 +449,29 @@ class srtm_tiff:
             return -999
         else:
             td = self.tilearr[tdi]
-            fname = td['fname']
-            """ 
-            If the required file is not open, open it.
-            But if we are already have the maximum number of files open,
-            we have to close one first
-            """
-            if (td['handle'] == -1):
-                if (self.debug):
-                    print "Required file is closed"
-                if (self.NumOpenFiles >= self.MaxOpenFiles):
-                    if (self.debug):
-                        print "Maximum number of open files reached - closing one first"
-                    self.closeAFile()
-                else:
-                    if (self.debug):
-                        print "Number of open files ok - NumOpenFiles = %s, MaxOpenFiles=%s" % \
-                            (self.NumOpenFiles, self.MaxOpenFiles)
-                if (self.debug):
-                    print "Opening file %s" % fname
-                td['handle'] = gdal.Open(fname)
-                self.NumOpenFiles += 1
-                if (self.debug):
-                    print "NumOpenFiles = %s" % self.NumOpenFiles
-            else:
-                if (self.debug):
-                    print "File already open - NumOpenFiles = %s" % self.NumOpenFiles
+            halo = td['halo']
             (row,col,row_f,col_f) = self.posFromLatLon(lat,lon, td)
             if (self.verbose):
                 print "row=%s, col=%s,row_f=%s,col_f=%s" % (row,col,row_f,col_f)
-            if (bilinear):
+            # NOTE - Interpolation needs pixels beyond the edge of the tile.
+            # If the tile has a halo (see srtm_raw) they are there, otherwise
+            # we fiddle the position to stay inside the tile, which is not
+            # correct - we should get the points from the next tile.
+            if (bicubic):
+                if (self.debug):
+                    print "Using bicubic interpolation to find height"
+                row = max(min(row,td['ysize']-3+halo),1-halo)
+                col = max(min(col,td['xsize']-3+halo),1-halo)
+                htarr=self.readWindow(tdi,col-1,row-1,4,4)
+                if (self.debug):
+                    print htarr
+                height = bicubicInterpolation(htarr,row_f-row,col_f-col)
+            elif (bilinear):
                 if (self.debug):
                     print "Using bilinear interpolation to find height"
-                    # NOTE - THIS IS A FIDDLE TO STOP ERRORS AT THE EDGE OF
-                    # TILES - IT IS NO CORRECT - WE SHOULD GET TWO POINTS 
-                    # FROM THE NEXT TILE.
-                if row==5999: row=5998
-                if col==5999: col=5998
-                htarr=gdalnumeric.DatasetReadAsArray(td['handle'],col,row,2,2)
+                row = min(row,td['ysize']-2+halo)
+                col = min(col,td['xsize']-2+halo)
+                htarr=self.readWindow(tdi,col,row,2,2)
                 if (self.debug):
                     print htarr
                 height = bilinearInterpolation(htarr[0][0],
@@ -239,12 +482,150 @@ class srtm_tiff:
             else:
                 if (self.debug):
                     print "Using single point to get height"
-                htarr=gdalnumeric.DatasetReadAsArray(td['handle'],col,row,1,1)
+                pointCache = self.pointCache
+                if pointCache is not None:
+                    height = pointCache.get((tdi,row,col))
+                    if height is not None:
+                        if info is not None:
+                            info['tile'] = tdi
+                        return height
+                htarr=self.readWindow(tdi,col,row,1,1)
                 height = htarr[0][0]
+                if pointCache is not None:
+                    pointCache.put((tdi,row,col),height)
             return height
          
         return -999
 
+
+    def getTileIndices(self,lats,lons):
+        """Vectorised version of getTileIndex() - returns an integer array
+        of the tile index of each point in the arrays lats and lons, with
+        -999 for points which are not covered by any tile.
+
+        The points are grouped by degree cell, so the tile index is only
+        consulted once per cell rather than once per point.
+
+        """
+        tdis = numpy.empty(len(lats),dtype=int)
+        tdis.fill(-999)
+        valid = numpy.nonzero(numpy.isfinite(lats) & numpy.isfinite(lons))[0]
+        if len(valid) == 0:
+            return tdis
+        ilats = numpy.floor(lats[valid]).astype(int)
+        ilons = numpy.floor(lons[valid]).astype(int)
+        (cells,first,inverse) = numpy.unique(ilats*1000+ilons,
+                                             return_index=True,
+                                             return_inverse=True)
+        for c in range(len(cells)):
+            cell = (ilats[first[c]],ilons[first[c]])
+            incell = valid[inverse == c]
+            for i in self.tileIndex.get(cell,()):
+                td = self.tilearr[i]
+                pts = incell[tdis[incell] == -999]
+                if len(pts) == 0:
+                    break
+                fits = (lats[pts]<=td['N']) & (lats[pts]>=td['S']) & \
+                       (lons[pts]<=td['E']) & (lons[pts]>=td['W'])
+                tdis[pts[fits]] = i
+        return tdis
+
+
+    def getElevations(self,lats,lons,bilinear=False,bicubic=False):
+        """Returns the elevations in metres of a set of points.
+
+        lats and lons are sequences (or NumPy arrays) of the same length.
+        This gives the same answers as calling getElevation() for each
+        point, but the points are grouped by tile and the data around them
+        is read a block at a time (see tileElevations()), after which the
+        single point, bilinear or bicubic values are worked out with NumPy array
+        operations.  Use this rather than getElevation() when you have
+        more than a handful of points.
+
+        Returns a tuple (eles,outside) - eles is an array of elevations,
+        and outside is a boolean array which is True for the points that
+        are not covered by any of the tiles (eles is -999 for these).
+
+        """
+        lats = numpy.asarray(lats,dtype=float).ravel()
+        lons = numpy.asarray(lons,dtype=float).ravel()
+        eles = numpy.empty(len(lats),dtype=float)
+        eles.fill(-999)
+        info = getattr(self.threadData,'lookupInfo',None)
+        if info is not None:
+            info['points'] += len(lats)
+        tdis = self.getTileIndices(lats,lons)
+        outside = (tdis == -999)
+        for tdi in numpy.unique(tdis[~outside]):
+            pts = numpy.nonzero(tdis == tdi)[0]
+            if (self.verbose):
+                print "getElevations - %s points in tile %s" % (len(pts),tdi)
+            eles[pts] = self.tileElevations(tdi,lats[pts],lons[pts],
+                                            bilinear,bicubic)
+        return (eles,outside)
+
+
+    def tileElevations(self,tdi,lats,lons,bilinear=False,bicubic=False):
+        """Returns an array of the elevations of points (lats,lons), which
+        must all lie within tile tdi.
+
+        Array version of the calculation done in getElevation().  The
+        points are grouped by the BlockSize x BlockSize block their
+        neighbourhood starts in, and one small readWindow() is made per
+        group, so a few points scattered over a big tile do not read (or
+        fill the block cache with) the whole window between them.  Only
+        the samples around each point are converted to float.
+
+        """
+        td = self.tilearr[tdi]
+        rows_f = (lats-td['N'])/td['lat_pixel']
+        cols_f = (lons-td['W'])/td['lon_pixel']
+        # The interpolation needs the pixels from 'before' above and to the
+        # left of the point to 'after' below and to the right, which may be
+        # in the halo (if any).
+        if (bicubic):
+            (before,after,halo) = (1,2,td['halo'])
+        elif (bilinear):
+            (before,after,halo) = (0,1,td['halo'])
+        else:
+            (before,after,halo) = (0,0,0)
+        rows = numpy.clip(numpy.floor(rows_f).astype(int),
+                          before-halo,td['ysize']-1-after+halo)
+        cols = numpy.clip(numpy.floor(cols_f).astype(int),
+                          before-halo,td['xsize']-1-after+halo)
+        # samples[k,i,j] is the pixel i-before rows down and j-before
+        # columns across from point k.
+        n = before+after+1
+        samples = numpy.empty((len(rows),n,n),dtype=float)
+        bs = self.BlockSize
+        # The halo puts the first pixels in block -1, hence the +1.
+        keys = ((rows-before)//bs+1)*(td['xsize']//bs+3) + \
+               (cols-before)//bs+1
+        order = numpy.argsort(keys,kind='mergesort')
+        bounds = numpy.nonzero(numpy.diff(keys[order]))[0]+1
+        for pts in numpy.split(order,bounds):
+            row0 = rows[pts].min()-before
+            col0 = cols[pts].min()-before
+            htarr = self.readWindow(tdi,col0,row0,
+                                    cols[pts].max()+after-col0+1,
+                                    rows[pts].max()+after-row0+1)
+            # (r,c) is the top left of each point's samples in htarr.
+            r = rows[pts]-before-row0
+            c = cols[pts]-before-col0
+            for i in range(n):
+                for j in range(n):
+                    samples[pts,i,j] = htarr[r+i,c+j]
+        if (bicubic):
+            p = [[samples[:,i,j] for j in range(4)] for i in range(4)]
+            return bicubicInterpolation(p,rows_f-rows,cols_f-cols)
+        elif (bilinear):
+            return bilinearInterpolation(samples[:,0,0],samples[:,0,1],
+                                         samples[:,1,0],samples[:,1,1],
+                                         rows_f-rows,cols_f-cols)
+        else:
+            return samples[:,0,0]
+
+
     def posFromLatLon(self,lat,lon,td):
         """Converts coordinates (lat,lon) into the appropriate (row,column)
         position in the GeoTIFF tile data stored in td.
@@ -272,15 +653,34 @@ class srtm_tiff:
         # Error checking to correct any rounding errors.
         if (rowno<0):
             rowno = 0
-        if (rowno>(xsize-1)):
-            rowno = xsize-1
+        if (rowno>(ysize-1)):
+            rowno = ysize-1
         if (colno<0):
             colno = 0
-        if (colno>(ysize-1)):
+        if (colno>(xsize-1)):
             colno = xsize-1
             
         return (rowno,colno,rowno_f,colno_f)
 
+class threadToken:
+    "An object held only by a thread's local data - see getTileCache()."
+    pass
+
+
+def tileCacheRetirer(number,tileCaches,retiredStats,lock):
+    """Return the weakref callback which removes tile cache number from
+    dictionary tileCaches when its thread exits, adding its counts to
+    retiredStats.  It refers to the dictionaries rather than to the
+    srtm_tiff object, so that the object is not kept alive by it."""
+    def retire(ref):
+        with lock:
+            (tileCache,ref) = tileCaches.pop(number)
+            stats = tileCache.getStats()
+            for key in retiredStats:
+                retiredStats[key] += stats[key]
+    return retire
+
+
 def bilinearInterpolation(tl, tr, bl, br, a, b):
   # GJ Shamelessly plagiarised from route_altitude_profile/trunk/server/altitude.py
   # In the likely case that the coordinate is somewhere between
@@ -300,6 +700,36 @@ def bilinearInterpolation(tl, tr, bl, br, a, b):
   return b1 + b2 * a + b3 * b + b4 * a * b
 
 
+def cubicWeights(t):
+    """Return the four Catmull-Rom weights for the samples at -1, 0, 1
+    and 2 of a point a fraction t of the way from sample 0 to sample 1.
+    t may be a number or a NumPy array.
+    """
+    t2 = t*t
+    t3 = t2*t
+    return ((-t3 + 2.*t2 - t)/2.,
+            (3.*t3 - 5.*t2 + 2.)/2.,
+            (-3.*t3 + 4.*t2 + t)/2.,
+            (t3 - t2)/2.)
+
+
+def bicubicInterpolation(p, a, b):
+    """Bicubic (Catmull-Rom) interpolation on the 4x4 grid of samples p,
+    where p[i][j] is at row i-1, column j-1, for a point a fraction a of
+    a row down and b of a column across from p[1][1].
+
+    The elements of p and a, b may be numbers, or NumPy arrays to
+    interpolate many points at once.
+    """
+    wa = cubicWeights(a)
+    wb = cubicWeights(b)
+    height = 0.
+    for i in range(4):
+        height = height + wa[i]*(wb[0]*p[i][0] + wb[1]*p[i][1] +
+                                 wb[2]*p[i][2] + wb[3]*p[i][3])
+    return height
+
+
 def getBBox(fname):
     """Open GeoTIFF file fname and return its bounding box
     (N,S,E,W) and its pixel height and with (lat_pixel,lon_pixel) in degrees and the
@@ -376,6 +806,8 @@ if __name__ == '__main__':
                       help="longitude of point")
     parser.add_option("--maxfiles", dest="maxfiles",
                       help="maximum number of open files")
+    parser.add_option("--maxbytes", dest="maxbytes",
+                      help="maximum total decoded size of open files (bytes, 0=no limit)")
     parser.add_option("-b", "--bilinear", action="store_true",dest="bilinear",
                       help="Use bilinear interpolation to improve accuracy (slower)")
     parser.add_option("-t", "--test", action="store_true",dest="test",
@@ -392,6 +824,7 @@ if __name__ == '__main__':
                         lat="54",
                         lon="-1",
                         maxfiles="10",
+                        maxbytes="0",
                         bilinear=False,
                         test=False,
                         bigtest=0,
@@ -413,57 +846,53 @@ if __name__ == '__main__':
     else:
     
                 
-        srtm = srtm_tiff(options.filename,options.maxfiles,options.verbose,options.debug)
+        srtm = srtm_tiff(options.filename,options.maxfiles,options.verbose,options.debug,
+                         options.maxbytes)
 
 
 
         if (options.bigtest != 0):
             options.test = True
 
-            if (options.test == False):
-                lat = float(options.lat)
-                lon = float(options.lon)
+        if (options.test == False):
+            lat = float(options.lat)
+            lon = float(options.lon)
+            ele = srtm.getElevation(lat,lon,options.bilinear)
+            print "Elevation of point (%s,%s) is %d\n\n" % (lat,lon,ele)
+        else:
+            print "Test Cases"
+            testcases = ( (54, -1), (54, -2), (54, -3), \
+                              (53,-1), (53,-2), (53,-3), \
+                              (52,-1), (52,-2), (52,-3), \
+                              #                          (51,-1), (51,-2), (51,-3), \
+                              #                          (50,-1), (50,-2), (50,-3), \
+                              #                          (59,-6), (59,-7), (59,-8), \
+                              #                          (54,-6), (54,-7), (54,-8), \
+                              #                          (59,-1), (59,-2), (59,-3), \
+                              (54,1), (54,2), (54,3) \
+                              #                          (49,-1), (49,-2), (49,-3) \
+                              )
+            print testcases
+            for case in testcases:
+                (lat,lon) = case
+                print "lat=%s lon=%s" % (lat,lon)
                 ele = srtm.getElevation(lat,lon,options.bilinear)
-                if (options.bilinear):
-                    print "WARNING!!!!!:  Although this prints an answer, it doesn't work!!!"
-                    print "Elevation of point (%s,%s) is %d\n\n" % (lat,lon,ele)
-            else:
-                print "Test Cases"
-                testcases = ( (54, -1), (54, -2), (54, -3), \
-                                  (53,-1), (53,-2), (53,-3), \
-                                  (52,-1), (52,-2), (52,-3), \
-                                  #                          (51,-1), (51,-2), (51,-3), \
-                                  #                          (50,-1), (50,-2), (50,-3), \
-                                  #                          (59,-6), (59,-7), (59,-8), \
-                                  #                          (54,-6), (54,-7), (54,-8), \
-                                  #                          (59,-1), (59,-2), (59,-3), \
-                                  (54,1), (54,2), (54,3) \
-                                  #                          (49,-1), (49,-2), (49,-3) \
-                                  )
-                print testcases
-                for case in testcases:
-                    (lat,lon) = case
-                    print "lat=%s lon=%s" % (lat,lon)
+                print "Elevation of point (%s,%s) is %d\n\n" % (lat,lon,ele)
+
+            if (options.bigtest != 0):
+                numtests = int(options.bigtest)
+                print "Running Time Test - numtests=%s" % numtests
+                tstart = default_timer()
+                for i in range(numtests):
+                    lat = random.uniform(50,60)
+                    lon = random.uniform(-10, 5)
                     ele = srtm.getElevation(lat,lon,options.bilinear)
-                    print "Elevation of point (%s,%s) is %d\n\n" % (lat,lon,ele)
-                        
-                if (options.bigtest != 0):
-                    numtests = int(options.bigtest)
-                    print "Running Time Test - numtests=%s" % numtests
-                    tstart = clock()
-                    print "tstart=%s" % tstart
-                    for i in range(1, numtests):
-                        lat = random.uniform(50,60)
-                        lon = random.uniform(-10, 5)
-                        ele = srtm.getElevation(lat,lon,options.bilinear)
-                        
-                        
-                    tend = clock()
-                    print "tend=%s" % tend
-                    total_ms = 1000.*(tend-tstart)
-                    timePerTest = total_ms / numtests
-                    print "Total time = %s ms" % (total_ms)
-                    print "Time per elevation measurement = %s ms" % timePerTest
+                tend = default_timer()
+                total_ms = 1000.*(tend-tstart)
+                timePerTest = total_ms / numtests
+                print "Total time = %s ms" % (total_ms)
+                print "Time per elevation measurement = %s ms" % timePerTest
+                print "(benchmark.py gives repeatable timings with synthetic tiles)"
 
 
         if options.profile:
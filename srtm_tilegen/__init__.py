@@ -0,0 +1,9 @@
+"""
+The map tile renderer - srtm_tilegen.py renders tiles from the command
+line, and the elevation servers import tilerender and pyramid from this
+package to render tiles on demand (see tilecache.py).
+
+The modules import each other by their plain names, so they also work
+when srtm_tilegen.py is run as a script from this directory.
+
+"""
@@ -0,0 +1,350 @@
+#!/usr/bin/python
+#-------------------------------------------------------
+# Renders a pyramid of map tiles in parallel, and can resume an
+# interrupted run.
+#
+# renderPyramid() works through the tiles from the requested tile down to
+# the maximum zoom level a block of neighbouring tiles at a time (so that
+# the tiles a worker process is given read the same few data files),
+# and renders the blocks in a pool of worker processes, each with its own
+# srtm_tiff object.  The blocks are produced as the pool asks for them,
+# so rendering starts straight away however big the pyramid is.  Every
+# finished tile is recorded in a manifest file in the output directory,
+# so a run which is interrupted starts again where it left off without
+# having to look for the tile files.
+#
+# In overview mode (options.overview) only the tiles of the maximum zoom
+# level are sampled from the data.  The levels above are rendered one at
+# a time, working upwards, from the elevations of each tile's four
+# children (saved in the elevations directory until the parent is done),
+# so the cost of a level is proportional to its number of tiles, rather
+# than to the area of data it covers.
+#-------------------------------------------------------
+import os
+import sys
+import time
+import errno
+import signal
+import shutil
+import collections
+import multiprocessing
+from math import floor
+from cStringIO import StringIO
+import numpy
+from tilenames import tileEdges
+from srtm_tiff3 import srtm_tiff
+from tilerender import TILE_SIZE, tileElevations, downsample, renderElevations, \
+     renderTile
+
+MANIFEST = 'manifest.txt'
+ELEVATIONS = 'elevations'   # directory of the overview mode's elevations.
+OVERVIEW_METHODS = ('mean','min','max')
+BATCH_LEVELS = 3          # a worker is given blocks of 2**BATCH_LEVELS square tiles.
+REPORT_INTERVAL = 10.0    # seconds between progress reports.
+POOL_WAIT = 3600.0        # seconds to wait for a batch from the pool.
+QUEUED_BATCHES = 2        # batches handed to the pool per worker process.
+
+def tileFileName(outputdir,tile_X,tile_Y,Z):
+    return "%s/%d/%d/%d.png" % (outputdir,Z,tile_X,tile_Y)
+
+
+def elevationFileName(outputdir,tile_X,tile_Y,Z):
+    return "%s/%s/%d/%d/%d.npy" % (outputdir,ELEVATIONS,Z,tile_X,tile_Y)
+
+
+def writeFile(fname,data):
+    """Write string data to file fname, creating its directory if need be.
+    It is written under a temporary name first, so an interrupted run
+    never leaves a partly written file in place."""
+    try:
+        os.makedirs(os.path.dirname(fname))
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    tmpfname = "%s.%d.tmp" % (fname,os.getpid())
+    f = open(tmpfname,"wb")
+    f.write(data)
+    f.close()
+    os.rename(tmpfname,fname)
+
+
+def childTiles(tile_X,tile_Y,Z):
+    "Return the four tiles (Z,X,Y) one zoom level below tile (tile_X,tile_Y,Z)."
+    return [(Z+1,2*tile_X+dx,2*tile_Y+dy) for dy in (0,1) for dx in (0,1)]
+
+
+def childElevations(srtm,outputdir,tile_X,tile_Y,Z,size=TILE_SIZE):
+    """Return the 2*size x 2*size array of the elevations of the four
+    children of tile (tile_X,tile_Y,Z), read from the files saved when
+    they were rendered.  A child without a file (if the run it was
+    rendered in was interrupted just after its parent was finished, say)
+    is sampled from srtm again."""
+    eles = numpy.empty((2*size,2*size),numpy.float32)
+    for (z,x,y) in childTiles(tile_X,tile_Y,Z):
+        fname = elevationFileName(outputdir,x,y,z)
+        try:
+            child = numpy.load(fname)
+        except IOError:
+            child = tileElevations(srtm,x,y,z,size)
+        row = (y-2*tile_Y)*size
+        col = (x-2*tile_X)*size
+        eles[row:row+size,col:col+size] = child
+    return eles
+
+
+def pyramidSize(Z,maxzoom):
+    "Return the number of tiles in a pyramid from zoom level Z to maxzoom."
+    return sum([4**(z-Z) for z in range(Z,maxzoom+1)])
+
+
+def inPyramid(tile,tile_X,tile_Y,Z,maxzoom):
+    "Return True if tile (Z,X,Y) is in the pyramid below tile (tile_X,tile_Y,Z)."
+    (z,x,y) = tile
+    return Z <= z <= maxzoom and x >> (z-Z) == tile_X and y >> (z-Z) == tile_Y
+
+
+def overlapsData(srtm,tile_X,tile_Y,Z):
+    """Return True if tile (tile_X,tile_Y,Z) overlaps any of srtm's data
+    tiles - only the data tiles in the degree cells it covers (see
+    srtm_tiff.buildTileIndex()) are checked."""
+    (S,W,N,E) = tileEdges(tile_X,tile_Y,Z)
+    for ilat in range(int(floor(S)),int(floor(N))+1):
+        for ilon in range(int(floor(W)),int(floor(E))+1):
+            for i in srtm.tileIndex.get((ilat,ilon),()):
+                td = srtm.tilearr[i]
+                if td['S'] <= N and td['N'] >= S and \
+                   td['W'] <= E and td['E'] >= W:
+                    return True
+    return False
+
+
+def levelBatches(srtm,tile_X,tile_Y,Z,z,done,covered,counts):
+    """Generate the batches of tiles (lists of (Z,X,Y)) of zoom level z of
+    the pyramid below tile (tile_X,tile_Y,Z) which are still to be
+    rendered.  Each batch is the tiles of a block of up to 2**BATCH_LEVELS
+    square tiles - itself a tile of a lower zoom level - and the blocks
+    are worked along row by row.
+
+    The tiles in set done are left out, and if covered is set so are
+    tiles which do not overlap srtm's data (whole blocks at a time where
+    possible), counting them in counts['nodata'].
+    """
+    bz = max(z-BATCH_LEVELS,Z)
+    (nblocks,size) = (2**(bz-Z),2**(z-bz))
+    for by in xrange(tile_Y*nblocks,(tile_Y+1)*nblocks):
+        for bx in xrange(tile_X*nblocks,(tile_X+1)*nblocks):
+            blockCovered = not covered or overlapsData(srtm,bx,by,bz)
+            batch = []
+            for y in range(by*size,(by+1)*size):
+                for x in range(bx*size,(bx+1)*size):
+                    if (z,x,y) in done:
+                        continue
+                    if not blockCovered or \
+                       (covered and not overlapsData(srtm,x,y,z)):
+                        counts['nodata'] += 1
+                        continue
+                    batch.append((z,x,y))
+            if batch:
+                yield batch
+
+
+def pyramidBatches(srtm,tile_X,tile_Y,Z,maxzoom,done,covered,counts):
+    """Generate the batches of all of the zoom levels of the pyramid below
+    tile (tile_X,tile_Y,Z) (see levelBatches())."""
+    for z in range(Z,maxzoom+1):
+        for batch in levelBatches(srtm,tile_X,tile_Y,Z,z,done,covered,counts):
+            yield batch
+
+
+def readManifest(fname):
+    """Return the set of the tiles (Z,X,Y) listed in manifest fname, or an
+    empty set if there is no manifest."""
+    done = set()
+    if not os.path.isfile(fname):
+        return done
+    for line in open(fname):
+        if not line.endswith('\n'):
+            continue     # a line cut short when the run was interrupted.
+        try:
+            (z,x,y) = [int(v) for v in line.split()]
+        except ValueError:
+            continue
+        done.add((z,x,y))
+    return done
+
+
+def formatTime(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds/3600,(seconds/60)%60,seconds%60)
+
+
+# The elevation data and render options of a worker process - set by
+# initWorker(), as the srtm_tiff object can not be shared between processes.
+workerState = {}
+
+def initWorker(filename,outputdir,minele,maxele,overview=None,
+               minzoom=0,maxzoom=0,layer='elevation'):
+    # Leave ^C to the parent process, which stops the pool.
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+    workerState['srtm'] = srtm_tiff(filename,10,False,False)
+    workerState['outputdir'] = outputdir
+    workerState['minele'] = minele
+    workerState['maxele'] = maxele
+    workerState['overview'] = overview
+    workerState['minzoom'] = minzoom
+    workerState['maxzoom'] = maxzoom
+    workerState['layer'] = layer
+
+
+def renderBatch(tiles):
+    """Render tiles (a list of (Z,X,Y)) in a worker process, and return
+    the list of the tiles rendered."""
+    srtm = workerState['srtm']
+    outputdir = workerState['outputdir']
+    overview = workerState['overview']
+    layer = workerState['layer']
+    for (z,x,y) in tiles:
+        if layer != 'elevation':
+            writeFile(tileFileName(outputdir,x,y,z),
+                      renderTile(srtm,x,y,z,workerState['minele'],
+                                 workerState['maxele'],layer=layer))
+            continue
+        if overview and z < workerState['maxzoom']:
+            eles = downsample(childElevations(srtm,outputdir,x,y,z),overview)
+        else:
+            eles = tileElevations(srtm,x,y,z)
+        writeFile(tileFileName(outputdir,x,y,z),
+                  renderElevations(eles,workerState['minele'],
+                                   workerState['maxele']))
+        if overview and z > workerState['minzoom']:
+            # Keep the elevations for the parent tile.
+            buf = StringIO()
+            numpy.save(buf,eles.astype(numpy.float32))
+            writeFile(elevationFileName(outputdir,x,y,z),buf.getvalue())
+    return tiles
+
+
+def poolBatches(pool,procs,batches):
+    """Generate the results of renderBatch() for each of batches (an
+    iterable of lists of tiles), rendered by pool, in order.
+
+    Only QUEUED_BATCHES batches per worker process are handed to the pool
+    at a time, so batches is only read as far as the pool has got, and
+    the pool's task queue never fills up - Pool.terminate() can hang when
+    it has.  The results are waited for with a timeout, as waiting without
+    one can not be interrupted with ^C.
+    """
+    pending = collections.deque()
+    for batch in batches:
+        pending.append(pool.apply_async(renderBatch,(batch,)))
+        if len(pending) >= QUEUED_BATCHES*procs:
+            yield pending.popleft().get(POOL_WAIT)
+    while pending:
+        yield pending.popleft().get(POOL_WAIT)
+
+
+def removeChildElevations(outputdir,tiles):
+    "Delete the elevation files of the children of tiles, once they are done."
+    for (z,x,y) in tiles:
+        for (cz,cx,cy) in childTiles(x,y,z):
+            try:
+                os.remove(elevationFileName(outputdir,cx,cy,cz))
+            except OSError:
+                pass
+
+
+def renderPyramid(options,srtm,tile_X,tile_Y,Z):
+    """Render the pyramid of tiles from (tile_X,tile_Y,Z) down to
+    options.maxzoom into options.outputdir, with options.procs worker
+    processes (0 to render them in this process).
+
+    The tiles already listed in the manifest are skipped, unless
+    options.rerender is set, in which case the manifest is started again.
+    If options.covered is set, tiles which do not overlap the data are
+    not rendered at all (rather than being rendered as no data).  If
+    options.overview is one of OVERVIEW_METHODS, the tiles above the
+    maximum zoom level are made from their children's elevations with
+    that method.  options.layer (one of tilerender.LAYERS) is the layer
+    rendered - overview mode only works for the elevation layer.
+    """
+    outputdir = options.outputdir
+    if not os.path.isdir(outputdir):
+        os.makedirs(outputdir)
+    manifest = os.path.join(outputdir,MANIFEST)
+    if options.rerender:
+        done = set()
+        manifestFile = open(manifest,"w")
+    else:
+        done = readManifest(manifest)
+        manifestFile = open(manifest,"a")
+    maxzoom = int(options.maxzoom)
+    overview = getattr(options,'overview',None)
+    layer = getattr(options,'layer','elevation')
+    if overview and layer != 'elevation':
+        raise ValueError("overview mode only works for the elevation layer")
+
+    total = pyramidSize(Z,maxzoom)
+    ndone = len([tile for tile in done
+                 if inPyramid(tile,tile_X,tile_Y,Z,maxzoom)])
+    print "%d tiles in the pyramid - %d rendered already, up to %d to render" % \
+        (total,ndone,total-ndone)
+    covered = getattr(options,'covered',False)
+    counts = {'nodata':0}
+
+    # A zoom level can only be made from the one below once that is
+    # finished, so in overview mode the levels are rendered in turn.
+    if overview:
+        levels = [levelBatches(srtm,tile_X,tile_Y,Z,z,done,covered,counts)
+                  for z in range(maxzoom,Z-1,-1)]
+    else:
+        levels = [pyramidBatches(srtm,tile_X,tile_Y,Z,maxzoom,done,covered,
+                                 counts)]
+    procs = int(options.procs)
+    initArgs = (options.filename,outputdir,
+                float(options.minele),float(options.maxele),
+                overview,Z,maxzoom,layer)
+    if procs > 0:
+        pool = multiprocessing.Pool(procs,initWorker,initArgs)
+    else:
+        pool = None
+        initWorker(*initArgs)
+
+    rendered = 0
+    tstart = time.time()
+    lastReport = tstart
+    try:
+        for batches in levels:
+            if pool is not None:
+                results = poolBatches(pool,procs,batches)
+            else:
+                results = (renderBatch(batch) for batch in batches)
+            for batch in results:
+                manifestFile.write(''.join(["%d %d %d\n" % tile for tile in batch]))
+                manifestFile.flush()
+                if overview:
+                    removeChildElevations(outputdir,batch)
+                rendered += len(batch)
+                now = time.time()
+                if now - lastReport >= REPORT_INTERVAL:
+                    lastReport = now
+                    rate = rendered/max(now-tstart,1e-6)
+                    togo = total - ndone - counts['nodata'] - rendered
+                    print "%d tiles rendered, up to %d to go - %.1f tiles/s, ETA %s" % \
+                        (rendered,togo,rate,formatTime(togo/rate))
+                    sys.stdout.flush()
+    except KeyboardInterrupt:
+        print "Interrupted - %d tiles rendered, run again to resume" % rendered
+        if pool is not None:
+            pool.terminate()
+            pool = None
+        raise
+    finally:
+        manifestFile.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print "%d tiles rendered, %d without data - %.1f tiles/s" % \
+        (rendered,counts['nodata'],rendered/max(time.time()-tstart,1e-6))
+    if overview:
+        shutil.rmtree(os.path.join(outputdir,ELEVATIONS),True)
+    return rendered
@@ -4,8 +4,15 @@
 from optparse import OptionParser
 from tilenames import *
 from srtm_tiff3 import srtm_tiff
-import gd
+from tilerender import renderTile, LAYERS
+from pyramid import renderPyramid, OVERVIEW_METHODS
+import multiprocessing
+try:
+    import gd
+except ImportError:
+    gd = None   # only needed for the old per-pixel renderer (--gd).
 import os
+import sys
 
 from math import *
 import matplotlib
@@ -14,20 +21,17 @@ import pylab
 from numpy import *
 
 def rendertile(options,srtm,tile_X,tile_Y,Z):
+    """Render map tile (tile_X,tile_Y,Z), and the tiles beneath it down to
+    options.maxzoom, into options.outputdir/Z/X/Y.png.  The tiles are
+    rendered with tilerender.renderTile(), unless options.gd is set, when
+    the old per-pixel gd renderer is used.
+    """
     nw_latlon=xy2latlon(tile_X,tile_Y,Z)
     se_latlon=xy2latlon(tile_X+1,tile_Y+1,Z)
 
     print "nw corner of tile is %f, %f" % nw_latlon
     print "sw corner of tile is %f, %f" % se_latlon
 
-    eleArr = zeros([256,256],float)
-    im = gd.image((256, 256))
-    white = im.colorAllocate((255, 255, 255))
-    black = im.colorAllocate((0,0,0))
-    blue  = im.colorAllocate((0,0,255))
-    im.colorTransparent(white)
-    im.interlace(1)
-
     tileoutdir = "%s/%d/%d" % (options.outputdir,Z,tile_X)
     print "tileoutdir=%s" % tileoutdir
     if not os.path.isdir(tileoutdir):
@@ -39,36 +43,14 @@ def rendertile(options,srtm,tile_X,tile_Y,Z):
     #
     if os.path.isfile(fname) and not options.rerender:
         print "%s exists already - skipping..." % fname
+    elif getattr(options,'gd',False):
+        rendertile_gd(options,srtm,tile_X,tile_Y,Z,fname)
     else:
-        for px_x in range (0, 256):
-            for px_y in range(0,256):
-                px_X = tile_X + px_x/256.
-                px_Y = tile_Y + px_y/256.
-                px_latlon = xy2latlon(px_X,px_Y,Z)
-                ele = srtm.getElevation(px_latlon[0],px_latlon[1],True)
-                eleArr[px_x][px_y] = ele
-                if ele<0: eleArr[px_x][px_y]=0.0
-
-                if (options.debug): 
-                    print "px=(%d,%d), latlon=(%f,%f), ele=%f, colval=%d" % \
-                        (px_x,px_y,px_latlon[0],px_latlon[1],ele,colval)
-                if (ele<0):
-                    im.setPixel((px_x,px_y),blue)
-                elif (ele<options.minele):
-                    im.setPixel((px_x,px_y),white)
-                elif (ele>float(options.maxele)):
-                    im.setPixel((px_x,px_y),black)
-                else:
-                    colval = 100-int(100.0*(ele-options.minele)/(float(options.maxele)-float(options.minele)))
-                    im.setPixel((px_x,px_y),im.colorResolve((0,colval,0)))
-        f=open(fname,"w")
-        im.writePng(f)
+        png = renderTile(srtm,tile_X,tile_Y,Z,options.minele,options.maxele)
+        f=open(fname,"wb")
+        f.write(png)
         f.close()
 
-#        pylab.contour(eleArr)
-#        pylab.savefig(fname)
-#        pylab.show()
-
     # If we have not got down to the maximum zoom level,
     # Render the next zoom level down (4 sub tiles beneath the current one).
     if Z<int(options.maxzoom):
@@ -80,6 +62,48 @@ def rendertile(options,srtm,tile_X,tile_Y,Z):
         rendertile(options,srtm,2*tile_X+1,2*tile_Y+1,Z+1)
 
 
+def rendertile_gd(options,srtm,tile_X,tile_Y,Z,fname):
+    """Render tile (tile_X,tile_Y,Z) into file fname one pixel at a time
+    with gd - the original renderer, which is much slower than
+    tilerender.renderTile() and needs the gd module."""
+    eleArr = zeros([256,256],float)
+    im = gd.image((256, 256))
+    white = im.colorAllocate((255, 255, 255))
+    black = im.colorAllocate((0,0,0))
+    blue  = im.colorAllocate((0,0,255))
+    im.colorTransparent(white)
+    im.interlace(1)
+
+    for px_x in range (0, 256):
+        for px_y in range(0,256):
+            px_X = tile_X + px_x/256.
+            px_Y = tile_Y + px_y/256.
+            px_latlon = xy2latlon(px_X,px_Y,Z)
+            ele = srtm.getElevation(px_latlon[0],px_latlon[1],True)
+            eleArr[px_x][px_y] = ele
+            if ele<0: eleArr[px_x][px_y]=0.0
+
+            if (options.debug): 
+                print "px=(%d,%d), latlon=(%f,%f), ele=%f, colval=%d" % \
+                    (px_x,px_y,px_latlon[0],px_latlon[1],ele,colval)
+            if (ele<0):
+                im.setPixel((px_x,px_y),blue)
+            elif (ele<options.minele):
+                im.setPixel((px_x,px_y),white)
+            elif (ele>float(options.maxele)):
+                im.setPixel((px_x,px_y),black)
+            else:
+                colval = 100-int(100.0*(ele-options.minele)/(float(options.maxele)-float(options.minele)))
+                im.setPixel((px_x,px_y),im.colorResolve((0,colval,0)))
+    f=open(fname,"w")
+    im.writePng(f)
+    f.close()
+
+#    pylab.contour(eleArr)
+#    pylab.savefig(fname)
+#    pylab.show()
+
+
 def srtm_tilegen(options):
     print "srtm_tilegen: options=%s" % options
     print "Requested Tile is X=%s, Y=%s, Z=%s" % \
@@ -89,9 +113,15 @@ def srtm_tilegen(options):
     tile_Y = int(options.y)
     Z = int(options.z)
 
-    srtm = srtm_tiff("srtm_tiff.txt",10,options.verbose,options.debug)
+    srtm = srtm_tiff(options.filename,10,options.verbose,options.debug)
 
-    rendertile(options,srtm,tile_X,tile_Y,Z)
+    if options.gd:
+        rendertile(options,srtm,tile_X,tile_Y,Z)
+    else:
+        try:
+            renderPyramid(options,srtm,tile_X,tile_Y,Z)
+        except KeyboardInterrupt:
+            sys.exit(1)
 
 
 if __name__ == '__main__':            
@@ -116,6 +146,17 @@ if __name__ == '__main__':
                       help="Minimum Elevation that is coloured in")
     parser.add_option("-r",action="store_true", dest="rerender",
                       help="Re-Render tiles, even if they already exist.")
+    parser.add_option("--gd",action="store_true", dest="gd",
+                      help="Use the old (slow) per-pixel gd renderer, one tile at a time.")
+    parser.add_option("-p", "--procs",dest="procs",
+                      help="Number of rendering processes (0 to render in this process)")
+    parser.add_option("--covered",action="store_true", dest="covered",
+                      help="Only render tiles which overlap the elevation data.")
+    parser.add_option("--overview",dest="overview",type="choice",
+                      choices=OVERVIEW_METHODS,
+                      help="Make the tiles above the maximum zoom level from their children's elevations, with method mean, min or max.")
+    parser.add_option("--layer",dest="layer",type="choice",choices=LAYERS,
+                      help="Layer to render - elevation, hillshade, slope or aspect (use a separate output directory for each).")
     parser.add_option("-t", "--test", action="store_true",dest="test",
                       help="Run a series of self tests")
     parser.add_option("--bigtest",dest="bigtest",
@@ -137,11 +178,18 @@ if __name__ == '__main__':
                         minele = 200.0,
                         maxzoom = 17,
                         rerender=False,
+                        gd=False,
+                        procs=multiprocessing.cpu_count(),
+                        covered=False,
+                        overview=None,
+                        layer='elevation',
                         test=False,
                         bigtest=0,
                         debug=False,
                         verbose=False)
     (options,args)=parser.parse_args()
+    if options.layer != 'elevation' and (options.overview or options.gd):
+        parser.error("--overview and --gd only work for the elevation layer")
 
     if (options.debug):
         options.verbose = True
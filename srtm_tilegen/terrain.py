@@ -0,0 +1,215 @@
+#!/usr/bin/python
+"""
+Works out terrain products - hillshade, slope and aspect - from arrays
+of elevations, and writes them as GeoTIFF rasters for the tiles in a
+tile list.
+
+The gradients are found with Horn's method: the 3x3 weighted finite
+differences around each pixel are worked out for the whole array at once
+from shifted views of it, so the elevations must have a one pixel
+border around the pixels the products are wanted for.  The pixel spacing
+in metres is passed in, and may be different for each row, as the east
+west size of a pixel shrinks with latitude.
+
+To write slope rasters for the tiles listed in srtm_tiff.txt do:
+   python ./terrain.py -f srtm_tiff.txt -o slope_tiffs --product slope
+
+"""
+import os
+import fileinput
+from math import radians
+from optparse import OptionParser
+import numpy
+import gdal, gdalnumeric
+from srtm_tiff3 import srtm_tiff
+
+PRODUCTS = ('hillshade','slope','aspect')
+EARTH_RADIUS = 6372795.0  # metres.
+AZIMUTH = 315.0           # direction the hillshade is lit from (degrees).
+ALTITUDE = 45.0           # height of the light above the horizon (degrees).
+STRIP_ROWS = 512          # rows of a raster worked out at once.
+RASTER_NODATA = -9999.0   # no data value of the slope and aspect rasters.
+
+def hornGradients(eles,dx,dy):
+    """Return arrays (dzdx,dzdy) of the east and north gradients of the
+    elevations of the pixels of eles inside its one pixel border, so they
+    are two rows and columns smaller than eles.  dx and dy are the pixel
+    width and height in metres - numbers, or arrays with a value for each
+    row.  Gradients which use a void (or NaN) elevation are NaN.
+    """
+    eles = numpy.asarray(eles,dtype=float)
+    (h,w) = (eles.shape[0]-2,eles.shape[1]-2)
+    eles = numpy.where(eles > -999,eles,numpy.nan)
+    def shifted(dr,dc):
+        return eles[1+dr:1+dr+h,1+dc:1+dc+w]
+    # Row 0 is the north edge.
+    east = shifted(-1,1) + 2*shifted(0,1) + shifted(1,1)
+    west = shifted(-1,-1) + 2*shifted(0,-1) + shifted(1,-1)
+    north = shifted(-1,-1) + 2*shifted(-1,0) + shifted(-1,1)
+    south = shifted(1,-1) + 2*shifted(1,0) + shifted(1,1)
+    dx = numpy.reshape(numpy.asarray(dx,dtype=float),(-1,1))
+    dy = numpy.reshape(numpy.asarray(dy,dtype=float),(-1,1))
+    return ((east-west)/(8*dx), (north-south)/(8*dy))
+
+
+def slope(dzdx,dzdy):
+    "Return the slope in degrees from the horizontal."
+    return numpy.degrees(numpy.arctan(numpy.hypot(dzdx,dzdy)))
+
+
+def aspect(dzdx,dzdy):
+    """Return the aspect - the compass direction the slope faces, in
+    degrees clockwise from north - or -1 where the ground is flat."""
+    result = numpy.degrees(numpy.arctan2(-dzdx,-dzdy)) % 360.0
+    return numpy.where((dzdx == 0) & (dzdy == 0),-1.0,result)
+
+
+def hillshade(dzdx,dzdy,azimuth=AZIMUTH,altitude=ALTITUDE):
+    """Return the brightness (0 to 1) of the ground lit from compass
+    direction azimuth, altitude degrees above the horizon - the cosine of
+    the angle between the light and the ground's normal."""
+    (az,alt) = (radians(azimuth),radians(altitude))
+    lit = (-dzdx*numpy.sin(az)*numpy.cos(alt) -
+           dzdy*numpy.cos(az)*numpy.cos(alt) + numpy.sin(alt)) / \
+          numpy.sqrt(dzdx**2 + dzdy**2 + 1)
+    return numpy.clip(lit,0.0,1.0)
+
+
+def terrainProduct(name,eles,dx,dy):
+    """Return product name (one of PRODUCTS) for the pixels of eles inside
+    its one pixel border (see hornGradients()), NaN where there is no data.
+    """
+    (dzdx,dzdy) = hornGradients(eles,dx,dy)
+    if name == 'hillshade':
+        return hillshade(dzdx,dzdy)
+    elif name == 'slope':
+        return slope(dzdx,dzdy)
+    elif name == 'aspect':
+        return aspect(dzdx,dzdy)
+    raise ValueError("unknown terrain product %s" % name)
+
+
+def geographicPixelSize(lats,lat_pixel,lon_pixel):
+    """Return (dx,dy), the width of the pixels of a latitude/longitude
+    grid in metres in each row (at latitudes lats), and their height."""
+    dx = EARTH_RADIUS*radians(abs(lon_pixel))*numpy.cos(numpy.radians(lats))
+    return (dx, EARTH_RADIUS*radians(abs(lat_pixel)))
+
+
+def readStrip(dataset,geotransform,row0,nrows,source):
+    """Return an array of the elevations of rows row0 to row0+nrows-1 of
+    GeoTIFF dataset, with a one pixel border, and NaN for voids.  The rows
+    above and below come from the dataset where it has them, and the rest
+    of the border from the neighbouring tiles with source (a srtm_tiff
+    object), or copied from the edge where there are none.
+    """
+    (xsize,ysize) = (dataset.RasterXSize,dataset.RasterYSize)
+    first = max(row0-1,0)
+    last = min(row0+nrows+1,ysize)
+    data = gdalnumeric.DatasetReadAsArray(dataset,0,first,xsize,
+                                          last-first).astype(float)
+    (above,below) = (1-(row0-first),1-(last-row0-nrows))
+    data = numpy.pad(data,((above,below),(1,1)),mode='edge')
+    # As srtm_raw.fillHalo(), but only for the border pixels off the tile.
+    offtile = numpy.zeros(data.shape,dtype=bool)
+    offtile[:,0] = offtile[:,-1] = True
+    offtile[:above] = True
+    offtile[data.shape[0]-below:] = True
+    (rr,cc) = numpy.nonzero(offtile)
+    lats = geotransform[3] + (row0+rr-1+0.5)*geotransform[5]
+    lons = geotransform[0] + (cc-1+0.5)*geotransform[1]
+    (eles,outside) = source.getElevations(lats,lons)
+    data[rr[~outside],cc[~outside]] = eles[~outside]
+    # Voids are -32768 in SRTM data.
+    data[data == -32768] = numpy.nan
+    return data
+
+
+def writeProductRaster(fname,outfname,name,source,verbose=False):
+    """Write product name of GeoTIFF elevation tile fname to GeoTIFF file
+    outfname, on the same grid.  The border needed at the edges of the tile
+    is read from the neighbouring tiles with source (a srtm_tiff object for
+    the complete tile set), or copied from the edge where there are none.
+    Hillshade is written as bytes (0 for no data), and slope and aspect as
+    degrees, with a no data value of RASTER_NODATA.
+
+    The tile is read and the raster worked out STRIP_ROWS rows at a time,
+    so only a strip of it is in memory at once.  It is written under a
+    temporary name and renamed into place.
+    """
+    if (verbose):
+        print "Writing %s of %s to %s" % (name,fname,outfname)
+    dataset = gdal.Open(fname)
+    geotransform = dataset.GetGeoTransform()
+    (xsize,ysize) = (dataset.RasterXSize,dataset.RasterYSize)
+
+    if name == 'hillshade':
+        (datatype,nodata) = (gdal.GDT_Byte,0)
+    else:
+        (datatype,nodata) = (gdal.GDT_Float32,RASTER_NODATA)
+    tmpfname = "%s.%d.tmp.tif" % (outfname,os.getpid())
+    out = gdal.GetDriverByName('GTiff').Create(tmpfname,xsize,ysize,1,datatype)
+    out.SetGeoTransform(geotransform)
+    out.SetProjection(dataset.GetProjection())
+    band = out.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    for row0 in range(0,ysize,STRIP_ROWS):
+        nrows = min(STRIP_ROWS,ysize-row0)
+        lats = geotransform[3] + (row0+numpy.arange(nrows)+0.5)*geotransform[5]
+        (dx,dy) = geographicPixelSize(lats,geotransform[5],geotransform[1])
+        values = terrainProduct(name,readStrip(dataset,geotransform,row0,
+                                               nrows,source),dx,dy)
+        if name == 'hillshade':
+            values = numpy.where(numpy.isnan(values),0,1+values*254)
+            values = values.astype(numpy.uint8)
+        else:
+            values = numpy.where(numpy.isnan(values),nodata,values)
+        band.WriteArray(values,0,row0)
+    band.FlushCache()
+    del band, out
+    os.rename(tmpfname,outfname)
+
+
+def productFileName(outputdir,fname,name):
+    base = os.path.splitext(os.path.basename(fname))[0]
+    return os.path.join(outputdir,"%s_%s.tif" % (base,name))
+
+
+def writeProductRasters(fname,outputdir,names=PRODUCTS,verbose=False):
+    """Write products names of each of the GeoTIFF tiles listed in tile
+    list file fname (the format used by srtm_tiff) to outputdir, as
+    <tile>_<product>.tif."""
+    tilefnames = [line.split(None,1)[0] for line in fileinput.input(fname)]
+    fileinput.close()
+    source = srtm_tiff(fname,10,False,False)
+    if not os.path.isdir(outputdir):
+        os.makedirs(outputdir)
+    for tilefname in tilefnames:
+        for name in names:
+            writeProductRaster(tilefname,productFileName(outputdir,tilefname,name),
+                               name,source,verbose)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    usage = "terrain [options]"
+    parser.add_option("-f", "--file", dest="filename",
+                      help="name of file containing list of srtm data files",
+                      metavar="FILE")
+    parser.add_option("-o", dest="outputdir",
+                      help="Output directory for the rasters")
+    parser.add_option("--product", action="append", dest="products",
+                      help="Product to write - hillshade, slope or aspect (may be given more than once, default all of them)")
+    parser.add_option("-v", "--verbose", action="store_true",dest="verbose",
+                      help="Include verbose output")
+    parser.set_defaults(filename="srtm_tiff.txt",
+                        outputdir="./terrain",
+                        products=None,
+                        verbose=False)
+    (options,args)=parser.parse_args()
+    products = options.products or PRODUCTS
+    for name in products:
+        if name not in PRODUCTS:
+            parser.error("unknown product %s" % name)
+    writeProductRasters(options.filename,options.outputdir,products,
+                        options.verbose)
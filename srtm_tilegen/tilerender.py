@@ -0,0 +1,233 @@
+#!/usr/bin/python
+#-------------------------------------------------------
+# Renders elevation map tiles with NumPy array operations.
+#
+# The latitudes and longitudes of all of the pixels of a tile are worked
+# out at once (the latitude only depends on the row, and the longitude on
+# the column), all of the elevations are looked up with one
+# srtm.getElevations() call, which reads each data tile with a single
+# window and interpolates with array operations, the colours are picked
+# through a lookup table, and the PNG is written straight from the
+# array - so a tile takes milliseconds rather than the seconds of the
+# per-pixel loop in srtm_tilegen.py.
+#
+# Besides the elevation layer, tiles can show the terrain products of
+# terrain.py (hillshade, slope and aspect), worked out from the
+# elevations of the tile plus a one pixel border.
+#-------------------------------------------------------
+import struct
+import zlib
+import colorsys
+import numpy
+from terrain import PRODUCTS, EARTH_RADIUS, terrainProduct
+
+TILE_SIZE = 256
+NGREENS = 101             # shades of green from minele to maxele.
+PNG_LEVEL = 6             # zlib compression level of the PNGs.
+NODATA = -999             # elevation of pixels not covered by the data.
+
+LAYERS = ('elevation',) + PRODUCTS
+SLOPE_MAX = 60.0          # slope (degrees) of the darkest red.
+NASPECTS = 36             # colours round the compass in the aspect layer.
+
+# Palette indices - the greens follow, from darkest (maxele) up.
+TRANSPARENT = 0
+BLUE = 1                  # no data (or below sea level).
+BLACK = 2                 # above maxele.
+GREEN0 = 3
+
+def tileLatLons(tile_X,tile_Y,Z,size=TILE_SIZE,border=0):
+    """Return arrays (lats,lons) of the latitudes of the rows and the
+    longitudes of the columns of the pixels of tile (tile_X,tile_Y,Z),
+    plus border pixels round the edge.  Each pixel is sampled at its north
+    west corner, as rendertile() does.
+    """
+    n = 2.0**Z
+    ys = (tile_Y + (numpy.arange(size+2*border)-border)/float(size))/n
+    xs = (tile_X + (numpy.arange(size+2*border)-border)/float(size))/n
+    lats = numpy.degrees(numpy.arctan(numpy.sinh(numpy.pi*(1 - 2*ys))))
+    lons = -180.0 + 360.0*xs
+    return (lats,lons)
+
+
+def tileElevations(srtm,tile_X,tile_Y,Z,size=TILE_SIZE,bilinear=True,
+                   border=0):
+    """Return a size x size array (indexed [row,column]) of the elevations
+    of the pixels of tile (tile_X,tile_Y,Z), looked up with srtm (a
+    srtm_tiff object) in one getElevations() call - with border more rows
+    and columns round each edge if border is given.  Pixels which are not
+    covered by the data are NODATA.
+    """
+    (lats,lons) = tileLatLons(tile_X,tile_Y,Z,size,border)
+    latGrid = numpy.repeat(lats,len(lons))
+    lonGrid = numpy.tile(lons,len(lats))
+    (eles, outside) = srtm.getElevations(latGrid,lonGrid,bilinear)
+    eles[outside] = NODATA
+    return eles.reshape((len(lats),len(lons)))
+
+
+def mercatorPixelSize(lats,Z,size=TILE_SIZE):
+    """Return the width (which is also the height) in metres of the pixels
+    of map tiles of zoom level Z at latitudes lats."""
+    return 2*numpy.pi*EARTH_RADIUS*numpy.cos(numpy.radians(lats))/(size*2.0**Z)
+
+
+def tileProduct(srtm,tile_X,tile_Y,Z,name,size=TILE_SIZE):
+    """Return a size x size array of terrain product name (see terrain.py)
+    for the pixels of tile (tile_X,tile_Y,Z), NaN where there is no data.
+    """
+    eles = tileElevations(srtm,tile_X,tile_Y,Z,size,border=1)
+    pixel = mercatorPixelSize(tileLatLons(tile_X,tile_Y,Z,size)[0],Z,size)
+    return terrainProduct(name,eles,pixel,pixel)
+
+
+def downsample(eles,method='mean'):
+    """Return an array of half the height and width of the 2-D array of
+    elevations eles, each element of which is the mean, min or max
+    (method) of the valid elevations of a 2x2 block of eles, or NODATA if
+    none of the four are valid.
+
+    The four children of a map tile split it exactly in half in each
+    direction, so the elevations of a tile can be made from those of its
+    children, at a quarter of the cost of sampling the data again.
+    """
+    (height, width) = eles.shape
+    blocks = eles.reshape((height/2,2,width/2,2)).swapaxes(1,2)
+    blocks = blocks.reshape((height/2,width/2,4))
+    valid = blocks > NODATA
+    count = valid.sum(axis=2)
+    if method == 'mean':
+        result = numpy.where(valid,blocks,0).sum(axis=2)/numpy.maximum(count,1)
+    elif method == 'min':
+        result = numpy.where(valid,blocks,numpy.inf).min(axis=2)
+    elif method == 'max':
+        result = numpy.where(valid,blocks,-numpy.inf).max(axis=2)
+    else:
+        raise ValueError("unknown downsampling method %s" % method)
+    return numpy.where(count > 0,result,NODATA)
+
+
+def palette():
+    "Return the list of (r,g,b) colours the palette indices stand for."
+    colours = [(255,255,255), (0,0,255), (0,0,0)]
+    colours.extend([(0,colval,0) for colval in range(NGREENS)])
+    return colours
+
+
+def layerPalette(layer):
+    """Return the palette of terrain product layer - index TRANSPARENT is
+    no data, then greys from black for hillshade, reds from white (flat)
+    for slope, and for aspect grey (flat) and then the colours of the
+    directions round the compass from north."""
+    colours = [(255,255,255)]
+    if layer == 'hillshade':
+        colours.extend([(v,v,v) for v in range(255)])
+    elif layer == 'slope':
+        n = int(SLOPE_MAX)
+        colours.extend([(255,255-255*k/n,255-255*k/n) for k in range(n+1)])
+    elif layer == 'aspect':
+        colours.append((160,160,160))
+        for k in range(NASPECTS):
+            (r,g,b) = colorsys.hsv_to_rgb(float(k)/NASPECTS,0.6,0.95)
+            colours.append((int(255*r),int(255*g),int(255*b)))
+    else:
+        raise ValueError("unknown layer %s" % layer)
+    return colours
+
+
+def layerIndices(values,layer):
+    """Return an array of the palette indices (see layerPalette()) of
+    terrain product layer's values."""
+    nodata = numpy.isnan(values)
+    values = numpy.nan_to_num(values)
+    if layer == 'hillshade':
+        indices = 1 + numpy.round(values*254)
+    elif layer == 'slope':
+        indices = 1 + numpy.round(numpy.clip(values,0,SLOPE_MAX))
+    elif layer == 'aspect':
+        sector = numpy.floor(values*NASPECTS/360.0 + 0.5) % NASPECTS
+        indices = numpy.where(values < 0,1,2 + sector)
+    else:
+        raise ValueError("unknown layer %s" % layer)
+    return numpy.where(nodata,TRANSPARENT,indices).astype(numpy.uint8)
+
+
+def colourIndices(eles,minele,maxele):
+    """Return an array of the palette indices of the pixels with elevations
+    eles - blue below 0 (no data), transparent below minele, black above
+    maxele, and a green which is darker the higher the pixel is between.
+    """
+    minele = float(minele)
+    maxele = float(maxele)
+    scaled = (eles - minele)*((NGREENS-1)/(maxele - minele))
+    greens = GREEN0 + (NGREENS-1) - \
+             numpy.clip(scaled,0,NGREENS-1).astype(numpy.uint8)
+    indices = numpy.where(eles > maxele, BLACK, greens)
+    indices = numpy.where(eles < minele, TRANSPARENT, indices)
+    indices = numpy.where(eles < 0, BLUE, indices)
+    return indices.astype(numpy.uint8)
+
+
+def pngChunk(tag,data):
+    return struct.pack('>I',len(data)) + tag + data + \
+           struct.pack('>I',zlib.crc32(tag + data) & 0xffffffff)
+
+
+def encodePNG(indices,colours,transparent=None,level=PNG_LEVEL):
+    """Return a paletted PNG image (as a string) of the 2-D uint8 array
+    of palette indices, with palette colours (a list of (r,g,b)), in which
+    palette index transparent (if not None) is see-through.
+    """
+    (height, width) = indices.shape
+    # Each row starts with its filter type - 0, no filtering.
+    rows = numpy.zeros((height,width+1),numpy.uint8)
+    rows[:,1:] = indices
+    png = ['\x89PNG\r\n\x1a\n',
+           pngChunk('IHDR',struct.pack('>IIBBBBB',width,height,8,3,0,0,0)),
+           pngChunk('PLTE',''.join([struct.pack('BBB',*c) for c in colours]))]
+    if transparent is not None:
+        png.append(pngChunk('tRNS','\xff'*transparent + '\x00'))
+    png.append(pngChunk('IDAT',zlib.compress(rows.tostring(),level)))
+    png.append(pngChunk('IEND',''))
+    return ''.join(png)
+
+
+def renderElevations(eles,minele,maxele):
+    """Return the PNG image (a string) of the 2-D array of elevations eles,
+    coloured as srtm_tilegen's rendertile() does."""
+    return encodePNG(colourIndices(eles,minele,maxele),palette(),TRANSPARENT)
+
+
+def renderTile(srtm,tile_X,tile_Y,Z,minele,maxele,size=TILE_SIZE,
+               layer='elevation'):
+    """Return the PNG image (a string) of map tile (tile_X,tile_Y,Z) of
+    layer (one of LAYERS), with elevations from srtm (a srtm_tiff
+    object).  The elevation layer is coloured as srtm_tilegen's
+    rendertile() does, from minele to maxele.
+    """
+    if layer == 'elevation':
+        return renderElevations(tileElevations(srtm,tile_X,tile_Y,Z,size),
+                                minele,maxele)
+    values = tileProduct(srtm,tile_X,tile_Y,Z,layer,size)
+    return encodePNG(layerIndices(values,layer),layerPalette(layer),TRANSPARENT)
+
+
+def renderMetatile(srtm,tile_X,tile_Y,Z,ntiles,minele,maxele,size=TILE_SIZE,
+                   layer='elevation'):
+    """Return a dictionary, keyed on (X,Y), of the PNG images of layer of
+    the ntiles x ntiles block of map tiles (a metatile) with tile
+    (tile_X,tile_Y,Z) at its top left.
+
+    The tiles are rendered one after another, so after the first the data
+    they need comes from srtm's block cache.  Their elevations are not
+    looked up in one getElevations() call for the whole block, because
+    the array operations cost more per point once the arrays are too big
+    for the CPU's cache - an 8x8 metatile took half as long again per
+    tile that way, and 400 MB.
+    """
+    tiles = {}
+    for j in range(ntiles):
+        for i in range(ntiles):
+            tiles[(tile_X+i,tile_Y+j)] = renderTile(srtm,tile_X+i,tile_Y+j,Z,
+                                                    minele,maxele,size,layer)
+    return tiles
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+"""
+Serves the static files (eleserver.html, plots...) of the elevation
+servers from a document root directory.
+
+Only class staticFiles is defined in this module, plus sendFile(), which
+copies a file to a socket with sendfile() where it can, and etagMatches(),
+which checks an If-None-Match header.
+
+"""
+import os
+import sys
+import errno
+import select
+import socket
+import mimetypes
+import urllib
+import cgi
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from lrucache import LRUCache
+
+INDEX = 'eleserver.html'      # file served for a directory.
+SMALL_FILE = 256*1024         # files up to this size are kept in memory.
+CACHE_BYTES = 16*1024*1024    # total size of the files kept in memory.
+CACHE_FILES = 1000            # number of files kept in memory.
+STATIC_MAX_AGE = 3600         # seconds clients may cache a file for.
+COPY_SIZE = 65536             # bytes copied at a time without sendfile().
+
+# Python 2 has no os.sendfile(), so use the C library's on Linux.
+try:
+    _sendfile = os.sendfile
+except AttributeError:
+    _sendfile = None
+    if sys.platform.startswith('linux'):
+        try:
+            import ctypes, ctypes.util
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+            _libcSendfile = _libc.sendfile64
+            _libcSendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                                      ctypes.POINTER(ctypes.c_int64),
+                                      ctypes.c_size_t]
+            _libcSendfile.restype = ctypes.c_ssize_t
+
+            def _sendfile(outfd, infd, offset, count):
+                offset = ctypes.c_int64(offset)
+                n = _libcSendfile(outfd, infd, ctypes.byref(offset), count)
+                if n < 0:
+                    e = ctypes.get_errno()
+                    raise OSError(e, os.strerror(e))
+                return n
+        except (ImportError, OSError, AttributeError):
+            _sendfile = None
+
+
+def etagMatches(etag, ifNoneMatch):
+    """Return True if ifNoneMatch (an If-None-Match request header, or
+    None) matches etag, so the client already has the current version."""
+    if not ifNoneMatch:
+        return False
+    tags = [tag.strip() for tag in ifNoneMatch.split(',')]
+    if '*' in tags:
+        return True
+    # If-None-Match uses the weak comparison, so W/ is ignored.
+    return etag.replace('W/','',1) in [tag.replace('W/','',1) for tag in tags]
+
+
+def sendFile(sock, f, count):
+    """Send count bytes of open file f, from its start, to socket sock.
+    Uses sendfile() so that the data is not copied through Python if it
+    is available, otherwise copies COPY_SIZE bytes at a time.  Returns the
+    number of bytes sent, which is less than count if the file has got
+    shorter.
+    """
+    sent = 0
+    if _sendfile is not None:
+        while sent < count:
+            try:
+                n = _sendfile(sock.fileno(), f.fileno(), sent, count-sent)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.EAGAIN:
+                    raise
+                # The socket has a timeout, so it is non-blocking - wait
+                # until it can take more.
+                (r, w, x) = select.select([], [sock], [], sock.gettimeout())
+                if not w:
+                    raise socket.timeout('timed out')
+                continue
+            if n == 0:
+                break
+            sent += n
+        return sent
+    f.seek(0)
+    while sent < count:
+        data = f.read(min(COPY_SIZE, count-sent))
+        if not data:
+            break
+        sock.sendall(data)
+        sent += len(data)
+    return sent
+
+
+class staticFiles:
+    """
+    Finds the files requested from directory docroot.  Only regular files
+    inside docroot (after following any symbolic links) can be served,
+    and not ones whose names start with '.'.  Files of up to smallFile
+    bytes are kept in an LRU cache of up to cacheBytes bytes, and are
+    checked with os.stat() on each request so that changes are seen.
+
+    To serve a file do:
+        files = staticFiles('/var/www/eleserver')
+        info = files.lookup(path)
+        if info is None:
+            # reply 404
+        elif files.notModified(info, ifNoneMatch, ifModifiedSince):
+            # reply 304 with files.headers(info)
+        elif info['data'] is not None:
+            # reply 200 with files.headers(info) and info['data']
+        else:
+            # reply 200 with files.headers(info), then
+            # sendFile(sock, info['file'], info['size'])
+        files.close(info)
+
+    """
+    def __init__(self, docroot='.', cacheBytes=CACHE_BYTES,
+                 smallFile=SMALL_FILE):
+        self.docroot = os.path.realpath(docroot)
+        self.smallFile = int(smallFile)
+        self.cache = LRUCache(CACHE_FILES, cacheBytes)
+
+    def resolve(self, path):
+        """Return the file name for URL path (which may have a query
+        string), or None if it is not allowed."""
+        path = urllib.unquote(path.split('?',1)[0])
+        parts = [part for part in path.split('/') if part not in ('','.')]
+        if [part for part in parts if part.startswith('.')]:
+            return None
+        # The os.path functions raise TypeError for a NUL byte, and no
+        # file we serve has a control character in its name.
+        if [c for c in path if ord(c) < 32 or c == '\x7f']:
+            return None
+        fname = os.path.realpath(os.path.join(self.docroot, *parts))
+        if os.path.isdir(fname):
+            fname = os.path.realpath(os.path.join(fname, INDEX))
+        if not fname.startswith(self.docroot.rstrip(os.sep) + os.sep):
+            return None
+        return fname
+
+    def lookup(self, path):
+        """Return a dictionary describing the file for URL path, or None
+        if there is no such file (or it is not allowed):
+            'fname', 'size', 'mtime', 'ctype': its name, size, modification
+                time and content type
+            'etag', 'lastmodified': its validators
+            'data': its contents, if it is small enough to keep in memory,
+                otherwise None
+            'file': the open file if data is None - pass info to close()
+                when it has been sent
+        """
+        fname = self.resolve(path)
+        if fname is None:
+            return None
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        if not os.path.isfile(fname):
+            return None
+        info = {'fname':fname, 'data':None, 'file':None}
+        cached = self.cache.get(fname)
+        if cached is not None and cached[0] == (st.st_mtime, st.st_size):
+            info['data'] = cached[1]
+        else:
+            try:
+                f = open(fname, 'rb')
+            except IOError:
+                return None
+            # Use the stat of the file we opened, which may not be the one
+            # we looked at if it has been replaced since.
+            st = os.fstat(f.fileno())
+            if st.st_size <= self.smallFile:
+                info['data'] = f.read()
+                f.close()
+                self.cache.put(fname, ((st.st_mtime, st.st_size), info['data']),
+                               st.st_size)
+            else:
+                info['file'] = f
+        info['size'] = st.st_size
+        info['mtime'] = int(st.st_mtime)
+        info['ctype'] = mimetypes.guess_type(fname)[0] or 'application/octet-stream'
+        info['etag'] = '"%x-%x"' % (info['mtime'], st.st_size)
+        info['lastmodified'] = formatdate(info['mtime'], usegmt=True)
+        return info
+
+    def headers(self, info):
+        "Return the validator and caching headers for file info."
+        return [('ETag', info['etag']),
+                ('Last-Modified', info['lastmodified']),
+                ('Cache-Control', 'public, max-age=%d' % STATIC_MAX_AGE)]
+
+    def notModified(self, info, ifNoneMatch=None, ifModifiedSince=None):
+        """Return True if the client already has file info, according to
+        its If-None-Match and If-Modified-Since headers (which are used
+        only if there is no If-None-Match)."""
+        if ifNoneMatch:
+            return etagMatches(info['etag'], ifNoneMatch)
+        if ifModifiedSince:
+            t = parsedate_tz(ifModifiedSince)
+            if t is not None:
+                return info['mtime'] <= mktime_tz(t)
+        return False
+
+    def reply(self, path, ifNoneMatch=None, ifModifiedSince=None):
+        """Return the whole reply (code, content type, body, headers) for
+        URL path - for front ends which do not send files with sendFile()."""
+        info = self.lookup(path)
+        if info is None:
+            return (404, 'text/html', 'Error - %s not found' % cgi.escape(path), [])
+        try:
+            if self.notModified(info, ifNoneMatch, ifModifiedSince):
+                return (304, info['ctype'], '', self.headers(info))
+            data = info['data']
+            if data is None:
+                data = info['file'].read()
+            return (200, info['ctype'], data, self.headers(info))
+        finally:
+            self.close(info)
+
+    def close(self, info):
+        "Close the file opened by lookup() for info, if any."
+        if info['file'] is not None:
+            info['file'].close()
+            info['file'] = None
+
+    def getStats(self):
+        "Return the statistics of the cache of small files."
+        return self.cache.getStats()
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+"""
+Renders elevation map tiles (GET /tiles/{z}/{x}/{y}.png), and tiles of
+the hillshade, slope and aspect layers (GET /tiles/{layer}/{z}/{x}/{y}.png)
+for the elevation servers when they are asked for, and caches them.
+
+Only class tileCache is defined in this module, plus parseTilePath(),
+which picks the tile out of a URL path.  The tiles are coloured as
+srtm_tilegen colours them (see srtm_tilegen/tilerender.py).
+
+"""
+import os
+import re
+import threading
+from srtm_tilegen.tilerender import renderMetatile, LAYERS, PRODUCTS
+from srtm_tilegen.pyramid import tileFileName, writeFile
+from lrucache import LRUCache
+
+TILEDIR = 'tiles'
+MINELE = 200.0            # elevation (m) of the lightest green.
+MAXELE = 500.0            # elevation (m) of the darkest green.
+METATILE = 8              # tiles rendered at once in each direction.
+MAX_ZOOM = 17
+TILE_CACHE_BYTES = 64*1024*1024   # total size of the tiles kept in memory.
+TILE_CACHE_TILES = 100000         # number of tiles kept in memory.
+
+TILE_PATH = re.compile(r'^/tiles/(?:(%s)/)?(\d+)/(\d+)/(\d+)\.png$' %
+                       '|'.join(PRODUCTS))
+
+def parseTilePath(path):
+    """Return the tile (layer,z,x,y) requested by URL path (which may have
+    a query string), or None if it is not a /tiles/[{layer}/]{z}/{x}/{y}.png
+    path.  The layer is 'elevation' if it is not given."""
+    m = TILE_PATH.match(path.split('?',1)[0])
+    if m is None:
+        return None
+    return tuple([m.group(1) or 'elevation'] +
+                 [int(v) for v in m.groups()[1:]])
+
+
+class tileCache:
+    """
+    Renders map tiles on demand, using the elevation data of the srtm_tiff
+    object passed to getTile(), and colours running from minele to maxele
+    metres.
+
+    Tiles are rendered a metatile at a time - the block of metatile x
+    metatile tiles around the one asked for - as the neighbours of a tile
+    are usually asked for next, and rendering them together reads the
+    data for the block once, rather than once for every map tile.  The
+    tiles are kept in directory tiledir as {z}/{x}/{y}.png, the layout
+    srtm_tilegen writes, so a pyramid rendered with it can be served as
+    it is (the tiles of the other layers go in {layer}/{z}/{x}/{y}.png),
+    and the most recently used ones are kept in memory, in up to
+    cacheBytes bytes.  Requests for tiles of a metatile which is being
+    rendered wait for it rather than rendering it again.
+
+    The tiles on disk are not checked against minele and maxele, so
+    empty tiledir when changing them.
+
+    To use this class do:
+        tiles = tileCache('/var/cache/eleserver/tiles')
+        png = tiles.getTile(srtm,z,x,y,'hillshade')
+        if png is None:
+            # reply 404 - there is no such tile.
+
+    """
+    def __init__(self, tiledir=TILEDIR, minele=MINELE, maxele=MAXELE,
+                 metatile=METATILE, cacheBytes=TILE_CACHE_BYTES,
+                 maxZoom=MAX_ZOOM):
+        self.tiledir = tiledir
+        self.minele = float(minele)
+        self.maxele = float(maxele)
+        self.metatile = max(int(metatile),1)
+        self.maxZoom = int(maxZoom)
+        if not os.path.isdir(tiledir):
+            os.makedirs(tiledir)
+        self.cache = LRUCache(TILE_CACHE_TILES, cacheBytes)
+        self.lock = threading.Lock()
+        self.rendering = {}    # (layer,z,x,y) of metatile -> threading.Event.
+        self.diskHits = 0
+        self.rendered = 0
+        self.coalesced = 0
+
+    def validTile(self, z, x, y, layer='elevation'):
+        return layer in LAYERS and 0 <= z <= self.maxZoom and \
+               0 <= x < 2**z and 0 <= y < 2**z
+
+    def layerDir(self, layer):
+        if layer == 'elevation':
+            return self.tiledir
+        return os.path.join(self.tiledir,layer)
+
+    def getTile(self, srtm, z, x, y, layer='elevation'):
+        """Return the PNG image (a string) of map tile (z,x,y) of layer
+        (one of tilerender.LAYERS) - from memory, from disk, or rendered
+        with srtm - or None if there is no such tile."""
+        if not self.validTile(z,x,y,layer):
+            return None
+        png = self.cache.get((layer,z,x,y))
+        if png is None:
+            png = self.readTile(z,x,y,layer)
+        if png is None:
+            png = self.renderTile(srtm,z,x,y,layer)
+        return png
+
+    def readTile(self, z, x, y, layer='elevation'):
+        "Return tile (z,x,y) of layer from disk, or None if it is not there."
+        try:
+            f = open(tileFileName(self.layerDir(layer),x,y,z),'rb')
+        except IOError:
+            return None
+        try:
+            png = f.read()
+        finally:
+            f.close()
+        self.diskHits += 1
+        self.cache.put((layer,z,x,y),png,len(png))
+        return png
+
+    def renderTile(self, srtm, z, x, y, layer='elevation'):
+        """Render the metatile of layer containing tile (z,x,y), or wait
+        for the thread which is already rendering it, and return the tile."""
+        n = min(self.metatile,2**z)
+        mkey = (layer,z,x-x%n,y-y%n)
+        with self.lock:
+            event = self.rendering.get(mkey)
+            if event is None:
+                event = threading.Event()
+                self.rendering[mkey] = event
+                owner = True
+            else:
+                owner = False
+                self.coalesced += 1
+        if not owner:
+            event.wait()
+            png = self.cache.get((layer,z,x,y)) or self.readTile(z,x,y,layer)
+            if png is None:
+                # It failed, or has already been evicted - try ourselves.
+                png = self.renderTile(srtm,z,x,y,layer)
+            return png
+        try:
+            # Another thread may have finished it since we looked.
+            png = self.cache.get((layer,z,x,y))
+            if png is not None:
+                return png
+            tiles = renderMetatile(srtm,mkey[2],mkey[3],z,n,
+                                   self.minele,self.maxele,layer=layer)
+            self.rendered += 1
+            for ((tx,ty),png) in tiles.items():
+                self.cache.put((layer,z,tx,ty),png,len(png))
+                try:
+                    writeFile(tileFileName(self.layerDir(layer),tx,ty,z),png)
+                except (IOError,OSError), e:
+                    print "tileCache - can not save tile %s - %s" % \
+                        ((layer,z,tx,ty),e)
+        finally:
+            with self.lock:
+                del self.rendering[mkey]
+            event.set()
+        return tiles[(x,y)]
+
+    def getStats(self):
+        """Return the statistics of the tiles kept in memory, with the
+        number of tiles read from disk, metatiles rendered, and requests
+        which waited for a metatile another request was rendering."""
+        stats = self.cache.getStats()
+        stats.update({'diskhits':self.diskHits, 'rendered':self.rendered,
+                      'coalesced':self.coalesced})
+        return stats